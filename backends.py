@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import sys
+import time
+import types
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+from exercise_engine import KEYPOINT_NAMES
+from servo import FakeServoKit
+
+
+def load(name="jetson", argv=None):
+    """Returns the poseNet, videoSource, videoOutput, cudaFont and ServoKit
+    classes of the given backend, along with its clock, the renderer of
+    cached text blocks, the allocator of images filled from numpy, the numpy
+    view of an image, the wait for the GPU to finish drawing and the command
+    line usage.
+
+    "jetson" is the real hardware, "sim" runs the same loop on any machine
+    with synthetic frames, scripted poses and an in-memory servo board.
+    """
+    if name == "jetson":
+        from jetson_inference import poseNet
+        from jetson_utils import videoSource, videoOutput, Log, cudaFont, cudaToNumpy, cudaDeviceSynchronize
+        from adafruit_servokit import ServoKit
+
+        # the --input-* options of the command line reach the camera
+        command_line = sys.argv[:1] + list(sys.argv[1:] if argv is None else argv)
+
+        def capture_source(uri="", buffers=4):
+            # the capture ring must hold every frame the pipeline has in flight
+            return videoSource(uri, argv=command_line + [f"--num-buffers={buffers}"])
+
+        return types.SimpleNamespace(name=name,
+                                     poseNet=poseNet,
+                                     videoSource=capture_source,
+                                     videoOutput=videoOutput,
+                                     cudaFont=cudaFont,
+                                     ServoKit=ServoKit,
+                                     clock=timer,
+                                     TextRenderer=CudaTextRenderer,
+                                     allocate_image=cuda_image,
+                                     to_numpy=cudaToNumpy,
+                                     synchronize=cudaDeviceSynchronize,
+                                     usage=poseNet.Usage() + videoSource.Usage() + videoOutput.Usage() + Log.Usage())
+    elif name == "sim":
+        parser = sim_parser()
+        opts = parser.parse_known_args(argv)[0]
+        # the frames carry the time they would have been captured at, so holds
+        # last as long in frames however fast the loop runs
+        opts.clock = SimClock()
+
+        def bind(cls):
+            return lambda *args, **kwargs: cls(opts, *args, **kwargs)
+
+        return types.SimpleNamespace(name=name,
+                                     poseNet=bind(SimPoseNet),
+                                     videoSource=bind(SimVideoSource),
+                                     videoOutput=bind(SimVideoOutput),
+                                     cudaFont=bind(SimFont),
+                                     ServoKit=lambda channels=16: FakeServoKit(channels, opts.sim_servo_ms / 1000.0),
+                                     clock=opts.clock,
+                                     TextRenderer=SimTextRenderer,
+                                     allocate_image=numpy_image,
+                                     to_numpy=np.asarray,
+                                     synchronize=lambda: None,
+                                     usage=parser.format_help())
+    raise ValueError(f"unknown backend {name}")
+
+
+def cuda_image(width, height):
+    """Returns an rgb8 image in mapped memory and a numpy view of it, so a
+    frame copied into the view needs no further upload for the GPU"""
+    from jetson_utils import cudaAllocMapped, cudaToNumpy
+    img = cudaAllocMapped(width=width, height=height, format="rgb8")
+    return img, cudaToNumpy(img)
+
+
+def numpy_image(width, height):
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    return img, img
+
+
+class CudaTextRenderer:
+    """Renders text blocks with cudaFont into their own images and blits
+    them with cudaOverlay.
+
+    cudaFont has no text extents, so the text is drawn onto a block filled
+    with a key color and cropped to the pixels that changed. The block is
+    copied rather than blended, so the background is drawn opaque.
+    """
+
+    KEY = (255, 0, 255)
+
+    def __init__(self):
+        from jetson_utils import cudaAllocMapped, cudaCrop, cudaOverlay, cudaToNumpy, cudaDeviceSynchronize
+        self.cudaAllocMapped = cudaAllocMapped
+        self.cudaCrop = cudaCrop
+        self.cudaOverlay = cudaOverlay
+        self.cudaToNumpy = cudaToNumpy
+        self.cudaDeviceSynchronize = cudaDeviceSynchronize
+
+    def render(self, font, text, color, background, format):
+        size = font.GetSize()
+        pad = int(size)
+        canvas = self.cudaAllocMapped(width=int(size * len(text)) + 2 * pad, height=int(2 * size) + 2 * pad,
+                                      format=format or "rgb8")
+        pixels = self.cudaToNumpy(canvas)
+        pixels[:, :, :3] = self.KEY
+        font.OverlayText(canvas, text=text, x=pad, y=pad, color=color, background=tuple(background[:3]) + (255,))
+        self.cudaDeviceSynchronize()
+
+        drawn = np.any(pixels[:, :, :3] != self.KEY, axis=2)
+        rows = np.flatnonzero(drawn.any(axis=1))
+        cols = np.flatnonzero(drawn.any(axis=0))
+        if len(rows) == 0:
+            return None
+        left, top, right, bottom = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+        block = self.cudaAllocMapped(width=right - left, height=bottom - top, format=canvas.format)
+        self.cudaCrop(canvas, block, (left, top, right, bottom))
+        return block, (left - pad, top - pad)
+
+    def blit(self, block, img, x, y):
+        self.cudaOverlay(block, img, x, y)
+
+
+class SimTextRenderer:
+    def render(self, font, text, color, background, format):
+        h, w = int(font.GetSize()), int(0.6 * font.GetSize() * len(text))
+        if w == 0:
+            return None
+        return np.full((h, w, 3), background[:3], dtype=np.uint8), (0, 0)
+
+    def blit(self, block, img, x, y):
+        h = min(block.shape[0], img.shape[0] - y)
+        w = min(block.shape[1], img.shape[1] - x)
+        if h > 0 and w > 0:
+            img[y:y + h, x:x + w] = block[:h, :w]
+
+
+def sim_parser():
+    parser = argparse.ArgumentParser(prog="sim backend", add_help=False)
+    parser.add_argument("--sim-frames", type=int, default=0, help="frames to capture before the stream ends, 0 for no end")
+    parser.add_argument("--sim-width", type=int, default=1280)
+    parser.add_argument("--sim-height", type=int, default=720)
+    parser.add_argument("--sim-fps", type=float, default=0.0, help="camera frame rate, 0 to capture as fast as possible")
+    parser.add_argument("--sim-inference-ms", type=float, default=0.0, help="time poseNet takes per frame")
+    parser.add_argument("--sim-render-ms", type=float, default=0.0, help="time the display takes per frame")
+    parser.add_argument("--sim-servo-ms", type=float, default=0.0, help="time each servo write takes")
+    parser.add_argument("--sim-trace", type=str, default="", help="replay the poses of this trace instead of the script")
+    parser.add_argument("--sim-hold", type=float, default=6.0, help="seconds of each scripted hold")
+    parser.add_argument("--sim-rest", type=float, default=2.0, help="seconds of rest between the scripted holds")
+    parser.add_argument("--sim-dropout", type=float, default=0.02, help="chance of a keypoint not being detected")
+    parser.add_argument("--sim-glitch", type=float, default=0.0, help="chance of a frame with the body detected at rest")
+    parser.add_argument("--sim-seed", type=int, default=0)
+    return parser
+
+
+class SimClock:
+    """The capture time of the frame a SimVideoSource captured last. Frames
+    from elsewhere, like a frame bus, are not stamped, so the clock ticks on
+    its own in seconds since it was made."""
+
+    def __init__(self):
+        self.time = 0.0
+        self.driven = False   # set once a SimVideoSource stamps its frames
+        self.start = timer()
+
+    def __call__(self):
+        if self.driven:
+            return self.time
+        return timer() - self.start
+
+
+def script_weight(opts, t):
+    """How far the scripted person is from REST (0) to ACTIVE (1) at time t"""
+    period = opts.sim_hold + opts.sim_rest
+    phase = math.fmod(t, period)
+    if phase < 0.5:
+        return phase / 0.5
+    elif phase < opts.sim_hold:
+        return 1.0
+    elif phase < opts.sim_hold + 0.5:
+        return 1.0 - (phase - opts.sim_hold) / 0.5
+    return 0.0
+
+
+class SimVideoSource:
+    """Generates frames from a small pool, like the capture ring buffer.
+    A block moves with the scripted arms, so the frames only change while
+    the scripted person moves."""
+
+    def __init__(self, opts, *args, buffers=4, **kwargs):
+        self.opts = opts
+        self.width = opts.sim_width
+        self.height = opts.sim_height
+        self.frames = 0
+        self._pool = [np.full((self.height, self.width, 3), 48, dtype=np.uint8) for i in range(buffers)]
+        self._drawn = [None] * buffers
+        self._next_time = None
+
+    @property
+    def buffers(self):
+        return len(self._pool)
+
+    def _draw(self, index, t):
+        # a buffer is only redrawn when the block moved since it was last used
+        top = int(self.height * (0.55 - 0.4 * script_weight(self.opts, t)))
+        if self._drawn[index] == top:
+            return
+        img = self._pool[index]
+        img.fill(48)
+        img[top:top + self.height // 8, self.width // 2 - self.width // 16:self.width // 2 + self.width // 16] = 200
+        self._drawn[index] = top
+
+    def Capture(self, timeout=-1):
+        if not self.IsStreaming():
+            return None
+        if self.opts.sim_fps > 0:
+            now = time.monotonic()
+            if self._next_time is None:
+                self._next_time = now
+            if self._next_time > now:
+                time.sleep(self._next_time - now)
+            self._next_time += 1.0 / self.opts.sim_fps
+        index = self.frames % len(self._pool)
+        img = self._pool[index]
+        self.opts.clock.time = self.frames / (self.opts.sim_fps or 30.0)
+        if not self.opts.sim_trace:
+            self._draw(index, self.opts.clock.time)
+        self.opts.clock.driven = True
+        self.frames += 1
+        return img
+
+    def IsStreaming(self)->bool:
+        return self.opts.sim_frames <= 0 or self.frames < self.opts.sim_frames
+
+    def GetWidth(self):
+        return self.width
+
+    def GetHeight(self):
+        return self.height
+
+
+class SimVideoOutput:
+    def __init__(self, opts, *args, **kwargs):
+        self.opts = opts
+        self.frames = 0
+
+    def Render(self, img):
+        if self.opts.sim_render_ms > 0:
+            time.sleep(self.opts.sim_render_ms / 1000.0)
+        self.frames += 1
+
+    def SetStatus(self, status):
+        pass
+
+    def IsStreaming(self)->bool:
+        return True
+
+
+class SimFont:
+    White = (255, 255, 255, 255)
+    Gray40 = (40, 40, 40, 100)
+
+    def __init__(self, opts, *args, size=32.0, **kwargs):
+        self.size = size
+
+    def GetSize(self):
+        return self.size
+
+    def OverlayText(self, img, text="", x=0, y=0, color=White, background=Gray40):
+        # fill the background box, roughly the work of drawing the text
+        x, y, h = int(x), int(y), int(self.size)
+        w = int(0.6 * self.size * len(text))
+        img[y:y + h, x:x + w] = background[:3]
+
+
+class SimKeypoint:
+    __slots__ = ("ID", "x", "y")
+
+    def __init__(self, ID, x, y):
+        self.ID = ID
+        self.x = x
+        self.y = y
+
+
+class SimPose:
+    def __init__(self, keypoints):
+        self.Keypoints = keypoints
+
+    def FindKeypoint(self, id_or_name):
+        id = KEYPOINT_NAMES.index(id_or_name) if isinstance(id_or_name, str) else id_or_name
+        for i, keypoint in enumerate(self.Keypoints):
+            if keypoint.ID == id:
+                return i
+        return -1
+
+
+# scripted standing and exercising positions, in a 1280x720 frame
+REST = {"nose": (640, 170), "left_eye": (655, 160), "right_eye": (625, 160),
+        "left_ear": (675, 170), "right_ear": (605, 170), "neck": (640, 230),
+        "left_shoulder": (720, 240), "right_shoulder": (560, 240),
+        "left_elbow": (740, 330), "right_elbow": (540, 330),
+        "left_wrist": (750, 410), "right_wrist": (530, 410),
+        "left_hip": (690, 420), "right_hip": (590, 420),
+        "left_knee": (695, 540), "right_knee": (585, 540),
+        "left_ankle": (700, 660), "right_ankle": (580, 660)}
+
+ACTIVE = dict(REST)
+ACTIVE.update({"left_elbow": (790, 180), "right_elbow": (490, 180),
+               "left_wrist": (820, 100), "right_wrist": (460, 100),
+               "left_knee": (760, 430), "right_knee": (520, 430),
+               "left_ankle": (770, 560), "right_ankle": (510, 560),
+               "left_shoulder": (660, 240), "right_shoulder": (620, 240)})
+
+
+class SimPoseNet:
+    """Stands in for poseNet, moving between the REST and ACTIVE positions on
+    a script, or replaying the poses of a recorded trace"""
+
+    def __init__(self, opts, *args, **kwargs):
+        self.opts = opts
+        self.frames = 0
+        self._random = np.random.RandomState(opts.sim_seed)
+        self._rest = np.array([REST[name] for name in KEYPOINT_NAMES], dtype=np.float32)
+        self._active = np.array([ACTIVE[name] for name in KEYPOINT_NAMES], dtype=np.float32)
+        self._trace = None
+        if opts.sim_trace:
+            from pose_trace import Trace
+            self._trace = Trace(opts.sim_trace)
+
+    def GetNumKeypoints(self):
+        return len(KEYPOINT_NAMES)
+
+    def GetKeypointName(self, index):
+        return KEYPOINT_NAMES[index]
+
+    def FindKeypointID(self, name):
+        return KEYPOINT_NAMES.index(name)
+
+    def Process(self, img, overlay="links,keypoints"):
+        if self.opts.sim_inference_ms > 0:
+            time.sleep(self.opts.sim_inference_ms / 1000.0)
+        self.frames += 1
+        # the frame captured at this time, even if the frames in between were not processed
+        frame = int(round(self.opts.clock() * (self.opts.sim_fps or 30.0)))
+
+        if self._trace is not None:
+            timestamp, poses = self._trace.frame(frame % len(self._trace))
+            return [self._pose(keypoints) for keypoints in poses]
+
+        # the capture time of the frame, as if the camera ran at 30 FPS
+        weight = script_weight(self.opts, frame / (self.opts.sim_fps or 30.0))
+        if self.opts.sim_glitch > 0 and self._random.random_sample() < self.opts.sim_glitch:
+            weight = 0.0
+        keypoints = self._rest + weight * (self._active - self._rest)
+        keypoints = keypoints + self._random.normal(0.0, 2.0, keypoints.shape)
+        keypoints[self._random.random_sample(len(keypoints)) < self.opts.sim_dropout] = np.nan
+        return [self._pose(keypoints)]
+
+    def _pose(self, keypoints):
+        return SimPose([SimKeypoint(id, float(x), float(y)) for id, (x, y) in enumerate(keypoints) if x == x])
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+import timeit
+
+import numpy as np
+
+import main
+import benchmark
+import exercise_engine
+from recipes import DEFAULT_RECIPE, load_recipe
+from pose_trace import Trace, replay
+
+# the utilities import their siblings by name, as when they are run from utils/
+UTILS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils")
+sys.path.insert(0, UTILS_DIR)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+BENCHMARKS = []
+
+
+class Skip(Exception):
+    """Raised by a setup when the benchmark cannot run here, e.g. without an optional package"""
+
+
+def bench(name):
+    """Registers a setup function, which returns the callable to time"""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def _pose(rs, table, at_exercise):
+    """Keypoints that put the limbs at or away from the exercising position"""
+    keypoints = rs.uniform(100, 600, (len(table.keypoint_names), 2)).astype(np.float32)
+    if at_exercise:
+        keypoints[:, 1] = 600 - keypoints[:, 1]
+    return keypoints
+
+
+@bench("limbs.evaluate")
+def bench_evaluate():
+    plan = load_recipe(DEFAULT_RECIPE)
+    keypoints = _pose(np.random.RandomState(0), plan.limb_table, True)
+    return lambda: exercise_engine.evaluate_limbs(plan.limb_table, keypoints)
+
+
+@bench("limbs.evaluate_4_people")
+def bench_evaluate_people():
+    plan = load_recipe(DEFAULT_RECIPE)
+    rs = np.random.RandomState(0)
+    keypoints = np.stack([_pose(rs, plan.limb_table, i % 2 == 0) for i in range(4)])
+    return lambda: exercise_engine.evaluate_limbs(plan.limb_table, keypoints)
+
+
+@bench("limbs.check_exercise")
+def bench_check_exercise():
+    plan = load_recipe(DEFAULT_RECIPE)
+    visible, at_exercise = exercise_engine.evaluate_limbs(plan.limb_table, _pose(np.random.RandomState(0), plan.limb_table, True))
+    parts = plan.exercise_parts[0]
+    return lambda: exercise_engine.check_exercise(parts, visible, at_exercise)
+
+
+@bench("tracker.update")
+def bench_tracker_update():
+    plan = load_recipe(DEFAULT_RECIPE)
+    tracker = exercise_engine.ExerciseTracker(plan)
+    keypoints = _pose(np.random.RandomState(0), plan.limb_table, True)
+    now = [0.0]
+
+    def update():
+        now[0] += 1 / 30.0
+        tracker.update(keypoints, 1, now[0])
+    return update
+
+
+def _record_session(frames, extra=()):
+    """Records a sim session into a temporary trace directory"""
+    path = tempfile.mkdtemp(prefix="bench-trace-")
+    args, backend = main.parse_args(["--backend", "sim", "--sim-frames", str(frames), "--serial",
+                                     "--record", path] + list(extra))
+    main.ExerciseApp(args, backend).run()
+    return path
+
+
+@bench("session.replay_3000_frames")
+def bench_replay():
+    path = _record_session(3000)
+    trace = Trace(path, mmap_mode=None)
+    shutil.rmtree(path)
+    plan = load_recipe(DEFAULT_RECIPE, trace.keypoint_names)
+    return lambda: replay(trace, exercise_engine.ExerciseTracker(plan))
+
+
+@bench("session.replay_3000_frames_debounced")
+def bench_replay_debounced():
+    path = _record_session(3000)
+    trace = Trace(path, mmap_mode=None)
+    shutil.rmtree(path)
+    plan = load_recipe(DEFAULT_RECIPE, trace.keypoint_names)
+    return lambda: replay(trace, exercise_engine.ExerciseTracker(plan, debounce=0.3))
+
+
+@bench("loop.sim_300_frames")
+def bench_frame_loop():
+    return lambda: benchmark.run_frames(["--serial"], 300)
+
+
+def _face_match(identities, photos=3, faces=2):
+    from face_match import FaceMatcher
+    rs = np.random.RandomState(0)
+    encodings = rs.normal(0, 0.1, (identities * photos, 128)).astype(np.float32)
+    names = [f"person{i // photos}" for i in range(len(encodings))]
+    matcher = FaceMatcher(encodings, names)
+    queries = encodings[:faces] + rs.normal(0, 0.02, (faces, 128)).astype(np.float32)
+    return lambda: matcher.match(queries, 3)
+
+
+for identities in (10, 100, 1000):
+    bench(f"face_match.{identities}_identities")(lambda identities=identities: _face_match(identities))
+
+
+@bench("snapshot.convert_cv_qt")
+def bench_convert_cv_qt():
+    try:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        from PyQt5.QtWidgets import QApplication
+        from face_snapshot import Ui_Main_window
+    except ImportError as e:
+        raise Skip(f"needs PyQt5 and OpenCV ({e})")
+    bench_convert_cv_qt.app = QApplication.instance() or QApplication(["bench_suite"])
+    rgb = np.random.RandomState(0).randint(0, 256, (720, 1280, 3), dtype=np.uint8)
+    # the method does not use the window
+    return lambda: Ui_Main_window.convert_cv_qt(None, rgb)
+
+
+def measure(fn, repeat=5):
+    """The fastest of repeat runs of about 0.2 seconds, in seconds per call"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def _format(seconds):
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.0f} ns"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the micro and macro benchmarks on the CPU and compare them with a baseline.")
+    parser.add_argument("-k", type=str, default="", help="only the benchmarks whose name matches this regular expression")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE, help="JSON file of the baseline timings")
+    parser.add_argument("--save", action="store_true", help="store the timings as the baseline")
+    parser.add_argument("--threshold", type=float, default=25.0, help="percent slower than the baseline that fails the run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark, the fastest counts")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    args = parser.parse_args()
+
+    selected = [(name, setup) for name, setup in BENCHMARKS if re.search(args.k, name)]
+    if args.list:
+        print("\n".join(name for name, _ in selected))
+        sys.exit(0)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["timings"]
+
+    timings = {}
+    regressions = []
+    print(f"{'benchmark':<40}{'time':>12}{'baseline':>12}{'change':>9}")
+    for name, setup in selected:
+        try:
+            seconds = measure(setup(), args.repeat)
+        except Skip as e:
+            print(f"{name:<40}  skipped: {e}")
+            continue
+        timings[name] = seconds
+        line = f"{name:<40}{_format(seconds):>12}"
+        if name in baseline:
+            change = 100.0 * (seconds / baseline[name] - 1.0)
+            line += f"{_format(baseline[name]):>12}{change:>+8.1f}%"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSED"
+        print(line)
+
+    if args.save:
+        # benchmarks that did not run keep their previous baseline
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": f"{platform.machine()}, {os.cpu_count()} CPUs",
+                       "python": platform.python_version(), "numpy": np.__version__,
+                       "timings": dict(baseline, **timings)}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"saved the baseline to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} benchmarks regressed by more than {args.threshold:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
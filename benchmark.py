@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+import main
+
+
+STAGES = ["capture", "inference", "update", "render"]
+
+
+class StageTimer:
+    """Records the latency of every call of every stage into preallocated arrays"""
+
+    def __init__(self, frames):
+        self.latency = {name: np.zeros(frames + 16, dtype=np.float64) for name in STAGES}
+        self.calls = dict.fromkeys(STAGES, 0)
+
+    def wrap(self, name, fn):
+        latency = self.latency[name]
+
+        def stage(*args):
+            start = timer()
+            result = fn(*args)
+            calls = self.calls[name]
+            if calls < len(latency):
+                latency[calls] = timer() - start
+            self.calls[name] = calls + 1
+            return result
+        return stage
+
+    def percentiles(self, name):
+        samples = self.latency[name][:min(self.calls[name], len(self.latency[name]))]
+        if len(samples) == 0:
+            return 0.0, 0.0, 0.0
+        return tuple(1000.0 * np.percentile(samples, [50, 95, 99]))
+
+
+def run_frames(argv, frames, wrap=None):
+    args, backend = main.parse_args(argv + ["--backend", "sim", "--sim-frames", str(frames)])
+    app = main.ExerciseApp(args, backend)
+    app.build_pipeline(wrap)
+    start = timer()
+    app.run()
+    return app, timer() - start
+
+
+def measure_allocations(argv, frames):
+    """Runs the frame loop under tracemalloc, returns the peak bytes allocated
+    within a frame and the bytes still held after it, averaged over the frames"""
+    peaks = []
+    held = []
+
+    def wrap(name, fn):
+        if name == "capture":
+            def capture():
+                tracemalloc.clear_traces()
+                return fn()
+            return capture
+        if name == "render":
+            def render(img):
+                result = fn(img)
+                current, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak)
+                held.append(current)
+                return result
+            return render
+        return fn
+
+    tracemalloc.start()
+    try:
+        run_frames(argv + ["--serial"], frames, wrap)
+    finally:
+        tracemalloc.stop()
+    return np.mean(peaks[1:]), np.mean(held[1:])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the full frame loop of main.py on the sim backend.",
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     epilog="Any other options, such as --sim-inference-ms or --queue-depth, are passed to main.py.")
+    parser.add_argument("--frames", type=int, default=1000, help="frames to run")
+    parser.add_argument("--alloc-frames", type=int, default=200, help="frames to run under tracemalloc, 0 to skip")
+    parser.add_argument("--pipelined", action="store_true", help="run the stages in their own threads")
+    parser.add_argument("--drop", action="store_true", help="let the pipelined stages drop frames, which only makes\n"
+                                                            "sense with the camera limited by --sim-fps")
+    args, argv = parser.parse_known_args()
+
+    if not args.pipelined:
+        argv = argv + ["--serial"]
+    elif not args.drop:
+        argv = argv + ["--block"]
+
+    timing = StageTimer(args.frames)
+    app, elapsed = run_frames(argv, args.frames, timing.wrap)
+    rendered = timing.calls["render"]
+
+    print(f"{rendered} frames in {elapsed:.2f} s, {rendered / elapsed:.1f} FPS "
+          f"({'pipelined' if args.pipelined else 'serial'}), "
+          f"{app.tracker.count_of_body_part_movement} exercises counted")
+    print(f"{'stage':<10}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in STAGES:
+        p50, p95, p99 = timing.percentiles(name)
+        print(f"{name:<10}{timing.calls[name]:>8}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+    print(f"servo: {app.servo.updates} updates, {app.kit.writes} writes")
+
+    if args.alloc_frames > 0:
+        peak, held = measure_allocations(argv, args.alloc_frames)
+        print(f"allocations: {peak / 1024:.1f} KiB peak per frame, {held / 1024:.1f} KiB held after each frame")
+    sys.exit(0)
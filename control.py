@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from metrics import ThreadingHTTPServer
+
+
+class ControlServer:
+    """Session control of the resident tracker over HTTP on the loopback interface:
+
+        POST /session/start?user=NAME&recipe=NAME   start exercising, the recipe defaults to the current one
+        POST /session/stop                          end the session and go idle
+        GET  /status                                the session, exercise and count as JSON
+        GET  /history?user=NAME&days=7              sessions and exercises per user and day, with --history
+    """
+
+    def __init__(self, app, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    if url.path == "/status":
+                        self._reply(200, app.status())
+                    elif url.path == "/history":
+                        self._reply(200, app.history_report(params.get("user"), int(params.get("days", 7))))
+                    else:
+                        self._reply(404, {"error": "not found"})
+                except sqlite3.Error as e:
+                    # a locked or damaged history database
+                    self._reply(500, {"error": str(e)})
+                except (OSError, ValueError) as e:
+                    self._reply(400, {"error": str(e)})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    if url.path == "/session/start":
+                        self._reply(200, app.start_session(params.get("user", ""), params.get("recipe")))
+                    elif url.path == "/session/stop":
+                        self._reply(200, app.stop_session())
+                    else:
+                        self._reply(404, {"error": "not found"})
+                except (OSError, ValueError) as e:
+                    self._reply(400, {"error": str(e)})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="control", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import types
+
+import numpy as np
+
+from keypoint_window import KeypointWindow
+
+
+# keypoint order of the resnet18-body model (see human_pose.json)
+KEYPOINT_NAMES = ["nose", "left_eye", "right_eye", "left_ear", "right_ear",
+                  "left_shoulder", "right_shoulder", "left_elbow", "right_elbow",
+                  "left_wrist", "right_wrist", "left_hip", "right_hip",
+                  "left_knee", "right_knee", "left_ankle", "right_ankle", "neck"]
+
+LOCATIONS = ["upper", "lower", "torso"]
+UPPER, LOWER, TORSO = range(len(LOCATIONS))
+
+
+class LimbTable:
+    """The limbs list compiled into keypoint ID arrays, one row per limb"""
+
+    def __init__(self, limbs, keypoint_names=KEYPOINT_NAMES):
+        self.names = [limb["name"] for limb in limbs]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.keypoint_names = list(keypoint_names)
+        kp_id = {name: i for i, name in enumerate(self.keypoint_names)}
+
+        try:
+            self.joints = np.array([[kp_id[limb["joint1"]], kp_id[limb["joint2"]], kp_id[limb["joint3"]]]
+                                    for limb in limbs], dtype=np.intp).reshape(-1, 3)
+            self.track = np.array([kp_id[limb["track"]] for limb in limbs], dtype=np.intp)
+            self.location = np.array([LOCATIONS.index(limb["location"]) for limb in limbs], dtype=np.intp)
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"invalid limb definition: {e}")
+
+        self.is_upper = self.location == UPPER
+        self.is_lower = self.location == LOWER
+        self.is_torso = self.location == TORSO
+
+    def __len__(self):
+        return len(self.names)
+
+    def new_keypoints(self):
+        return new_keypoints(len(self.keypoint_names))
+
+
+def new_keypoints(num_keypoints):
+    """Allocates a (K,2) keypoint buffer to be filled by pack_keypoints()"""
+    return np.full((num_keypoints, 2), np.nan, dtype=np.float32)
+
+
+def compile_exercises(exercises, limb_table):
+    """Resolves the body_parts of each exercise into limb row indices"""
+    parts = []
+    for exercise in exercises:
+        try:
+            parts.append(np.array([limb_table.index[name] for name in exercise["body_parts"]], dtype=np.intp))
+        except KeyError as e:
+            raise ValueError(f"exercise {exercise['name']} uses unknown body part {e}")
+    return parts
+
+
+class PackedPose:
+    """A pose that is already packed into (K,2) keypoints, e.g. predicted between two inferences"""
+
+    def __init__(self, keypoints):
+        self.keypoints = keypoints
+
+    @property
+    def Keypoints(self):
+        return [types.SimpleNamespace(ID=i, x=float(x), y=float(y))
+                for i, (x, y) in enumerate(self.keypoints) if x == x]
+
+
+def pack_keypoints(pose, out):
+    """Packs pose.Keypoints into the (K,2) array out, undetected keypoints are NaN"""
+    if isinstance(pose, PackedPose):
+        np.copyto(out, pose.keypoints)
+        return out
+    out.fill(np.nan)
+    for keypoint in pose.Keypoints:
+        out[keypoint.ID, 0] = keypoint.x
+        out[keypoint.ID, 1] = keypoint.y
+    return out
+
+
+def evaluate_limbs(table, keypoints):
+    """Evaluates every limb at once, returns the (visible, at_exercise) bool arrays.
+    keypoints is (K,2) for one pose or (N,K,2) to evaluate N poses in one go."""
+    j1 = keypoints[..., table.joints[:, 0], :]
+    j2 = keypoints[..., table.joints[:, 1], :]
+    j3 = keypoints[..., table.joints[:, 2], :]
+
+    visible = ~(np.isnan(j1[..., 0]) | np.isnan(j2[..., 0]) | np.isnan(j3[..., 0]))
+
+    # upper: shoulder, elbow, wrist -> the elbow is raised above the shoulder
+    upper = j1[..., 1] > j2[..., 1]
+    # lower: hip, ankle, knee -> the thigh is close to horizontal
+    lower = np.abs(j1[..., 1] - j3[..., 1]) < np.abs(0.8 * (j3[..., 1] - j2[..., 1]))
+    # torso: knee, knee, shoulder -> the shoulder is between the knees
+    torso = ((j1[..., 0] > j3[..., 0]) & (j3[..., 0] > j2[..., 0])) | ((j1[..., 0] < j3[..., 0]) & (j3[..., 0] < j2[..., 0]))
+
+    at_exercise = (table.is_upper & upper) | (table.is_lower & lower) | (table.is_torso & torso)
+    return visible, at_exercise & visible
+
+
+def check_exercise(parts, visible, at_exercise):
+    """Applies the per-exercise body part check to the evaluated limbs.
+
+    Returns (limb, visible, at_exercise) for the first body part that is not
+    visible or not at the exercising position, or the last one if all pass,
+    along with the limbs checked up to it.
+    """
+    ok = visible[parts] & at_exercise[parts]
+    failed = np.flatnonzero(~ok)
+    last = failed[0] if len(failed) else len(parts) - 1
+    limb = parts[last]
+    return limb, bool(visible[limb]), bool(at_exercise[limb]), parts[:last + 1]
+
+
+class Plan:
+    """A routine compiled for the tracker: the limb table, and for every
+    exercise the limb rows to check"""
+
+    def __init__(self, limbs, exercises, keypoint_names=KEYPOINT_NAMES, name=""):
+        self.name = name
+        self.limbs = limbs
+        self.exercises = exercises
+        self.limb_table = LimbTable(limbs, keypoint_names)
+        self.exercise_parts = compile_exercises(exercises, self.limb_table)
+
+
+class ExerciseTracker:
+    """The exercise state machine: holding a position, repeating and moving on.
+
+    update() takes the packed keypoints of the only pose in the frame along
+    with the number of poses and the frame time, so the same code runs live
+    with timer() and on recorded traces with their timestamps.
+
+    When a new plan replaces the one of a previous tracker, the count carries
+    over and so does the current exercise if the new plan still has it.
+
+    With debounce seconds, a limb counts as visible and at the exercising
+    position when it was in most frames of the last debounce seconds, so a
+    single noisy frame neither starts nor breaks a hold.
+    """
+
+    def __init__(self, plan, previous=None, debounce=None, max_fps=60):
+        self.plan = plan
+        self.limb_table = plan.limb_table
+        self.exercises = plan.exercises
+        self.exercise_parts = plan.exercise_parts
+        self.current_exercise_index = 0
+        self.exercise_completed = False
+        self.repeat = -1
+        self.part_at_exercise_previously = False
+        self.count_of_body_part_movement = 0
+        self.time_start = None
+        self.status = None
+        self.tracked = ()     # limbs checked this frame, their track joints are followed
+        self.advanced = False # moved on to the next exercise this frame
+        self.started = False  # reached the exercising position this frame
+        self.completed = False # held the position long enough this frame
+
+        if debounce is None:
+            debounce = previous.debounce if previous is not None else 0.0
+        self.debounce = debounce
+        self.window = None
+        if debounce > 0:
+            self.window = KeypointWindow(len(self.limb_table.keypoint_names), len(self.limb_table),
+                                         capacity=int(np.ceil(debounce * max_fps)) + 1)
+            self._visible = np.zeros(len(self.limb_table), dtype=bool)
+            self._at_exercise = np.zeros(len(self.limb_table), dtype=bool)
+
+        if previous is not None:
+            self.count_of_body_part_movement = previous.count_of_body_part_movement
+            names = [exercise["name"] for exercise in self.exercises]
+            if previous.exercise["name"] in names:
+                self.current_exercise_index = names.index(previous.exercise["name"])
+                self.repeat = min(previous.repeat, self.exercise["repeat"])
+
+    @property
+    def exercise(self)->dict:
+        return self.exercises[self.current_exercise_index]
+
+    def update(self, keypoints, num_poses, now, limbs=None):
+        """limbs can pass the (visible, at_exercise) of the keypoints if they were already evaluated"""
+        exercise = self.exercise
+        if self.repeat < 0:
+            self.repeat = exercise["repeat"]
+
+        self.status = None
+        self.tracked = ()
+        self.advanced = False
+        self.started = False
+        self.completed = False
+
+        if num_poses > 1:
+            # when there are more than one body detected
+            self.status = "Too many people"
+            return
+        if num_poses == 0:
+            if self.window is not None:
+                # a frame without the body is outvoted by the frames around it
+                self.window.append(now)
+                visible, at_exercise = self._debounced(now)
+            if self.window is None or not visible.any():
+                self.status = "Body is not detected."
+                return
+        else:
+            visible, at_exercise = evaluate_limbs(self.limb_table, keypoints) if limbs is None else limbs
+            if self.window is not None:
+                self.window.append(now, keypoints, visible, at_exercise)
+                visible, at_exercise = self._debounced(now)
+
+        limb, body_part_visible, body_part_at_exercise, self.tracked = check_exercise(
+            self.exercise_parts[self.current_exercise_index], visible, at_exercise)
+
+        # Flag the issue when the whole body part is not visible.
+        if not body_part_visible:
+            self.status = f"{self.limb_table.names[limb]} is not visible."
+            return
+
+        if body_part_at_exercise:
+            if not self.part_at_exercise_previously: #if this is the first frame when the body part is at the exercising position
+                self.time_start = now
+                self.part_at_exercise_previously = True
+                self.exercise_completed = False
+                self.started = True
+        else:
+            # when the body is not at the exercising position
+            self.part_at_exercise_previously = False
+            self.status = exercise["description"]
+            if self.exercise_completed:
+                self.repeat = self.repeat - 1
+                if self.repeat == 0:
+                    self.current_exercise_index = (self.current_exercise_index + 1) % len(self.exercises)
+                    self.repeat = -1
+                    self.advanced = True
+                self.exercise_completed = False
+
+        if self.part_at_exercise_previously:
+            elasped_time = now - self.time_start
+            if elasped_time > exercise["duration"]:
+                self.status = exercise["return_caption"]
+                if not self.exercise_completed:
+                    self.count_of_body_part_movement += 1
+                    self.completed = True
+                self.exercise_completed = True
+            else:
+                self.status = f"Holds this position for{self.time_start + exercise['duration'] - now: .0f} seconds."
+
+    def _debounced(self, now):
+        visible, at_exercise = self.window.in_position(self.debounce, now)
+        np.greater(visible, 0.5, out=self._visible)
+        np.greater(at_exercise, 0.5, out=self._at_exercise)
+        return self._visible, self._at_exercise
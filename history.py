@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "history.db")
+
+# the events are appended and never changed, kind is the index into EVENTS
+EVENTS = ["session_started", "session_ended", "rep_started", "rep_completed", "exercise_advanced"]
+SESSION_STARTED, SESSION_ENDED, REP_STARTED, REP_COMPLETED, EXERCISE_ADVANCED = range(len(EVENTS))
+
+# a single index serves the aggregates: equal kind, then user and a range of days,
+# already in the order of the grouping
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    time REAL NOT NULL,
+    day TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    person INTEGER,
+    recipe TEXT,
+    exercise TEXT
+);
+CREATE INDEX IF NOT EXISTS events_by_kind_user_day ON events (kind, user, day, exercise);
+"""
+
+
+def connect(path):
+    """Opens the history database, creating it if needed"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=10.0)
+    # WAL appends the pages of a transaction to the log and syncs it only at
+    # checkpoints, readers never block the writer
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def local_day(timestamp):
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+
+class HistoryWriter:
+    """Appends events to the history database from a background thread.
+
+    record() only queues the event, so the frame loop never waits for the SD
+    card. The thread collects the events of up to interval seconds and
+    writes them in one transaction, a session of reps costs a few page
+    writes instead of a page write and sync for every rep. Events still
+    queued when the process is killed are lost, close() writes them.
+    """
+
+    def __init__(self, path, interval=5.0, batch=512):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.written = 0
+        self.transactions = 0
+        self.failed = 0
+        # open it here so a bad path is reported at startup
+        connect(path).close()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="history", daemon=True)
+        self._thread.start()
+
+    def record(self, timestamp, kind, user, person=None, recipe=None, exercise=None):
+        self._queue.put((timestamp, kind, user or "", person, recipe, exercise))
+
+    def _run(self):
+        db = connect(self.path)
+        stop = False
+        while not stop:
+            event = self._queue.get()
+            if event is None:
+                break
+            events = [event]
+            deadline = time.monotonic() + self.interval
+            while len(events) < self.batch:
+                try:
+                    event = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                events.append(event)
+            self._write(db, events)
+        db.close()
+
+    def _write(self, db, events):
+        rows = [(timestamp, local_day(timestamp), kind, user, person, recipe, exercise)
+                for timestamp, kind, user, person, recipe, exercise in events]
+        try:
+            with db:
+                db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.written += len(rows)
+            self.transactions += 1
+        except sqlite3.Error as e:
+            print(f"history: cannot write {len(rows)} events to {self.path}: {e}", file=sys.stderr)
+            self.failed += len(rows)
+
+    def close(self):
+        """Writes the queued events and stops the thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+
+class History:
+    """Aggregate queries over the history database"""
+
+    def __init__(self, path):
+        self.db = connect(path)
+
+    def _where(self, kinds, user, since):
+        sql = f"kind IN ({', '.join('?' * len(kinds))})"
+        params = list(kinds)
+        if user is not None:
+            sql += " AND user = ?"
+            params.append(user)
+        if since is not None:
+            sql += " AND day >= ?"
+            params.append(since)
+        return sql, params
+
+    def users(self, user=None, since=None):
+        """Returns (user, sessions, reps, days active, last day) rows"""
+        where, params = self._where((SESSION_STARTED, REP_COMPLETED), user, since)
+        return self.db.execute(f"SELECT user, SUM(kind = {SESSION_STARTED}), SUM(kind = {REP_COMPLETED}), "
+                               f"COUNT(DISTINCT day), MAX(day) FROM events WHERE {where} "
+                               f"GROUP BY user ORDER BY user", params).fetchall()
+
+    def daily(self, user=None, since=None):
+        """Returns (user, day, exercise, reps) rows of the completed reps"""
+        where, params = self._where((REP_COMPLETED,), user, since)
+        return self.db.execute(f"SELECT user, day, exercise, COUNT(*) FROM events WHERE {where} "
+                               f"GROUP BY user, day, exercise ORDER BY user, day, exercise", params).fetchall()
+
+    def report(self, user=None, days=7):
+        """The summary and daily reps of the last days as a dict, e.g. for JSON"""
+        since = local_day(time.time() - (days - 1) * 86400) if days else None
+        return {"since": since,
+                "users": [{"user": u, "sessions": sessions, "reps": reps, "days": active, "last": last}
+                          for u, sessions, reps, active, last in self.users(user, since)],
+                "daily": [{"user": u, "day": day, "exercise": exercise, "reps": reps}
+                          for u, day, exercise, reps in self.daily(user, since)]}
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the exercise history recorded with main.py --history.")
+    parser.add_argument("--db", type=str, default=DEFAULT_HISTORY, help="history database")
+    parser.add_argument("--user", type=str, default=None, help="only this user")
+    parser.add_argument("--days", type=int, default=7, help="the last days to show, 0 for all")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        sys.exit(f"no history at {args.db}")
+    history = History(args.db)
+    report = history.report(args.user, args.days)
+    history.close()
+
+    print(f"since {report['since']}" if report["since"] else "all time")
+    for row in report["users"]:
+        print(f"{row['user'] or 'unknown user'}: {row['sessions']} sessions, {row['reps']} exercises "
+              f"on {row['days']} days, last on {row['last']}")
+    for row in report["daily"]:
+        print(f"  {row['user'] or 'unknown user':16} {row['day']}  {row['exercise']:24} {row['reps']:5}")
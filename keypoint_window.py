@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import argparse
+import warnings
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+
+class KeypointWindow:
+    """The keypoints and limb checks of the last capacity frames in
+    preallocated arrays, with queries over the frames of the last seconds.
+
+    Every frame is written twice, at row i and i + capacity, so the last
+    frames are always one contiguous slice that the queries read as a view.
+    append() and in_position(), which run on every frame, allocate nothing;
+    median(), angles() and velocity() return new arrays and build small
+    temporaries. Missing keypoints are NaN, poseNet gives no confidences so
+    their presence is what the queries count.
+    """
+
+    def __init__(self, num_keypoints, num_limbs=0, capacity=64):
+        self.capacity = capacity
+        self.count = 0
+        self.times = np.zeros(2 * capacity, dtype=np.float64)
+        self.keypoints = np.full((2 * capacity, num_keypoints, 2), np.nan, dtype=np.float32)
+        self.visible = np.zeros((2 * capacity, num_limbs), dtype=bool)
+        self.at_exercise = np.zeros((2 * capacity, num_limbs), dtype=bool)
+        self._next = 0
+        self._limb_counts = np.zeros((2, num_limbs), dtype=np.intp)
+        self._limb_share = np.zeros((2, num_limbs), dtype=np.float32)
+
+    def append(self, now, keypoints=None, visible=None, at_exercise=None):
+        """Adds a frame, keypoints None when no body was detected"""
+        for row in (self._next, self._next + self.capacity):
+            self.times[row] = now
+            if keypoints is None:
+                self.keypoints[row] = np.nan
+            else:
+                self.keypoints[row] = keypoints
+            if visible is None:
+                self.visible[row] = False
+                self.at_exercise[row] = False
+            else:
+                self.visible[row] = visible
+                self.at_exercise[row] = at_exercise
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def rows(self, seconds, now):
+        """Returns the slice of the rows of the frames of the last seconds, oldest first"""
+        end = self._next + self.capacity
+        start = end - self.count
+        return slice(start + int(np.searchsorted(self.times[start:end], now - seconds)), end)
+
+    def window(self, seconds, now):
+        """Returns views of the (n,) times and (n,K,2) keypoints of the last seconds"""
+        rows = self.rows(seconds, now)
+        return self.times[rows], self.keypoints[rows]
+
+    def median(self, seconds, now, out=None):
+        """The (K,2) median position of every keypoint, NaN if it was never seen"""
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmedian(self.window(seconds, now)[1], axis=0, out=out)
+
+    def angles(self, joints, seconds, now):
+        """The (n,J) angles in degrees at the middle keypoint of every (J,3) keypoint triple"""
+        keypoints = self.window(seconds, now)[1]
+        a = keypoints[:, joints[:, 0]] - keypoints[:, joints[:, 1]]
+        b = keypoints[:, joints[:, 2]] - keypoints[:, joints[:, 1]]
+        cross = a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+        dot = a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1]
+        return np.degrees(np.abs(np.arctan2(cross, dot)))
+
+    def velocity(self, seconds, now):
+        """The (K,2) least squares velocity of every keypoint in pixels per second, NaN if seen less than twice"""
+        times, keypoints = self.window(seconds, now)
+        seen = ~np.isnan(keypoints[..., :1])                 # (n,K,1)
+        n = seen.sum(axis=0)
+        t = np.where(seen, (times - times[-1] if len(times) else times)[:, None, None], 0.0)
+        x = np.where(seen, keypoints, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t_mean = t.sum(axis=0) / n
+            x_mean = x.sum(axis=0) / n
+            dt = np.where(seen, t - t_mean, 0.0)
+            slope = (dt * (x - x_mean)).sum(axis=0) / (dt * dt).sum(axis=0)
+        return np.where(n >= 2, slope, np.nan).astype(np.float32)
+
+    def in_position(self, seconds, now):
+        """The (L,) shares of the frames of the last seconds in which each limb
+        was visible and at the exercising position, as views that the next
+        call overwrites"""
+        rows = self.rows(seconds, now)
+        np.sum(self.visible[rows], axis=0, out=self._limb_counts[0])
+        np.sum(self.at_exercise[rows], axis=0, out=self._limb_counts[1])
+        np.divide(self._limb_counts, max(rows.stop - rows.start, 1), out=self._limb_share)
+        return self._limb_share[0], self._limb_share[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time appending to and querying a keypoint window.")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=0.5, help="length of the queried window")
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(0)
+    keypoints = rs.uniform(0, 720, (18, 2)).astype(np.float32)
+    limbs = rs.uniform(size=(2, 8)) > 0.5
+    window = KeypointWindow(18, 8)
+    joints = np.array([[5, 7, 9], [6, 8, 10], [11, 13, 15], [12, 14, 16]])
+
+    timings = {}
+    for name, query in [("append", lambda now: window.append(now, keypoints, *limbs)),
+                        ("in_position", lambda now: window.in_position(args.seconds, now)),
+                        ("median", lambda now: window.median(args.seconds, now)),
+                        ("angles", lambda now: window.angles(joints, args.seconds, now)),
+                        ("velocity", lambda now: window.velocity(args.seconds, now))]:
+        start = timer()
+        for i in range(args.frames):
+            query(i / 30.0)
+        timings[name] = (timer() - start) / args.frames
+    for name, seconds in timings.items():
+        print(f"{name:12} {seconds * 1e6:8.1f} us")
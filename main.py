@@ -1,293 +1,553 @@
 #!/usr/bin/env python3
 
 import sys
-import argparse
 import time
+import signal
+import argparse
+import threading
 
-from jetson_inference import poseNet
-from jetson_utils import videoSource, videoOutput, Log, cudaFont
 from timeit import default_timer as timer
-from adafruit_servokit import ServoKit
-
-
-kit = ServoKit(channels=16)
-
-def check_body_part_visible(pose, joint1_idx, joint2_idx, joint3_idx, track_idx)->bool:
-    joint_tracking(pose, track_idx)
-    if joint1_idx < 0 or joint2_idx < 0 or joint3_idx < 0: 
-        return False
-    return True
-
-def check_body_part_at_exercise(pose, joint1_idx, joint2_idx, joint3_idx, location)->bool:
-    if joint1_idx < 0 or joint2_idx < 0 or joint3_idx < 0:
-        return False
-    
-    if location == "upper":
-        shoulder = pose.Keypoints[joint1_idx]
-        elbow = pose.Keypoints[joint2_idx]
-        wrist = pose.Keypoints[joint3_idx]
-        return True if shoulder.y > elbow.y else False
-    elif location == "lower":
-        hip = pose.Keypoints[joint1_idx]
-        ankle = pose.Keypoints[joint2_idx]
-        knee = pose.Keypoints[joint3_idx]
-        return True if (abs(hip.y-knee.y) < abs(0.8*(knee.y-ankle.y))) else False
-    elif location == "torso":
-        knee1 = pose.Keypoints[joint1_idx]
-        knee2 = pose.Keypoints[joint2_idx]
-        shoulder = pose.Keypoints[joint3_idx]
-        return True if (knee1.x > shoulder.x and shoulder.x > knee2.x) or (knee1.x < shoulder.x and shoulder.x < knee2.x) else False
-
-
-
-def joint_tracking(pose, joint_idx):
-    if joint_idx < 0:
-        return False
-    joint = pose.Keypoints[joint_idx]
-    print(kit.servo[0].angle, joint.x, joint.y)
-    if joint.x > 680:
-        kit.servo[0].angle = min(max(0.0, kit.servo[0].angle - 3.0), 180.0)
-    elif joint.x < 600 :
-        kit.servo[0].angle = min(max(0.0, kit.servo[0].angle + 3.0), 180.0)
-    
-    if joint.y > 390:
-        kit.servo[1].angle = min(max(0.0, kit.servo[1].angle + 3.0), 180.0)
-    elif joint.y < 330:
-        kit.servo[1].angle = min(max(0.0, kit.servo[1].angle - 3.0), 180.0)
-
-
-# load the pose estimation model
-model = poseNet("resnet18-body", 0, 0.15)
-
-# create video sources & outputs
-input = videoSource()
-output = videoOutput()
-output.SetStatus("Exercise Tracker")
-
-font = cudaFont()
-part_at_exercise_previously:bool = False
-count_of_body_part_movement = 0
-
-limbs = [{"name": "Left Arm", 
-          "joint1": "left_shoulder", 
-          "joint2": "left_elbow", 
-          "joint3": "left_wrist",
-          "location": "upper",
-          "track": "left_shoulder"
-          }, 
-        {"name": "Right Arm", 
-          "joint1": "right_shoulder", 
-          "joint2": "right_elbow", 
-          "joint3": "right_wrist",
-          "location": "upper",
-          "track": "right_shoulder"
-          },
-        {"name": "Left Leg", 
-          "joint1": "left_hip", 
-          "joint2": "left_ankle", 
-          "joint3": "left_knee",
-          "location": "lower",
-          "track": "left_hip"
-          },
-        {"name": "Right Leg", 
-          "joint1": "right_hip", 
-          "joint2": "right_ankle", 
-          "joint3": "right_knee",
-          "location": "lower",
-          "track": "right_hip"
-          },
-        {"name": "Right Torso", 
-          "joint1": "right_knee", 
-          "joint2": "left_knee", 
-          "joint3": "right_shoulder",
-          "location": "torso",
-          "track": "left_hip"
-          },
-        {"name": "Left Torso", 
-          "joint1": "right_knee", 
-          "joint2": "left_knee", 
-          "joint3": "left_shoulder",
-          "location": "torso",
-          "track": "right_hip"
-          }]
-          
-
-exercises = [{"name": "Lift Left Arm", 
-          "body_parts": ["Left Arm"], 
-          "duration": 5,
-          "repeat":2,
-          "return_caption": "Lower Left Arm",
-          "description": "Raise Left Arm" }, 
-          {"name": "Lift Right Arm", 
-          "body_parts": ["Right Arm"], 
-          "duration": 5,
-          "repeat":2,
-          "return_caption": "Lower Right Arm",
-          "description": "Raise Right Arm"  },
-          {"name": "Lift Both Arms", 
-          "body_parts": ["Left Arm", "Right Arm"],
-          "duration": 3,
-          "repeat": 3 ,
-          "return_caption": "Lower Both Arm",
-          "description": "Raise Both Arms"},
-          {"name": "Lift Left Leg", 
-          "body_parts": ["Left Leg"],
-          "duration": 3,
-          "repeat": 2,
-          "return_caption": "Lower Left Leg",
-          "description": "Lift Left Leg"},
-          {"name": "Lift Right Leg", 
-          "body_parts": ["Right Leg"],
-          "duration": 3,
-          "repeat": 2,
-          "return_caption": "Lower Right Leg",
-          "description": "Lift Right Leg"},
-          {"name": "Rotate Right Torso", 
-          "body_parts": ["Right Torso"],
-          "duration": 3,
-          "repeat": 2,
-          "return_caption": "Return Torso to the front",
-          "description": "Rotate Right Torso"},
-          {"name": "Rotate Left Torso", 
-          "body_parts": ["Left Torso"],
-          "duration": 3,
-          "repeat": 2,
-          "return_caption": "Rotate Torso to the front",
-          "description": "Rotate Left Torso"}]
-
-
-current_exercise_index = 0
-exercise_completed = False
-repeat = -1
-kit.servo[0].angle = 90
-kit.servo[1].angle = 90
-
-# loop to process each frame 
-while True:
-    # capture the next image
-    img = input.Capture()
-
-    if img is None: # timeout
-        continue  
-
-    # procss the new frame
-    poses = model.Process(img)
-    
-    # get the current exercise
-    exercise:dict = exercises[current_exercise_index]
-
-    if repeat < 0:
-        repeat = exercise["repeat"]
-    # get the body parts involved
-    body_parts = exercise["body_parts"]
-
-    body_part_visible = False
-    body_part_at_exercise = False
-
-
-
-    if len(poses) == 0:
-        font.OverlayText(img, text=f"Body is not detected.",
-                    x=0, y=50 + (font.GetSize()),
-                    color=font.White, background=font.Gray40)
-        
-    font.OverlayText(img, text=f"Current exercise: {exercise['name']} ",
-                    x=0, y=0 + (font.GetSize()),
-                    color=font.White, background=font.Gray40)
-    if len(poses) > 1:
-        # when there are more than one body detected
-        font.OverlayText(img, text=f"Too many people",
-                    x=0, y=50 + (font.GetSize()),
-                    color=font.White, background=font.Gray40)
-    elif len(poses) == 1:  
-        pose = poses[0] # get the only body
-
-        # find all the detected key points
-        left_wrist_idx = pose.FindKeypoint('left_wrist')
-        left_shoulder_idx = pose.FindKeypoint('left_shoulder')
-        left_eye_idx = pose.FindKeypoint('left_eye')
-        right_ankle_idx = pose.FindKeypoint('right_ankle')
-        left_ankle_idx = pose.FindKeypoint('left_ankle')
-        left_ear_idx = pose.FindKeypoint('left_ear')
-        left_hip_idx = pose.FindKeypoint('left_hip')
-        left_knee_idx = pose.FindKeypoint('left_knee')
-        left_elbow_idx = pose.FindKeypoint('left_elbow')
-        right_ear_idx = pose.FindKeypoint('right_ear')
-        right_shoulder_idx = pose.FindKeypoint('right_shoulder')
-        right_elbow_idx = pose.FindKeypoint('right_elbow')
-        right_hip_idx = pose.FindKeypoint('right_hip')
-        right_knee_idx = pose.FindKeypoint('right_knee')
-        right_wrist_idx = pose.FindKeypoint('right_wrist')
-        right_eye_idx = pose.FindKeypoint('right_eye')
-        nose_idx = pose.FindKeypoint('nose')
-
-
-
-        # check all the body parts each consist of some keypoints
-        for body_part in body_parts:  #body_part is a str
-            matches = [x for x in limbs if x["name"] == body_part]
-            part = matches[0]
-            body_part_visible = check_body_part_visible(pose, joint1_idx=pose.FindKeypoint(part["joint1"]),
-                                        joint2_idx=pose.FindKeypoint(part["joint2"]),  
-                                        joint3_idx=pose.FindKeypoint(part["joint3"]), 
-                                        track_idx=pose.FindKeypoint(part["track"]))
-        
-            body_part_at_exercise = check_body_part_at_exercise(pose, joint1_idx=pose.FindKeypoint(part["joint1"]),
-                                        joint2_idx=pose.FindKeypoint(part["joint2"]),  
-                                        joint3_idx=pose.FindKeypoint(part["joint3"]), location=part["location"])
-            if not body_part_visible or not body_part_at_exercise:
-                break
-
-        # Flag the issue when the whole body part is not visible.
-        if not body_part_visible:
-            font.OverlayText(img, text=f"{part['name']} is not visible.",
-                                x=5, y=50 + (font.GetSize()),
-                                color=font.White, background=font.Gray40)
-            
-        else:          
-
-            if body_part_at_exercise:
-                if not part_at_exercise_previously: #if this is the first frame when the body part is at the exercising position
-                    time_start = timer() 
-                    part_at_exercise_previously = True
-                    exercise_completed = False                
-            else:
-                # when the body is not at the exercising position
-                part_at_exercise_previously = False
-                font.OverlayText(img, text=f"{exercise['description']}",
-                    x=5, y=50 + (font.GetSize()),
-                    color=font.White, background=font.Gray40)    
-                if exercise_completed:
-                    repeat = repeat - 1 
-                    if repeat == 0:
-                        current_exercise_index = (current_exercise_index + 1) % len(exercises)
-                        kit.servo[1].angle = 90
-                    exercise_completed = False
-
-            if part_at_exercise_previously:
-                elasped_time = timer() - time_start
-                if elasped_time > exercise['duration']:
-                    font.OverlayText(img, text=f"{exercise['return_caption']}",
-                                    x=0, y=50 + (font.GetSize()),
-                                    color=font.White, background=font.Gray40) 
-                    if not exercise_completed:
-                        count_of_body_part_movement += 1       
-        
-                    exercise_completed = True
-
-                else:
-                    font.OverlayText(img, text=f"Holds this position for{time_start + exercise['duration'] - timer(): .0f} seconds.",
-                        x=0, y=50 + (font.GetSize()),
-                        color=font.White, background=font.Gray40)
-                        
-    font.OverlayText(img, text=f"Total # exercises: {count_of_body_part_movement}",
-            x=0, y=100 + (font.GetSize()),
-            color=font.White, background=font.Gray40)
-    
-
-    # draw the visual
-    output.Render(img)
-
-
-    if not input.IsStreaming() or not output.IsStreaming():
-        break
+
+import backends
+import exercise_engine
+from pipeline import Pipeline, frames_in_flight
+from servo import ServoController
+from pose_trace import TraceRecorder
+from metrics import Metrics, MetricsServer
+from recipes import DEFAULT_RECIPE, RecipeWatcher, find_recipe, load_recipe
+from control import ControlServer
+from overlay import TextOverlay
+from people import PersonTracker
+from scheduler import InferenceScheduler, MotionGate
+from stream import StreamServer
+from telemetry import TelemetryServer, countdown
+from history import History, HistoryWriter, SESSION_STARTED, SESSION_ENDED, REP_STARTED, REP_COMPLETED, EXERCISE_ADVANCED
+from utils.framebus import FrameBusSource
+from utils.profiler import SpanProfiler
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    # the backend decides which other options are understood
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument("--backend", type=str, default="jetson", choices=["jetson", "sim"])
+    backend = backends.load(pre_parser.parse_known_args(argv)[0].backend, argv)
+
+    parser = argparse.ArgumentParser(description="Guide and count exercises with poseNet.",
+                                     formatter_class=argparse.RawTextHelpFormatter,
+                                     epilog=backend.usage)
+    parser.add_argument("--backend", type=str, default="jetson", choices=["jetson", "sim"],
+                        help="jetson for the camera, GPU and servos, sim for synthetic stand-ins")
+    parser.set_defaults(input="")
+    if backend.name == "jetson":
+        # the options of the sim backend are unknown here and would take their values for the URI
+        parser.add_argument("input", type=str, default="", nargs="?", help="URI of the input stream, e.g. csi://0 or /dev/video0")
+    parser.add_argument("--frame-bus", type=str, default="", help="take the frames from this shared-memory frame bus instead of opening\n"
+                                                                   "the camera, see utils/framebus.py")
+    parser.add_argument("--recipe", type=str, default=DEFAULT_RECIPE, help="JSON or YAML file with the exercise routine")
+    parser.add_argument("--reload-interval", type=float, default=1.0, help="seconds between checks for changes of the recipe, 0 to disable")
+    parser.add_argument("--people", type=int, default=1, help="people who can exercise together, each with their own progress")
+    parser.add_argument("--debounce", type=float, default=0.0, help="seconds of frames that decide whether a limb is in position, so a\n"
+                                                                    "noisy frame does not break a hold, 0 to decide on every frame")
+    parser.add_argument("--adaptive-inference", action="store_true", help="run poseNet less often while the body holds still and\n"
+                                                                          "predict the keypoints of the frames in between")
+    parser.add_argument("--inference-hz", type=float, nargs=2, default=[5.0, 30.0], metavar=("MIN", "MAX"),
+                        help="range of the adaptive inference rate")
+    parser.add_argument("--motion-gate", action="store_true", help="reuse the last poses while the frames do not change")
+    parser.add_argument("--motion-threshold", type=float, default=0.005, help="share of the sampled pixels that must change to run poseNet")
+    parser.add_argument("--motion-max-age", type=float, default=2.0, help="seconds the poses are reused at most")
+    parser.add_argument("--daemon", action="store_true", help="stay resident and idle until a session is started on the control port")
+    parser.add_argument("--control-port", type=int, default=8765, help="loopback port of the session control in --daemon mode")
+    parser.add_argument("--idle-fps", type=float, default=1.0, help="inference rate while no session runs, keeping the engine warm")
+    parser.add_argument("--queue-depth", type=int, default=1, help="frames queued between the pipeline stages, the capture ring\n"
+                                                                       "gets a buffer for every frame in flight")
+    parser.add_argument("--block", action="store_true", help="wait for a slow stage instead of dropping the oldest frame")
+    parser.add_argument("--serial", action="store_true", help="run capture, inference, logic and render in one thread")
+    parser.add_argument("--no-overlay-cache", action="store_true", help="draw the status text with cudaFont every frame")
+    parser.add_argument("--record", type=str, default="", help="record the keypoints of every frame into this trace directory")
+    parser.add_argument("--history", type=str, default="", help="append the sessions and exercises to this SQLite database,\n"
+                                                                 "e.g. data/history.db, see history.py")
+    parser.add_argument("--stream-port", type=int, default=0, help="stream the annotated frames as MJPEG on this port, 0 to disable")
+    parser.add_argument("--stream-host", type=str, default="127.0.0.1", help="0.0.0.0 to let caretakers on other machines watch")
+    parser.add_argument("--stream-fps", type=float, default=15.0, help="frames streamed per second at most")
+    parser.add_argument("--stream-quality", type=int, default=80, help="JPEG quality of the stream")
+    parser.add_argument("--telemetry-port", type=int, default=0, help="send the keypoints and exercise status to viewers of telemetry.py\n"
+                                                                      "on this UDP port, a few hundred bytes a second, 0 to disable")
+    parser.add_argument("--telemetry-host", type=str, default="127.0.0.1", help="0.0.0.0 to let viewers on other machines subscribe")
+    parser.add_argument("--telemetry-hz", type=float, default=5.0, help="telemetry packets per second at most")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus metrics on this loopback port, 0 to disable")
+    parser.add_argument("--stats", action="store_true", help="print the per-stage frame rates, queue depths and drops on exit")
+    parser.add_argument("--profile", type=int, default=0, help="record the spans of the first N frames as a Chrome trace, 0 for none,\n"
+                                                               "kill -USR1 records the next N frames (300 by default) of a running tracker")
+    parser.add_argument("--profile-dir", type=str, default="profiles", help="directory of the traces, open them in ui.perfetto.dev")
+    parser.add_argument("--cprofile", action="store_true", help="also profile the stages with cProfile while recording a trace")
+
+    return parser.parse_known_args(argv)[0], backend
+
+
+class ExerciseApp:
+    """Opens the model, camera, display and servos of a backend and runs the
+    exercise tracker over the frames as capture/inference/update/render stages.
+
+    With --daemon everything stays open between sessions, which are started
+    and stopped on the control port while poseNet idles at a low rate.
+    """
+
+    def __init__(self, args, backend):
+        self.args = args
+        self.clock = backend.clock
+
+        # the servos are driven from their own thread, the frame loop only posts positions
+        self.kit = backend.ServoKit(channels=16)
+        self.servo = ServoController(self.kit)
+        self.servo.start()
+
+        # load the pose estimation model
+        self.model = backend.poseNet("resnet18-body", 0, 0.15)
+
+        # create video sources & outputs, with enough images for every frame the stages
+        # and their queues can hold so the camera never writes into a frame still in use
+        self.capture_buffers = max(4, frames_in_flight(3, args.queue_depth, not args.serial))
+        if args.frame_bus:
+            self.input = FrameBusSource(args.frame_bus, backend.allocate_image, buffers=self.capture_buffers)
+        else:
+            self.input = backend.videoSource(args.input, buffers=self.capture_buffers)
+        self.output = backend.videoOutput()
+        self.output.SetStatus("Exercise Tracker")
+
+        self.font = backend.cudaFont()
+        self.text = TextOverlay(self.font, None if args.no_overlay_cache else backend.TextRenderer())
+
+        self.keypoint_names = [self.model.GetKeypointName(i) for i in range(self.model.GetNumKeypoints())]
+        self.keypoints = exercise_engine.new_keypoints(len(self.keypoint_names))
+        # the keypoints of every pose of a frame when several people are followed
+        self.all_keypoints = self.keypoints[None].repeat(4, axis=0)
+
+        # the tracker of the running session, None while idle
+        self.tracker = None
+        self.session = None
+        self.recipe_watcher = None
+        self.recipe = args.recipe
+        self.next_idle_inference = 0.0
+        self._commands = []
+        self._commands_lock = threading.Lock()
+
+        self.to_numpy = backend.to_numpy
+        self.motion_gate = None
+        if args.motion_gate:
+            self.motion_gate = MotionGate(args.motion_threshold, max_age=args.motion_max_age)
+        self.inferences = 0
+        self.scheduler = None
+        if args.adaptive_inference:
+            # a prediction must not be overwritten while the pipeline still holds its frame
+            self.scheduler = InferenceScheduler(len(self.keypoint_names), *args.inference_hz,
+                                                buffers=self.capture_buffers)
+
+        self.recorder = TraceRecorder(args.record, self.keypoint_names) if args.record else None
+        self.history = HistoryWriter(args.history) if args.history else None
+        self.synchronize = backend.synchronize
+        self.stream = None
+        if args.stream_port:
+            self.stream = StreamServer(args.stream_port, args.stream_host, args.stream_fps, args.stream_quality)
+        self.telemetry = None
+        if args.telemetry_port:
+            # the camera may not know its frame size before it streams, it is taken from the frames
+            self.telemetry = TelemetryServer(args.telemetry_port, 0, 0, args.telemetry_host,
+                                             len(self.keypoint_names), args.telemetry_hz)
+        self.pipeline = None
+
+        self.control_server = None
+        if args.daemon:
+            self.control_server = ControlServer(self, args.control_port)
+        else:
+            self.start_session()
+
+        self.metrics = None
+        self.metrics_server = None
+        if args.metrics_port:
+            self.enable_metrics(args.metrics_port)
+
+        # the spans cost a flag check per call while nothing is recorded
+        self.profiler = SpanProfiler("main", args.profile_dir, args.cprofile)
+        self.evaluate = self.profiler.wrap("limbs", self.evaluate)
+        self.overlay = self.profiler.wrap("overlay", self.overlay)
+        self.servo.observe = self.profiler.observer("servo", self.servo.observe)
+        if args.profile:
+            self.profiler.start(args.profile)
+
+    def enable_metrics(self, port):
+        """Times the stages into histograms served on the loopback interface.
+        Nothing is wrapped unless this is called, so disabled metrics cost nothing."""
+        metrics = self.metrics = Metrics()
+        stage_seconds = metrics.histogram("tracker_stage_seconds", "Time spent in each stage of a frame", label="stage")
+        self.poses_per_frame = metrics.histogram("tracker_poses_per_frame", "Poses detected per frame",
+                                                 buckets=[0, 1, 2, 3, 4])()
+        self.frames_total = metrics.counter("tracker_frames_total", "Frames rendered")
+        self.frame_time = None
+        self.frame_interval = None
+        metrics.gauge("tracker_fps", "Frames rendered per second, averaged over about a second",
+                      collect=lambda: 1.0 / self.frame_interval if self.frame_interval else 0.0)
+        metrics.counter("tracker_dropped_frames_total", "Frames dropped by the queue in front of each stage", label="stage",
+                      collect=lambda: {s["name"]: s["drops"] for s in self.pipeline.stats()[1:]} if self.pipeline else {})
+        metrics.gauge("tracker_queue_depth", "Frames waiting in the queue in front of each stage", label="stage",
+                      collect=lambda: {s["name"]: s["depth"] for s in self.pipeline.stats()[1:]} if self.pipeline else {})
+
+        metrics.counter("tracker_pose_frames_total", "Frames by where their poses came from: poseNet, "
+                        "reused by the motion gate or predicted by the adaptive rate", label="source",
+                        collect=lambda: {"posenet": self.inferences,
+                                         "reused": self.motion_gate.reused if self.motion_gate else 0,
+                                         "predicted": self.scheduler.predictions if self.scheduler else 0})
+
+        if self.stream is not None:
+            metrics.gauge("tracker_stream_viewers", "Viewers of the MJPEG stream", collect=lambda: len(self.stream.viewers))
+            self.stream.encode_seconds = metrics.histogram("tracker_stream_encode_seconds", "Time to encode a frame of the stream")()
+
+        for name in ("capture", "inference", "update", "render", "limbs", "overlay", "servo"):
+            stage_seconds(name)
+        self.evaluate = metrics.timed(stage_seconds("limbs").observe, self.evaluate)
+        self.overlay = metrics.timed(stage_seconds("overlay").observe, self.overlay)
+        self.servo.observe = stage_seconds("servo").observe
+        self.stage_seconds = stage_seconds
+
+        self.metrics_server = MetricsServer(metrics, port)
+
+    def start_session(self, user="", recipe=None):
+        """Starts exercising with a recipe of the recipe directory, or the
+        current recipe. The recipe is compiled here and swapped in between
+        two frames, so starting takes no longer than a frame."""
+        path = find_recipe(recipe) if recipe else self.recipe
+        # compile the routine once, each frame only packs the keypoints and indexes into its tables
+        plan = load_recipe(path, self.keypoint_names)
+        with self._commands_lock:
+            self._commands.append(("start", user, path, plan))
+        return {"user": user, "recipe": plan.name, "exercises": len(plan.exercises)}
+
+    def stop_session(self):
+        with self._commands_lock:
+            # a start that is still queued counts as a running session
+            running = self._commands[-1][0] == "start" if self._commands else self.session is not None
+            self._commands.append(("stop",))
+        return {"stopping": running}
+
+    def history_report(self, user=None, days=7):
+        if not self.args.history:
+            raise ValueError("no history is recorded, start with --history")
+        # queries run on the calling thread with their own connection
+        history = History(self.args.history)
+        try:
+            return history.report(user, days)
+        finally:
+            history.close()
+
+    def status(self):
+        tracker = self.tracker
+        if tracker is None:
+            return {"session": None}
+        status = {"session": self.session, "exercise": tracker.exercise["name"],
+                  "repeat": tracker.repeat, "count": tracker.count_of_body_part_movement}
+        if isinstance(tracker, PersonTracker):
+            status["people"] = [{"id": person.id, "exercise": person.tracker.exercise["name"],
+                                 "repeat": person.tracker.repeat, "count": person.tracker.count_of_body_part_movement}
+                                for person in tracker.people]
+        return status
+
+    def _apply_commands(self, now):
+        with self._commands_lock:
+            commands, self._commands = self._commands, []
+        for command in commands:
+            if self.tracker is not None:
+                print(f"session of {self.session['user'] or 'unknown user'} ended, "
+                      f"{self.tracker.count_of_body_part_movement} exercises")
+                if self.history is not None:
+                    self.history.record(self.wall_time(now), SESSION_ENDED, self.session["user"], recipe=self.session["recipe"])
+                self.tracker = None
+                self.session = None
+                if self.recipe_watcher is not None:
+                    self.recipe_watcher.close()
+                    self.recipe_watcher = None
+                self.servo.home(90, 90)
+
+            if command[0] == "start":
+                user, self.recipe, plan = command[1:]
+                self.tracker = self.new_tracker(plan)
+                self.session = {"user": user, "recipe": plan.name, "start": now, "wall": time.time()}
+                if self.history is not None:
+                    self.history.record(self.session["wall"], SESSION_STARTED, user, recipe=plan.name)
+                # an edited recipe is swapped in between two frames, the model stays loaded
+                if self.args.reload_interval > 0:
+                    self.recipe_watcher = RecipeWatcher(self.recipe, self.keypoint_names, self.args.reload_interval)
+                self.servo.home(90, 90)
+
+    def new_tracker(self, plan, previous=None):
+        if self.args.people > 1:
+            return PersonTracker(plan, previous, max_people=self.args.people, debounce=self.args.debounce)
+        return exercise_engine.ExerciseTracker(plan, previous, debounce=self.args.debounce)
+
+    def wall_time(self, now):
+        """The wall clock time of a frame time of the session"""
+        return self.session["wall"] + now - self.session["start"]
+
+    def record_history(self, tracker, now):
+        """Queues the rep and exercise events of this frame for the history"""
+        if isinstance(tracker, PersonTracker):
+            trackers = [(person.id, person.tracker) for person in tracker.people]
+        else:
+            trackers = [(None, tracker)]
+        for person, tracker in trackers:
+            if not (tracker.started or tracker.completed or tracker.advanced):
+                continue
+            timestamp = self.wall_time(now)
+            user = self.session["user"]
+            if tracker.started:
+                self.history.record(timestamp, REP_STARTED, user, person, tracker.plan.name, tracker.exercise["name"])
+            if tracker.completed:
+                self.history.record(timestamp, REP_COMPLETED, user, person, tracker.plan.name, tracker.exercise["name"])
+            if tracker.advanced:
+                # the exercise that was finished
+                finished = tracker.exercises[tracker.current_exercise_index - 1]
+                self.history.record(timestamp, EXERCISE_ADVANCED, user, person, tracker.plan.name, finished["name"])
+
+    def publish_telemetry(self, tracker, num_poses, now):
+        """Sends what the tracker made of this frame to the telemetry viewers"""
+        if isinstance(tracker, PersonTracker):
+            people = [(person.id, person.keypoints) for person in tracker.people if person.seen == now]
+        else:
+            people = [(0, self.keypoints)] if num_poses == 1 else []
+        # the countdown is sent on its own, so the status text only changes with the step of the exercise
+        hold = countdown(tracker, now)
+        status = {"exercise": tracker.exercise["name"], "repeat": tracker.repeat, "status": None if hold else tracker.status}
+        self.telemetry.publish(people, status, hold, tracker.count_of_body_part_movement)
+
+    def joint_tracking(self, joint_id, keypoints=None):
+        x, y = (self.keypoints if keypoints is None else keypoints)[joint_id]
+        if x != x: # NaN, the keypoint is not detected
+            return False
+        self.servo.track(x, y)
+        return True
+
+    def capture(self):
+        # capture the next image, None on timeout
+        img = self.input.Capture()
+
+        if img is None and not self.input.IsStreaming():
+            self.pipeline.finish()
+        return img
+
+    def inference(self, img):
+        if self.tracker is None and self.args.idle_fps > 0 and not self._commands:
+            # idle, keep the engine warm at a low rate, the other frames are still shown
+            now = timer()
+            if now < self.next_idle_inference:
+                return img, []
+            self.next_idle_inference = now + 1.0 / self.args.idle_fps
+
+        now = self.clock()
+        gate = self.motion_gate
+        if gate is not None and not gate.changed(self.to_numpy(img), now):
+            # nothing moved since the last inference
+            return img, gate.poses
+
+        scheduler = self.scheduler
+        if scheduler is not None and self.tracker is not None:
+            if not scheduler.due(now):
+                # a still body needs no new inference, its keypoints are extrapolated
+                return img, scheduler.predict(now)
+            poses = self.model.Process(img)
+            scheduler.observe(poses, now)
+        else:
+            # procss the new frame
+            poses = self.model.Process(img)
+        self.inferences += 1
+
+        if gate is not None:
+            gate.inferred(poses, now)
+        return img, poses
+
+    def update(self, frame):
+        img, poses = frame
+        now = self.clock()
+
+        if self.recorder is not None:
+            self.recorder.add(now, poses)
+
+        if self._commands:
+            self._apply_commands(now)
+        if self.tracker is None:
+            self.text.draw(img, [("Waiting for the next session", 0, self.font.GetSize())])
+            return img
+
+        plan = self.recipe_watcher.take() if self.recipe_watcher is not None else None
+        if plan is not None:
+            self.tracker = self.new_tracker(plan, previous=self.tracker)
+            print(f"loaded the {plan.name} routine with {len(plan.exercises)} exercises")
+
+        if self.telemetry is not None and self.telemetry.subscribers:
+            # the keypoints are sent as fractions of this frame
+            height, width = self.to_numpy(img).shape[:2]
+            self.telemetry.resize(width, height)
+        self.evaluate(poses, now)
+        self.overlay(img)
+        return img
+
+    def evaluate(self, poses, now):
+        tracker = self.tracker
+        keypoints = None
+        if isinstance(tracker, PersonTracker):
+            if len(poses) > len(self.all_keypoints):
+                self.all_keypoints = self.keypoints[None].repeat(len(poses), axis=0)
+            for pose, out in zip(poses, self.all_keypoints):
+                exercise_engine.pack_keypoints(pose, out)
+            tracker.update(self.all_keypoints, len(poses), now)
+            # the camera follows the person seen the longest
+            if tracker.primary is not None:
+                keypoints = tracker.primary.keypoints
+        else:
+            if len(poses) == 1:
+                exercise_engine.pack_keypoints(poses[0], self.keypoints)
+            tracker.update(self.keypoints, len(poses), now)
+
+        if self.history is not None:
+            self.record_history(tracker, now)
+        if self.telemetry is not None and self.telemetry.subscribers:
+            self.publish_telemetry(tracker, len(poses), now)
+        for limb in tracker.tracked:
+            self.joint_tracking(tracker.limb_table.track[limb], keypoints)
+        if tracker.advanced:
+            self.servo.home(tilt=90)
+
+    def overlay(self, img):
+        size = self.font.GetSize()
+        tracker = self.tracker
+        if isinstance(tracker, PersonTracker) and len(tracker.people) > 1:
+            # a column of status lines above each person
+            lines = []
+            for person in tracker.people:
+                x = person.keypoints[:, 0]
+                x = int(max(0, x[x == x].min())) if (x == x).any() else 0
+                lines.append((f"#{person.id} {person.tracker.exercise['name']}", x, 0 + size))
+                if person.tracker.status:
+                    lines.append((person.tracker.status, x, 50 + size))
+                lines.append((f"# exercises: {person.tracker.count_of_body_part_movement}", x, 100 + size))
+            self.text.draw(img, lines)
+            return
+        lines = [(f"Current exercise: {tracker.exercise['name']} ", 0, 0 + size)]
+        if tracker.status:
+            lines.append((tracker.status, 0, 50 + size))
+        lines.append((f"Total # exercises: {tracker.count_of_body_part_movement}", 0, 100 + size))
+        self.text.draw(img, lines)
+
+    def render(self, img):
+        if self.stream is not None and self.stream.due():
+            # the overlay is drawn by the GPU, let it finish before the frame is copied,
+            # frames between the streamed ones are neither waited for nor copied
+            self.synchronize()
+            self.stream.publish(self.to_numpy(img))
+
+        # draw the visual
+        self.output.Render(img)
+
+        if not self.output.IsStreaming():
+            self.pipeline.stop()
+        elif not self.input.IsStreaming():
+            self.pipeline.finish()
+
+    def build_pipeline(self, wrap=None):
+        """Creates the stage pipeline, wrap(name, fn) can decorate every stage"""
+        wrap = wrap or (lambda name, fn: fn)
+        stages = [("inference", self.inference), ("update", self.update), ("render", self.render)]
+        capture = self.capture
+        if self.metrics is not None:
+            capture = self.metrics.timed(self.stage_seconds("capture").observe, capture)
+            stages = [(name, self.metrics.timed(self.stage_seconds(name).observe, fn)) for name, fn in stages]
+            stages[0] = ("inference", self._count_poses(stages[0][1]))
+            stages[2] = ("render", self._count_frames(stages[2][1]))
+        capture = self.profiler.wrap("capture", capture, profile=True)
+        stages = [(name, self.profiler.wrap(name, fn, profile=True)) for name, fn in stages]
+        stages[2] = ("render", self._count_profiled_frames(stages[2][1]))
+        self.pipeline = Pipeline(wrap("capture", capture), [(name, wrap(name, fn)) for name, fn in stages],
+                                 depth=self.args.queue_depth, drop_oldest=not self.args.block,
+                                 threaded=not self.args.serial)
+        buffers = getattr(self.input, "buffers", self.capture_buffers)
+        if self.pipeline.frames_in_flight() > buffers:
+            raise ValueError(f"the pipeline holds up to {self.pipeline.frames_in_flight()} frames, "
+                             f"more than the {buffers} capture buffers")
+        return self.pipeline
+
+    def _count_poses(self, inference):
+        def count_poses(img):
+            frame = inference(img)
+            if frame is not None:
+                self.poses_per_frame.observe(len(frame[1]))
+            return frame
+        return count_poses
+
+    def _count_frames(self, render):
+        def count_frames(img):
+            render(img)
+            now = timer()
+            if self.frame_time is not None:
+                interval = now - self.frame_time
+                self.frame_interval = interval if self.frame_interval is None else \
+                    0.97 * self.frame_interval + 0.03 * interval
+            self.frame_time = now
+            self.metrics.inc(self.frames_total)
+        return count_frames
+
+    def _count_profiled_frames(self, render):
+        def count_profiled_frames(img):
+            render(img)
+            self.profiler.frame()
+        return count_profiled_frames
+
+    def run(self):
+        # capture, inference, exercise logic and rendering each run in their own stage
+        if self.pipeline is None:
+            self.build_pipeline()
+        try:
+            self.pipeline.run()
+        finally:
+            self.close()
+
+    def close(self):
+        self.servo.stop()
+        if self.control_server is not None:
+            self.control_server.close()
+            self.control_server = None
+        if self.recipe_watcher is not None:
+            self.recipe_watcher.close()
+            self.recipe_watcher = None
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.stream is not None:
+            self.stream.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        self.profiler.stop()
+        if self.history is not None:
+            if self.session is not None:
+                self.history.record(self.wall_time(self.clock()), SESSION_ENDED, self.session["user"], recipe=self.session["recipe"])
+            self.history.close()
+            self.history = None
+
+
+if __name__ == "__main__":
+    args, backend = parse_args()
+    app = ExerciseApp(args, backend)
+    app.profiler.toggle_on(signal.SIGUSR1, args.profile or 300)
+    app.run()
+
+    if args.stats:
+        print(app.pipeline.report())
+        if app.motion_gate is not None:
+            print(app.motion_gate.report())
+        if app.scheduler is not None:
+            print(app.scheduler.report())
+        if app.stream is not None:
+            print(app.stream.report())
+        if app.telemetry is not None:
+            print(app.telemetry.report())
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import bisect
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from timeit import default_timer as timer
+
+
+# seconds, from a fast limb check up to a throttled inference
+LATENCY_BUCKETS = [0.0005, 0.001, 0.002, 0.005, 0.010, 0.020, 0.033, 0.050, 0.100, 0.200, 0.500, 1.0]
+
+
+class Histogram:
+    """Fixed-bucket histogram, observe() is a bisect and two additions"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    def __init__(self, name, kind, help, label=None):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label = label
+        self.values = {} # label value -> number or Histogram
+        self.collect = None
+
+
+def _labels(label, value, extra=""):
+    labels = [f'{label}="{value}"'] if label else []
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """A small registry of counters, gauges and histograms rendered in the
+    Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, name, kind, help, label=None):
+        metric = Metric(name, kind, help, label)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        metric = self._add(name, "histogram", help, label)
+
+        def get(value=""):
+            histogram = metric.values.get(value)
+            if histogram is None:
+                histogram = metric.values[value] = Histogram(buckets)
+            return histogram
+        return get
+
+    def counter(self, name, help, label=None, collect=None):
+        metric = self._add(name, "counter", help, label)
+        metric.collect = collect
+        return metric
+
+    def gauge(self, name, help, label=None, collect=None):
+        """collect() is called on every scrape, returning the value or a dict of label value -> value"""
+        metric = self._add(name, "gauge", help, label)
+        metric.collect = collect
+        return metric
+
+    def inc(self, metric, value=1, label=""):
+        metric.values[label] = metric.values.get(label, 0) + value
+
+    def timed(self, observe, fn):
+        """Wraps fn so its run time is observed, leave fn unwrapped to disable"""
+        def timed_fn(*args):
+            start = timer()
+            result = fn(*args)
+            observe(timer() - start)
+            return result
+        return timed_fn
+
+    def render(self)->str:
+        lines = []
+        for metric in self._metrics:
+            values = metric.values
+            if metric.collect is not None:
+                values = metric.collect()
+                if not isinstance(values, dict):
+                    values = {"": values}
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for label, value in sorted(values.items()):
+                if metric.kind != "histogram":
+                    lines.append(f"{metric.name}{_labels(metric.label, label)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + ["+Inf"], list(value.counts)):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f"{metric.name}_bucket{_labels(metric.label, label, le)} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(metric.label, label)} {_number(value.sum)}")
+                lines.append(f"{metric.name}_count{_labels(metric.label, label)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """Serves GET /metrics on the loopback interface from a background thread"""
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
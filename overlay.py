@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+
+
+class TextOverlay:
+    """Draws the status lines from a cache of rendered text blocks.
+
+    A block is rendered by the backend once per (text, color, background,
+    image format) and every frame only blits the cached blocks onto the
+    image, so unchanged lines cost a copy instead of laying out and
+    rasterizing the glyphs again. Without a renderer the lines are drawn
+    with font.OverlayText() every frame as before.
+    """
+
+    def __init__(self, font, renderer=None, capacity=64):
+        self.font = font
+        self.renderer = renderer
+        self.capacity = capacity
+        self.renders = 0
+        self.blits = 0
+        self._blocks = OrderedDict()
+
+    def draw(self, img, lines, color=None, background=None):
+        """Draws (text, x, y) lines onto img"""
+        font = self.font
+        color = font.White if color is None else color
+        background = font.Gray40 if background is None else background
+
+        if self.renderer is None:
+            for text, x, y in lines:
+                font.OverlayText(img, text=text, x=x, y=y, color=color, background=background)
+            return
+
+        format = getattr(img, "format", None)
+        for text, x, y in lines:
+            key = (text, color, background, format)
+            block = self._blocks.get(key)
+            if block is None:
+                block = self._render(key)
+            else:
+                self._blocks.move_to_end(key)
+            if block[0] is not None:
+                image, (dx, dy) = block
+                self.renderer.blit(image, img, int(x + dx), int(y + dy))
+                self.blits += 1
+
+    def _render(self, key):
+        text, color, background, format = key
+        block = self.renderer.render(self.font, text, color, background, format)
+        if block is None:
+            block = (None, (0, 0))
+        self._blocks[key] = block
+        self.renders += 1
+        while len(self._blocks) > self.capacity:
+            self._blocks.popitem(last=False)
+        return block
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+import exercise_engine
+
+
+def keypoint_cost(tracks, poses):
+    """Returns the (T,P) cost of matching T tracked (T,K,2) keypoints with P
+    detected (P,K,2) keypoints: the mean distance of the keypoints both have,
+    relative to the size of the tracked body, inf when they share none"""
+    diff = tracks[:, None, :, :] - poses[None, :, :, :]
+    dist = np.sqrt(np.sum(diff * diff, axis=-1))          # (T,P,K), NaN where either is missing
+    shared = ~np.isnan(dist)
+    count = shared.sum(axis=-1)
+    mean = np.where(shared, dist, 0).sum(axis=-1) / np.maximum(count, 1)
+
+    with np.errstate(invalid="ignore"):
+        extent = np.nanmax(tracks, axis=1) - np.nanmin(tracks, axis=1)   # (T,2)
+    scale = np.hypot(extent[:, 0], extent[:, 1])
+    scale = np.where(np.isnan(scale) | (scale < 1), 1, scale)
+    return np.where(count > 0, mean / scale[:, None], np.inf)
+
+
+def assign(cost, max_cost):
+    """Returns the (track, pose) pairs of the assignment with the lowest total
+    cost, leaving out pairs above max_cost. Uses scipy when it is installed,
+    otherwise matches the cheapest pairs first."""
+    if cost.size == 0:
+        return []
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(np.where(np.isfinite(cost), cost, 1e9))
+        return [(t, p) for t, p in zip(rows, cols) if cost[t, p] <= max_cost]
+
+    pairs = []
+    used_tracks = np.zeros(cost.shape[0], dtype=bool)
+    used_poses = np.zeros(cost.shape[1], dtype=bool)
+    for flat in np.argsort(cost, axis=None):
+        t, p = np.unravel_index(flat, cost.shape)
+        if cost[t, p] > max_cost:
+            break
+        if used_tracks[t] or used_poses[p]:
+            continue
+        used_tracks[t] = used_poses[p] = True
+        pairs.append((t, p))
+    return pairs
+
+
+class Person:
+    def __init__(self, person_id, plan, keypoints, now, debounce=0.0):
+        self.id = person_id
+        self.keypoints = keypoints.copy()
+        self.tracker = exercise_engine.ExerciseTracker(plan, debounce=debounce)
+        self.seen = now
+
+
+class PersonTracker:
+    """Follows up to max_people poses across frames, each with their own
+    exercise state, so several people can exercise together.
+
+    Poses are associated with the people of the previous frame by the
+    distance of their keypoints, and the limbs of all poses are evaluated
+    in one call. A person not seen for forget_after seconds is dropped.
+
+    The attributes of ExerciseTracker are those of the person seen the
+    longest, who the camera follows.
+    """
+
+    def __init__(self, plan, previous=None, max_people=2, max_cost=0.5, forget_after=10.0, debounce=0.0):
+        self.plan = plan
+        self.limb_table = plan.limb_table
+        self.max_people = max_people
+        self.max_cost = max_cost
+        self.forget_after = forget_after
+        self.debounce = debounce
+        self.people = []
+        self.idle = exercise_engine.ExerciseTracker(plan)
+        self._next_id = 1
+
+        if isinstance(previous, PersonTracker):
+            # a new plan for the same people
+            self._next_id = previous._next_id
+            for person in previous.people:
+                person.tracker = exercise_engine.ExerciseTracker(plan, previous=person.tracker, debounce=debounce)
+                self.people.append(person)
+
+    @property
+    def primary(self):
+        return self.people[0] if self.people else None
+
+    def __getattr__(self, name):
+        # exercise, status, repeat, tracked, advanced, count_of_body_part_movement, ...
+        if name.startswith("_") or name in ("people", "plan", "idle", "debounce"):
+            raise AttributeError(name)
+        if not self.people:
+            return _NOBODY[name] if name in _NOBODY else getattr(self.idle, name)
+        return getattr(self.people[0].tracker, name)
+
+    def update(self, keypoints, num_poses, now):
+        """keypoints is the (N,K,2) packed keypoints of the num_poses poses of the frame"""
+        poses = keypoints[:num_poses]
+        seen = []
+        assigned = np.zeros(num_poses, dtype=bool)
+
+        if self.people and num_poses:
+            cost = keypoint_cost(np.stack([person.keypoints for person in self.people]), poses)
+            for t, p in assign(cost, self.max_cost):
+                person = self.people[t]
+                person.keypoints[:] = poses[p]
+                person.seen = now
+                seen.append(person)
+                assigned[p] = True
+
+        for p in np.flatnonzero(~assigned):
+            if len(self.people) >= self.max_people:
+                break
+            person = Person(self._next_id, self.plan, poses[p], now, self.debounce)
+            self._next_id += 1
+            self.people.append(person)
+            seen.append(person)
+
+        self.people = [person for person in self.people if now - person.seen < self.forget_after or person in seen]
+
+        # the limbs of everyone in view in one evaluation, then each state machine
+        if seen:
+            visible, at_exercise = exercise_engine.evaluate_limbs(self.limb_table, np.stack([person.keypoints for person in seen]))
+            for i, person in enumerate(seen):
+                person.tracker.update(person.keypoints, 1, now, limbs=(visible[i], at_exercise[i]))
+        for person in self.people:
+            if person not in seen:
+                person.tracker.update(None, 0, now)
+
+
+_NOBODY = {"status": "Body is not detected.", "tracked": (), "advanced": False, "started": False, "completed": False}
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import threading
+import time
+
+from collections import deque
+from timeit import default_timer as timer
+
+
+# passed down the stages by finish() after the last captured frame
+END = object()
+
+
+def frames_in_flight(stages, depth=1, threaded=True):
+    """Most frames a pipeline of capture and stages holds at once: one in
+    every stage and every queue slot, and the one being captured"""
+    if not threaded:
+        return 1
+    return (stages + 1) + stages * max(1, depth) + 1
+
+class FrameQueue:
+    """Bounded queue between two pipeline stages.
+
+    When the queue is full put() drops the oldest frame if drop_oldest is set,
+    otherwise it waits for the consumer to catch up.
+    """
+
+    def __init__(self, maxsize=1, drop_oldest=True):
+        self.maxsize = max(1, maxsize)
+        self.drop_oldest = drop_oldest
+        self.drops = 0
+        self.max_depth = 0
+        self._items = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item)->bool:
+        with self._cond:
+            while len(self._items) >= self.maxsize and not self._closed:
+                if self.drop_oldest:
+                    self._items.popleft()
+                    self.drops += 1
+                else:
+                    self._cond.wait()
+            if self._closed:
+                return False
+            self._items.append(item)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """Waits for the next item, returns None once the queue is closed"""
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._cond.notify_all()
+
+
+class Stage:
+    def __init__(self, name, fn, queue=None):
+        self.name = name
+        self.fn = fn
+        self.queue = queue  # input queue, None for the capture stage
+        self.frames = 0
+        self.busy = 0.0
+
+
+class Pipeline:
+    """Runs capture -> stage -> ... -> stage with each stage on its own thread.
+
+    capture() returns the next frame or None on timeout. Every stage is a
+    (name, fn) pair where fn(item) returns the item for the next stage, or
+    None to drop it. stop() ends the pipeline right away while finish() stops
+    capturing and lets the frames already captured flow through first. The
+    last stage runs on the thread calling run(), so display sinks bound to
+    the thread that opened them keep working.
+    """
+
+    def __init__(self, capture, stages, depth=1, drop_oldest=True, threaded=True):
+        self.stages = [Stage("capture", capture)]
+        self.stages += [Stage(name, fn, FrameQueue(depth, drop_oldest)) for name, fn in stages]
+        self.depth = depth
+        self.threaded = threaded
+        self.time_start = None
+        self.time_stop = None
+        self._running = False
+        self._capturing = False
+        self._error = None
+
+    def run(self):
+        """Runs the pipeline until stop() is called or a stage raises"""
+        self._running = True
+        self._capturing = True
+        self.time_start = timer()
+        if not self.threaded:
+            self._run_serial()
+            return
+
+        threads = [threading.Thread(target=self._run_stage, args=(i,), name=stage.name, daemon=True)
+                   for i, stage in enumerate(self.stages[:-1])]
+        for thread in threads:
+            thread.start()
+        try:
+            self._run_stage(len(self.stages) - 1)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def finish(self):
+        self._capturing = False
+
+    def stop(self):
+        self._capturing = False
+        if self._running:
+            self.time_stop = timer()
+        self._running = False
+        for stage in self.stages:
+            if stage.queue is not None:
+                stage.queue.close()
+
+    def frames_in_flight(self):
+        """Most frames the stages hold at once, the capture ring must have at least as many"""
+        return frames_in_flight(len(self.stages) - 1, self.depth, self.threaded)
+
+    @property
+    def running(self)->bool:
+        return self._running
+
+    def _call(self, stage, *args):
+        start = timer()
+        result = stage.fn(*args)
+        stage.busy += timer() - start
+        stage.frames += 1
+        return result
+
+    def _run_serial(self):
+        try:
+            while self._running and self._capturing:
+                item = self._call(self.stages[0])
+                for stage in self.stages[1:]:
+                    if item is None:
+                        break
+                    item = self._call(stage, item)
+        finally:
+            self.stop()
+
+    def _run_stage(self, i):
+        stage = self.stages[i]
+        output = self.stages[i + 1].queue if i + 1 < len(self.stages) else None
+        try:
+            while self._running:
+                if stage.queue is None:
+                    if not self._capturing:
+                        item = END
+                    else:
+                        item = self._call(stage)
+                else:
+                    item = stage.queue.get()
+                    if item is None: # closed
+                        break
+                    if item is not END:
+                        item = self._call(stage, item)
+                if item is not None and output is not None:
+                    output.put(item)
+                if item is END:
+                    if output is None:
+                        self.stop()
+                    break
+        except BaseException as e:
+            self._error = e
+            self.stop()
+
+    def stats(self):
+        elapsed = (self.time_stop or timer()) - (self.time_start or timer())
+        stats = []
+        for stage in self.stages:
+            queue = stage.queue
+            stats.append({"name": stage.name,
+                          "frames": stage.frames,
+                          "fps": stage.frames / elapsed if elapsed > 0 else 0.0,
+                          "busy_ms": 1000.0 * stage.busy / stage.frames if stage.frames else 0.0,
+                          "depth": len(queue) if queue is not None else 0,
+                          "max_depth": queue.max_depth if queue is not None else 0,
+                          "drops": queue.drops if queue is not None else 0})
+        return stats
+
+    def report(self)->str:
+        lines = [f"{'stage':<10}{'frames':>8}{'fps':>10}{'ms/frame':>10}{'depth':>7}{'max':>5}{'drops':>7}"]
+        for s in self.stats():
+            lines.append(f"{s['name']:<10}{s['frames']:>8}{s['fps']:>10.1f}{s['busy_ms']:>10.2f}"
+                         f"{s['depth']:>7}{s['max_depth']:>5}{s['drops']:>7}")
+        return "\n".join(lines)
+
+
+def sleeper(seconds):
+    """Stand-in stage that takes the given time per frame, like a camera wait or GPU call"""
+    def stage(item=None):
+        time.sleep(seconds)
+        return item if item is not None else object()
+    return stage
+
+
+if __name__ == "__main__":
+    # compare the serial loop against the pipeline with stand-in stages
+    parser = argparse.ArgumentParser(description="Benchmark the frame pipeline with stand-in stages.")
+    parser.add_argument("--frames", type=int, default=100, help="frames to render")
+    parser.add_argument("--depth", type=int, default=1, help="queue depth between stages")
+    parser.add_argument("--block", action="store_true", help="block instead of dropping the oldest frame")
+    parser.add_argument("--capture-ms", type=float, default=33.0)
+    parser.add_argument("--inference-ms", type=float, default=40.0)
+    parser.add_argument("--logic-ms", type=float, default=5.0)
+    parser.add_argument("--render-ms", type=float, default=16.0)
+    args = parser.parse_args()
+
+    for threaded in (False, True):
+        pipeline = None
+        rendered = sleeper(args.render_ms / 1000.0)
+
+        def render(item):
+            rendered(item)
+            if pipeline.stages[-1].frames + 1 >= args.frames:
+                pipeline.stop()
+
+        pipeline = Pipeline(sleeper(args.capture_ms / 1000.0),
+                            [("inference", sleeper(args.inference_ms / 1000.0)),
+                             ("logic", sleeper(args.logic_ms / 1000.0)),
+                             ("render", render)],
+                            depth=args.depth, drop_oldest=not args.block, threaded=threaded)
+        pipeline.run()
+        print("pipelined" if threaded else "serial")
+        print(pipeline.report())
+        print()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+import exercise_engine
+from recipes import DEFAULT_RECIPE, load_recipe
+
+
+# a trace is a directory of .npy columns that np.load() can memory-map:
+#   timestamps.npy  (N,) float64     time of each frame in seconds
+#   offsets.npy     (N+1,) int64     poses of frame i are keypoints[offsets[i]:offsets[i+1]]
+#   keypoints.npy   (M,K,2) float32  x, y of every keypoint of every pose, NaN if not detected
+#   meta.json                        keypoint names
+TRACE_VERSION = 1
+
+
+class TraceRecorder:
+    """Records the poses of every frame into a trace directory"""
+
+    def __init__(self, path, keypoint_names=exercise_engine.KEYPOINT_NAMES, chunk=4096):
+        self.path = path
+        self.keypoint_names = list(keypoint_names)
+        self.chunk = chunk
+        self.frames = 0
+        self.poses = 0
+        self._timestamps = [np.empty(chunk, dtype=np.float64)]
+        self._counts = [np.empty(chunk, dtype=np.int64)]
+        self._keypoints = [np.empty((chunk, len(self.keypoint_names), 2), dtype=np.float32)]
+        self._pose_row = 0
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, timestamp, poses):
+        frame_row = self.frames % self.chunk
+        if frame_row == 0 and self.frames > 0:
+            self._timestamps.append(np.empty(self.chunk, dtype=np.float64))
+            self._counts.append(np.empty(self.chunk, dtype=np.int64))
+        self._timestamps[-1][frame_row] = timestamp
+        self._counts[-1][frame_row] = len(poses)
+        self.frames += 1
+
+        for pose in poses:
+            if self._pose_row == self.chunk:
+                self._keypoints.append(np.empty_like(self._keypoints[-1]))
+                self._pose_row = 0
+            exercise_engine.pack_keypoints(pose, self._keypoints[-1][self._pose_row])
+            self._pose_row += 1
+            self.poses += 1
+
+    def close(self):
+        timestamps = np.concatenate(self._timestamps)[:self.frames]
+        offsets = np.zeros(self.frames + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(self._counts)[:self.frames], out=offsets[1:])
+        keypoints = np.concatenate(self._keypoints)[:self.poses]
+
+        np.save(os.path.join(self.path, "timestamps.npy"), timestamps)
+        np.save(os.path.join(self.path, "offsets.npy"), offsets)
+        np.save(os.path.join(self.path, "keypoints.npy"), keypoints)
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"version": TRACE_VERSION, "keypoint_names": self.keypoint_names}, f)
+
+
+class Trace:
+    """A recorded trace, the columns are memory-mapped rather than read"""
+
+    def __init__(self, path, mmap_mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != TRACE_VERSION:
+            raise ValueError(f"{path}: unsupported trace version {meta.get('version')}")
+        self.keypoint_names = meta["keypoint_names"]
+        self.timestamps = np.load(os.path.join(path, "timestamps.npy"), mmap_mode=mmap_mode)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        self.keypoints = np.load(os.path.join(path, "keypoints.npy"), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def frame(self, i):
+        """Returns (timestamp, keypoints) of frame i, keypoints is (poses,K,2)"""
+        return self.timestamps[i], self.keypoints[self.offsets[i]:self.offsets[i + 1]]
+
+
+def replay(trace, tracker, on_frame=None):
+    """Feeds every frame of the trace through the tracker, using the recorded
+    timestamps as the clock so the result does not depend on the replay speed"""
+    timestamps = np.asarray(trace.timestamps)
+    offsets = np.asarray(trace.offsets)
+    keypoints = np.asarray(trace.keypoints)
+    for i in range(len(timestamps)):
+        start, end = offsets[i], offsets[i + 1]
+        tracker.update(keypoints[start] if end - start == 1 else None, end - start, timestamps[i])
+        if on_frame is not None:
+            on_frame(i, timestamps[i], tracker)
+    return tracker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded pose traces through the exercise state machine.")
+    parser.add_argument("traces", nargs="+", help="trace directories recorded with main.py --record")
+    parser.add_argument("--recipe", type=str, default=DEFAULT_RECIPE, help="JSON or YAML file with the exercise routine")
+    parser.add_argument("--debounce", type=float, default=0.0, help="seconds of frames that decide whether a limb is in position")
+    parser.add_argument("--log", action="store_true", help="print every status change with its trace time")
+    args = parser.parse_args()
+
+    total_frames = 0
+    total_time = 0.0
+    for path in args.traces:
+        trace = Trace(path)
+        tracker = exercise_engine.ExerciseTracker(load_recipe(args.recipe, trace.keypoint_names), debounce=args.debounce)
+
+        on_frame = None
+        if args.log:
+            last = [None]
+            def on_frame(i, timestamp, tracker):
+                status = (tracker.exercise["name"], tracker.status)
+                if status != last[0]:
+                    print(f"{path} {timestamp - trace.timestamps[0]:9.3f}  {status[0]}: {status[1]}")
+                    last[0] = status
+
+        start = timer()
+        replay(trace, tracker, on_frame)
+        elapsed = timer() - start
+        total_frames += len(trace)
+        total_time += elapsed
+
+        print(f"{path}: {len(trace)} frames, {tracker.count_of_body_part_movement} exercises, "
+              f"at {tracker.exercise['name']} ({tracker.repeat} to go), {len(trace) / max(elapsed, 1e-9):.0f} frames/s")
+
+    if len(args.traces) > 1:
+        print(f"{len(args.traces)} traces, {total_frames} frames, {total_frames / max(total_time, 1e-9):.0f} frames/s")
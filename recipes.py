@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+import threading
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from exercise_engine import KEYPOINT_NAMES, LOCATIONS, Plan
+
+
+RECIPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipes")
+DEFAULT_RECIPE = os.path.join(RECIPE_DIR, "default.json")
+
+LIMB_FIELDS = {"name": str, "joint1": str, "joint2": str, "joint3": str, "location": str, "track": str}
+EXERCISE_FIELDS = {"name": str, "body_parts": list, "duration": (int, float), "repeat": int,
+                   "return_caption": str, "description": str}
+
+
+def read_recipe(path)->dict:
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError(f"{path}: reading YAML recipes needs PyYAML (pip3 install pyyaml)")
+            try:
+                return yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"{path}: {e}")
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{path}: {e}")
+
+
+def _check_fields(path, kind, item, fields):
+    if not isinstance(item, dict):
+        raise ValueError(f"{path}: every {kind} must be an object")
+    for field, types in fields.items():
+        if field not in item:
+            raise ValueError(f"{path}: {kind} {item.get('name', '?')} has no {field}")
+        if not isinstance(item[field], types) or isinstance(item[field], bool):
+            raise ValueError(f"{path}: {kind} {item.get('name', '?')} has an invalid {field}")
+
+
+def validate_recipe(recipe, path="recipe", keypoint_names=KEYPOINT_NAMES):
+    """Checks the limbs and exercises of a recipe, raising ValueError on the first problem"""
+    if not isinstance(recipe, dict):
+        raise ValueError(f"{path}: a recipe must be an object with limbs and exercises")
+    limbs = recipe.get("limbs")
+    exercises = recipe.get("exercises")
+    if not isinstance(limbs, list) or not limbs:
+        raise ValueError(f"{path}: no limbs")
+    if not isinstance(exercises, list) or not exercises:
+        raise ValueError(f"{path}: no exercises")
+
+    limb_names = set()
+    for limb in limbs:
+        _check_fields(path, "limb", limb, LIMB_FIELDS)
+        if limb["name"] in limb_names:
+            raise ValueError(f"{path}: limb {limb['name']} is defined twice")
+        limb_names.add(limb["name"])
+        for field in ("joint1", "joint2", "joint3", "track"):
+            if limb[field] not in keypoint_names:
+                raise ValueError(f"{path}: limb {limb['name']} uses unknown keypoint {limb[field]}")
+        if limb["location"] not in LOCATIONS:
+            raise ValueError(f"{path}: limb {limb['name']} has unknown location {limb['location']}, "
+                             f"expected one of {', '.join(LOCATIONS)}")
+
+    for exercise in exercises:
+        _check_fields(path, "exercise", exercise, EXERCISE_FIELDS)
+        if not exercise["body_parts"]:
+            raise ValueError(f"{path}: exercise {exercise['name']} has no body parts")
+        for body_part in exercise["body_parts"]:
+            if body_part not in limb_names:
+                raise ValueError(f"{path}: exercise {exercise['name']} uses unknown body part {body_part}")
+        if exercise["duration"] <= 0 or exercise["repeat"] < 1:
+            raise ValueError(f"{path}: exercise {exercise['name']} needs a positive duration and repeat")
+
+
+def find_recipe(name, directory=RECIPE_DIR)->str:
+    """Returns the path of the recipe with this name in the recipe directory"""
+    if not name or os.path.basename(name) != name or name.startswith("."):
+        raise ValueError(f"invalid recipe name {name!r}")
+    for ext in ("", ".json", ".yaml", ".yml"):
+        path = os.path.join(directory, name + ext)
+        if os.path.isfile(path):
+            return path
+    raise ValueError(f"no recipe {name} in {directory}")
+
+
+def load_recipe(path=DEFAULT_RECIPE, keypoint_names=KEYPOINT_NAMES)->Plan:
+    """Reads, validates and compiles a JSON or YAML recipe. A recipe without
+    limbs uses the limbs of the default recipe."""
+    recipe = read_recipe(path)
+    if isinstance(recipe, dict) and "limbs" not in recipe and path != DEFAULT_RECIPE:
+        recipe = dict(recipe, limbs=read_recipe(DEFAULT_RECIPE)["limbs"])
+    validate_recipe(recipe, path, keypoint_names)
+    return Plan(recipe["limbs"], recipe["exercises"], keypoint_names,
+                name=recipe.get("name", os.path.splitext(os.path.basename(path))[0]))
+
+
+class RecipeWatcher:
+    """Polls a recipe file for changes from a background thread.
+
+    A changed recipe is loaded and compiled off the frame loop, and only a
+    valid one is handed over through take(), so the loop can swap it in
+    between two frames. Invalid edits are reported and the current plan stays.
+    """
+
+    def __init__(self, path, keypoint_names=KEYPOINT_NAMES, interval=1.0):
+        self.path = path
+        self.keypoint_names = keypoint_names
+        self.interval = interval
+        self.reloads = 0
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stamp = self._stat()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="recipes", daemon=True)
+        self._thread.start()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stamp = self._stat()
+            if stamp is None or stamp == self._stamp:
+                continue
+            self._stamp = stamp
+            try:
+                plan = load_recipe(self.path, self.keypoint_names)
+                with self._lock:
+                    self._pending = plan
+                self.reloads += 1
+            except (OSError, ValueError) as e:
+                print(f"recipes: keeping the current routine, {e}", file=sys.stderr)
+
+    def take(self):
+        """Returns the newly loaded plan once, or None if there is none"""
+        with self._lock:
+            plan, self._pending = self._pending, None
+        return plan
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate exercise recipe files.")
+    parser.add_argument("recipes", nargs="+")
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.recipes:
+        try:
+            plan = load_recipe(path)
+            print(f"{path}: {len(plan.limbs)} limbs, {len(plan.exercises)} exercises")
+        except (OSError, ValueError) as e:
+            print(e)
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+import exercise_engine
+from people import assign, keypoint_cost
+
+
+class KeypointPredictor:
+    """Constant-velocity alpha-beta filter over the keypoints of every pose,
+    the steady-state form of a Kalman filter with a constant-velocity model.
+
+    observe() corrects the position and velocity of each keypoint with a
+    new inference, predict() extrapolates them to any time in between.
+    Poses are matched to the previous ones by their keypoint distance.
+    """
+
+    def __init__(self, num_keypoints, alpha=0.8, beta=0.3, max_poses=8, buffers=8):
+        self.alpha = alpha
+        self.beta = beta
+        self.count = 0
+        self.time = None
+        self.position = np.full((max_poses, num_keypoints, 2), np.nan, dtype=np.float32)
+        self.velocity = np.zeros_like(self.position)
+        # predictions are handed down the pipeline, so a few frames of them stay valid
+        self.predicted = np.empty((buffers,) + self.position.shape, dtype=np.float32)
+        self._next = 0
+        self._observed = np.empty_like(self.position)
+
+    def observe(self, poses, now):
+        count = min(len(poses), len(self.position))
+        observed = self._observed[:count]
+        for pose, out in zip(poses, observed):
+            exercise_engine.pack_keypoints(pose, out)
+
+        if self.time is None or count != self.count or now <= self.time:
+            # nothing to continue from
+            self.position[:count] = observed
+            self.velocity[:count] = 0
+        else:
+            if count > 1:
+                order = np.arange(count)
+                for t, p in assign(keypoint_cost(self.position[:count], observed), np.inf):
+                    order[t] = p
+                observed = observed[order]
+            dt = now - self.time
+            position = self.position[:count]
+            velocity = self.velocity[:count]
+            residual = observed - (position + velocity * dt)
+            new = np.isnan(position) | np.isnan(residual)
+            position += velocity * dt + self.alpha * residual
+            velocity += (self.beta / dt) * residual
+            # keypoints that appeared start at rest, those that disappeared stay missing
+            position[new] = observed[new]
+            velocity[new] = 0
+
+        self.count = count
+        self.time = now
+
+    def speed(self):
+        """The fastest keypoint movement of any pose, in body sizes per second"""
+        if self.count == 0:
+            return 0.0
+        position = self.position[:self.count]
+        with np.errstate(invalid="ignore"):
+            extent = np.nanmax(position, axis=1) - np.nanmin(position, axis=1)
+        size = np.maximum(np.hypot(extent[:, 0], extent[:, 1]), 1.0)
+        velocity = np.hypot(self.velocity[:self.count, :, 0], self.velocity[:self.count, :, 1])
+        velocity = np.where(np.isnan(velocity), 0, velocity)
+        return float(np.max(velocity.max(axis=1) / size))
+
+    def predict(self, now):
+        """Returns PackedPoses of the keypoints extrapolated to now"""
+        count = self.count
+        dt = 0.0 if self.time is None else now - self.time
+        predicted = self.predicted[self._next, :count]
+        self._next = (self._next + 1) % len(self.predicted)
+        np.multiply(self.velocity[:count], dt, out=predicted)
+        predicted += self.position[:count]
+        return [exercise_engine.PackedPose(keypoints) for keypoints in predicted]
+
+
+class InferenceScheduler:
+    """Runs poseNet at a rate that follows how fast the body moves.
+
+    During the slow holds of the exercises inference drops to min_hz, and
+    it rises to max_hz as the keypoints move faster than slow body sizes a
+    second, up to fast. The frames in between get the poses predicted by a
+    KeypointPredictor, so the state machine, overlay and servos still
+    update on every frame. buffers is the number of frames the pipeline
+    holds at once, as many predictions stay valid.
+    """
+
+    def __init__(self, num_keypoints, min_hz=5.0, max_hz=30.0, slow=0.1, fast=0.6, buffers=8):
+        self.min_hz = min_hz
+        self.max_hz = max_hz
+        self.slow = slow
+        self.fast = fast
+        self.predictor = KeypointPredictor(num_keypoints, buffers=buffers)
+        self.next_time = None
+        self.rate = max_hz
+        self.inferences = 0
+        self.predictions = 0
+
+    def due(self, now)->bool:
+        return self.next_time is None or now >= self.next_time
+
+    def observe(self, poses, now):
+        """Takes the poses of an inference and schedules the next one"""
+        changed = len(poses) != self.predictor.count
+        self.predictor.observe(poses, now)
+        self.inferences += 1
+        if changed:
+            # someone came or went, look again soon
+            self.rate = self.max_hz
+        else:
+            share = np.clip((self.predictor.speed() - self.slow) / (self.fast - self.slow), 0.0, 1.0)
+            self.rate = self.min_hz + share * (self.max_hz - self.min_hz)
+        self.next_time = now + 1.0 / self.rate
+
+    def predict(self, now):
+        self.predictions += 1
+        return self.predictor.predict(now)
+
+    def report(self)->str:
+        total = self.inferences + self.predictions
+        return (f"inference ran on {self.inferences} of {total} frames "
+                f"({100.0 * self.inferences / max(total, 1):.0f}%), last rate {self.rate:.1f} Hz")
+
+
+class MotionGate:
+    """Skips inference on frames that look like the frame of the last inference.
+
+    The frames are compared on a grid of every step-th pixel: when less than
+    threshold of the samples changed by more than delta gray levels, the poses
+    of the last inference are reused, for at most max_age seconds. Comparing
+    with the last inferred frame rather than the previous one keeps a slow
+    drift from going unnoticed.
+    """
+
+    def __init__(self, threshold=0.005, delta=15.0, max_age=2.0, step=16):
+        self.threshold = threshold
+        self.delta = delta
+        self.max_age = max_age
+        self.step = step
+        self.poses = []
+        self.time = None
+        self.frames = 0
+        self.reused = 0
+        self.expired = 0
+        self._reference = None
+        self._sample = None
+        self._diff = None
+        self._mask = None
+
+    def changed(self, array, now)->bool:
+        """Samples the (H,W,C) frame, returns False if the last poses can be reused"""
+        self.frames += 1
+        grid = array[::self.step, ::self.step]
+        if self._sample is None or self._sample.shape != grid.shape[:2]:
+            self._sample = np.empty(grid.shape[:2], dtype=np.float32)
+            self._reference = None
+            self._diff = np.empty_like(self._sample)
+            self._mask = np.empty(self._sample.shape, dtype=bool)
+        np.sum(grid, axis=2, dtype=np.float32, out=self._sample)
+        self._sample *= 1.0 / grid.shape[2]
+
+        if self._reference is None:
+            return True
+        if now - self.time > self.max_age:
+            self.expired += 1
+            return True
+        np.subtract(self._sample, self._reference, out=self._diff)
+        np.abs(self._diff, out=self._diff)
+        np.greater(self._diff, self.delta, out=self._mask)
+        if np.count_nonzero(self._mask) > self.threshold * self._diff.size:
+            return True
+        self.reused += 1
+        return False
+
+    def inferred(self, poses, now):
+        """Keeps the poses and the sampled frame of an inference"""
+        self.poses = poses
+        self.time = now
+        if self._reference is None:
+            self._reference = np.empty_like(self._sample)
+        np.copyto(self._reference, self._sample)
+
+    def report(self)->str:
+        return (f"motion gate reused the poses on {self.reused} of {self.frames} frames "
+                f"({100.0 * self.reused / max(self.frames, 1):.0f}%), {self.expired} refreshed for age")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import argparse
+import threading
+import time
+
+from timeit import default_timer as timer
+
+
+PAN, TILT = 0, 1
+
+
+class ServoController(threading.Thread):
+    """Moves the pan/tilt servos from a worker thread.
+
+    track() only posts the joint position into a single-slot mailbox, so
+    several calls per frame coalesce into one update. The worker keeps the
+    commanded angles in memory instead of reading them back over I2C, skips
+    positions inside the dead-band around the center of the frame and writes
+    both axes in one cycle at no more than max_rate updates per second.
+    """
+
+    def __init__(self, kit, channels=(0, 1), home=(90.0, 90.0), center=(640.0, 360.0),
+                 deadband=(40.0, 30.0), step=3.0, max_rate=20.0):
+        super().__init__(name="servo", daemon=True)
+        self.kit = kit
+        self.channels = channels
+        self.center = center
+        self.deadband = deadband
+        self.step = step
+        self.interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.angles = [float(home[PAN]), float(home[TILT])]
+        self.updates = 0
+        self.writes = 0
+        self.observe = None # called with the time each update took, for the metrics
+        self._target = None
+        self._home = list(home)
+        self._synced = False # the board is in an unknown position until the first write
+        self._running = True
+        self._cond = threading.Condition()
+
+    def track(self, x, y):
+        """Posts the position of the tracked joint, replacing any pending one"""
+        with self._cond:
+            self._target = (x, y)
+            self._cond.notify()
+
+    def home(self, pan=None, tilt=None):
+        """Moves the given axes to an absolute angle on the next update"""
+        with self._cond:
+            if self._home is None:
+                self._home = [None, None]
+            if pan is not None:
+                self._home[PAN] = pan
+            if tilt is not None:
+                self._home[TILT] = tilt
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        last_update = None
+        while True:
+            with self._cond:
+                while self._running and self._target is None and self._home is None:
+                    self._cond.wait()
+                if not self._running:
+                    break
+
+            # let the mailbox coalesce until the next update is due
+            if last_update is not None:
+                delay = last_update + self.interval - timer()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with self._cond:
+                target, home = self._target, self._home
+                self._target = None
+                self._home = None
+            last_update = timer()
+            self._update(target, home)
+            if self.observe is not None:
+                self.observe(timer() - last_update)
+
+    def _update(self, target, home):
+        angles = list(self.angles)
+        if target is not None:
+            x, y = target
+            if x > self.center[0] + self.deadband[0]:
+                angles[PAN] -= self.step
+            elif x < self.center[0] - self.deadband[0]:
+                angles[PAN] += self.step
+
+            if y > self.center[1] + self.deadband[1]:
+                angles[TILT] += self.step
+            elif y < self.center[1] - self.deadband[1]:
+                angles[TILT] -= self.step
+
+        if home is not None:
+            for axis in (PAN, TILT):
+                if home[axis] is not None:
+                    angles[axis] = home[axis]
+
+        self.updates += 1
+        for axis in (PAN, TILT):
+            angle = min(max(0.0, angles[axis]), 180.0)
+            if angle != self.angles[axis] or not self._synced:
+                self.kit.servo[self.channels[axis]].angle = angle
+                self.angles[axis] = angle
+                self.writes += 1
+        self._synced = True
+
+
+class FakeServo:
+    def __init__(self, kit):
+        self._kit = kit
+        self._angle = None
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        # stands in for the PCA9685 register write over I2C
+        if self._kit.write_latency > 0:
+            time.sleep(self._kit.write_latency)
+        self._kit.writes += 1
+        self._angle = value
+
+
+class FakeServoKit:
+    """In-memory stand-in for adafruit_servokit.ServoKit that counts the writes"""
+
+    def __init__(self, channels=16, write_latency=0.0):
+        self.write_latency = write_latency
+        self.writes = 0
+        self.servo = [FakeServo(self) for _ in range(channels)]
+
+
+if __name__ == "__main__":
+    # drive the controller with a fake servo board, as if tracking two joints per frame
+    parser = argparse.ArgumentParser(description="Exercise the servo controller with a fake ServoKit.")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--max-rate", type=float, default=20.0, help="servo updates per second")
+    parser.add_argument("--write-ms", type=float, default=2.0, help="simulated I2C write latency")
+    args = parser.parse_args()
+
+    kit = FakeServoKit(write_latency=args.write_ms / 1000.0)
+    servo = ServoController(kit, max_rate=args.max_rate)
+    servo.start()
+
+    posted = 0
+    blocked = 0.0
+    for frame in range(args.frames):
+        x = 640.0 + 200.0 * ((frame // 60) % 2 * 2 - 1)
+        for joint in range(2):
+            start = timer()
+            servo.track(x, 360.0 + 10.0 * joint)
+            blocked += timer() - start
+            posted += 1
+        time.sleep(1.0 / args.fps)
+    servo.stop()
+
+    print(f"posted {posted} positions over {args.frames} frames, {1e6 * blocked / posted:.1f} us per post")
+    print(f"{servo.updates} servo updates, {kit.writes} I2C writes, final angles {servo.angles}")
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import socket
+import argparse
+import threading
+
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+from http.server import BaseHTTPRequestHandler
+from timeit import default_timer as timer
+
+from metrics import Histogram, ThreadingHTTPServer
+from utils.frame_mailbox import FrameMailbox
+
+
+BOUNDARY = "frame"
+PAGE = b"""<!DOCTYPE html>
+<html><head><title>Exercise Tracker</title></head>
+<body style="margin:0;background:#000"><img src="/stream.mjpg" style="width:100%"></body></html>
+"""
+
+
+class JpegEncoder:
+    """Encodes RGB frames to JPEG with OpenCV, reusing the BGR buffer"""
+
+    def __init__(self, quality=80):
+        if cv2 is None:
+            raise ValueError("streaming needs OpenCV (pip3 install opencv-python)")
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self._bgr = None
+
+    def __call__(self, rgb):
+        if self._bgr is None or self._bgr.shape != rgb.shape:
+            self._bgr = np.empty_like(rgb)
+        cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=self._bgr)
+        ok, jpeg = cv2.imencode(".jpg", self._bgr, self.params)
+        if not ok:
+            raise ValueError("JPEG encoding failed")
+        return jpeg.tobytes()
+
+
+class Viewer:
+    def __init__(self, address):
+        self.address = f"{address[0]}:{address[1]}"
+        self.connected = time.time()
+        self.sent = 0
+        self.skipped = 0
+        self.lag = 0.0      # seconds from publishing a frame until it was written, averaged
+        self.max_lag = 0.0
+
+
+class StreamServer:
+    """Serves the annotated frames as MJPEG to any number of viewers:
+
+        GET /             a page showing the stream
+        GET /stream.mjpg  the multipart JPEG stream
+        GET /frame.jpg    the newest frame
+        GET /stats        encode time and the frames sent, skipped and lag of each viewer as JSON
+
+    publish() copies the frame into a mailbox and returns, a thread encodes
+    the newest frame once and every viewer is sent that same buffer. Each
+    viewer has its own thread that always sends the newest encoded frame,
+    so a viewer on a slow link skips frames instead of holding up the
+    tracker or the other viewers. Nothing is copied or encoded while no
+    one is watching.
+    """
+
+    def __init__(self, port, host="127.0.0.1", max_fps=15.0, quality=80, encoder=None):
+        self.encoder = encoder or JpegEncoder(quality)
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.encode_seconds = Histogram()
+        self.published = 0
+        self.viewers = []
+        self.closed = False
+        self._mailbox = FrameMailbox()
+        self._published = threading.Event()
+        self._next_publish = 0.0
+        self._frame = None      # (seq, jpeg bytes, publish time) of the newest encoded frame
+        self._encoded = threading.Condition()
+        self._viewers_lock = threading.Lock()
+
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/":
+                    self._reply("text/html", PAGE)
+                elif path == "/frame.jpg":
+                    # frames are only encoded for viewers, so wait for the next one as one
+                    viewer = server._attach(self.client_address)
+                    try:
+                        frame = server.wait(server._frame[0] if server._frame is not None else 0, timeout=5.0)
+                    finally:
+                        server._detach(viewer)
+                    if frame is None:
+                        self.send_error(503, "no frame yet")
+                    else:
+                        self._reply("image/jpeg", frame[1])
+                elif path == "/stats":
+                    self._reply("application/json", json.dumps(server.stats()).encode())
+                elif path == "/stream.mjpg":
+                    self._stream()
+                else:
+                    self.send_error(404)
+
+            def _reply(self, content_type, body):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                # a viewer that stops reading is dropped rather than kept forever
+                self.connection.settimeout(10.0)
+                viewer = server._attach(self.client_address)
+                seq = 0
+                try:
+                    while not server.closed:
+                        frame = server.wait(seq, timeout=1.0)
+                        if frame is None:
+                            continue
+                        if seq:
+                            viewer.skipped += frame[0] - seq - 1
+                        seq, jpeg, published = frame
+                        self.wfile.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                                         f"Content-Length: {len(jpeg)}\r\n\r\n".encode())
+                        self.wfile.write(jpeg)
+                        self.wfile.write(b"\r\n")
+                        lag = timer() - published
+                        viewer.lag = lag if viewer.sent == 0 else 0.9 * viewer.lag + 0.1 * lag
+                        viewer.max_lag = max(viewer.max_lag, lag)
+                        viewer.sent += 1
+                except (OSError, socket.timeout):
+                    pass
+                finally:
+                    server._detach(viewer)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._encode_thread = threading.Thread(target=self._encode, name="stream-encode", daemon=True)
+        self._encode_thread.start()
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stream", daemon=True)
+        self.thread.start()
+
+    def due(self)->bool:
+        """True if publish() would take a frame now, so the caller can skip preparing the others"""
+        return bool(self.viewers) and timer() >= self._next_publish
+
+    def publish(self, rgb):
+        """Hands an (H,W,3) RGB frame to the encoder, it is copied so the caller can reuse it"""
+        if not self.viewers:
+            return False
+        now = timer()
+        if now < self._next_publish:
+            return False
+        self._next_publish = now + self.interval
+
+        buffers = self._mailbox.back()
+        if buffers is None or buffers[0].shape != rgb.shape:
+            buffers = self._mailbox.set_back([np.empty_like(rgb), 0.0])
+        np.copyto(buffers[0], rgb)
+        buffers[1] = now
+        self._mailbox.publish()
+        self.published += 1
+        self._published.set()
+        return True
+
+    def _encode(self):
+        seq = 0
+        while not self.closed:
+            if not self._published.wait(1.0):
+                continue
+            self._published.clear()
+            new_seq, buffers = self._mailbox.take(seq)
+            if buffers is None:
+                continue
+            seq = new_seq
+            start = timer()
+            jpeg = self.encoder(buffers[0])
+            self.encode_seconds.observe(timer() - start)
+            with self._encoded:
+                self._frame = (seq, jpeg, buffers[1])
+                self._encoded.notify_all()
+
+    def wait(self, seq, timeout=None):
+        """Returns the newest (seq, jpeg, publish time) encoded after seq, None on timeout"""
+        with self._encoded:
+            if self._encoded.wait_for(lambda: self.closed or (self._frame is not None and self._frame[0] != seq), timeout):
+                return self._frame
+        return None
+
+    def _attach(self, address):
+        viewer = Viewer(address)
+        with self._viewers_lock:
+            self.viewers = self.viewers + [viewer]
+        return viewer
+
+    def _detach(self, viewer):
+        with self._viewers_lock:
+            self.viewers = [v for v in self.viewers if v is not viewer]
+
+    def stats(self):
+        encode = self.encode_seconds
+        return {"published": self.published, "encoded": encode.count,
+                "encode_ms": 1000.0 * encode.sum / max(encode.count, 1),
+                "bytes": len(self._frame[1]) if self._frame is not None else 0,
+                "viewers": [{"address": v.address, "sent": v.sent, "skipped": v.skipped,
+                             "lag_ms": 1000.0 * v.lag, "max_lag_ms": 1000.0 * v.max_lag} for v in self.viewers]}
+
+    def report(self)->str:
+        stats = self.stats()
+        lines = [f"stream: {stats['encoded']} frames encoded in {stats['encode_ms']:.1f} ms on average, "
+                 f"{len(stats['viewers'])} viewers"]
+        for v in stats["viewers"]:
+            lines.append(f"  {v['address']}: {v['sent']} sent, {v['skipped']} skipped, "
+                         f"lag {v['lag_ms']:.1f} ms, at most {v['max_lag_ms']:.1f} ms")
+        return "\n".join(lines)
+
+    def close(self):
+        self.closed = True
+        with self._encoded:
+            self._encoded.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def watch(port, seconds, read_delay=0.0):
+    """A loopback viewer reading the stream for some seconds, pausing
+    read_delay after every read to act like a slow link"""
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
+        s.sendall(b"GET /stream.mjpg HTTP/1.0\r\n\r\n")
+        deadline = time.monotonic() + seconds
+        received = 0
+        while time.monotonic() < deadline:
+            data = s.recv(65536)
+            if not data:
+                break
+            received += data.count(f"--{BOUNDARY}".encode())
+            if read_delay:
+                time.sleep(read_delay)
+    return received
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream the frames of a frame bus, or synthetic frames, as MJPEG.")
+    parser.add_argument("--frame-bus", type=str, default="", help="stream the frames of this frame bus, see utils/framebus.py")
+    parser.add_argument("--sim", action="store_true", help="stream synthetic frames")
+    parser.add_argument("--width", type=int, default=1280, help="size of the synthetic frames")
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="0.0.0.0 to let other machines watch")
+    parser.add_argument("--fps", type=float, default=15.0, help="frames encoded per second at most")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality")
+    parser.add_argument("--demo", type=float, default=0, metavar="SECONDS",
+                        help="watch with a fast and a slow loopback viewer for some seconds and report")
+    args = parser.parse_args()
+    if not args.frame_bus and not args.sim:
+        parser.error("either --frame-bus or --sim is needed")
+
+    stream = StreamServer(args.port, args.host, args.fps, args.quality)
+    print(f"streaming on http://{args.host}:{stream.port}/")
+
+    if args.demo:
+        for delay in (0.0, 0.2):
+            # they outlast the demo, so they are still listed in the report
+            threading.Thread(target=watch, args=(stream.port, args.demo + 1.0, delay), daemon=True).start()
+        while not stream.viewers:
+            time.sleep(0.01)
+
+    reader = None
+    if args.frame_bus:
+        from utils.framebus import FrameBusReader
+        reader = FrameBusReader(args.frame_bus, timeout=10.0)
+        frame = np.empty(reader.shape, dtype=np.uint8)
+    else:
+        # a bar sweeping across a gradient
+        frame = np.empty((args.height, args.width, 3), dtype=np.uint8)
+        gradient = np.linspace(0, 255, args.width, dtype=np.float32).astype(np.uint8)
+
+    start = time.monotonic()
+    try:
+        while not args.demo or time.monotonic() - start < args.demo:
+            if reader is not None:
+                if reader.read(frame, timeout=1.0) is None:
+                    if reader.closed:
+                        break
+                    continue
+            else:
+                frame[:, :, 0] = gradient
+                frame[:, :, 1] = 64
+                frame[:, :, 2] = 255 - gradient
+                x = int((time.monotonic() - start) * 240) % args.width
+                frame[:, x:x + 16] = 255
+                time.sleep(1.0 / 30)
+            stream.publish(frame)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(stream.report())
+        stream.close()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+from exercise_engine import KEYPOINT_NAMES
+
+
+# a packet is one UDP datagram, little endian:
+#   frame    version, kind (KEY or DELTA), seq uint16, hold countdown in seconds uint8, count uint16, people uint8
+#            KEY: frame width, height uint16
+#            every person: id uint8, bitmask of the keypoints present, then for each present keypoint
+#            x, y as uint8 fractions of the frame size (KEY, or DELTA for a keypoint that just appeared)
+#            or int8 differences to the previous packet (DELTA)
+#   status   version, STATUS, seq uint16, JSON of the exercise, repeat and status text
+#   hello    version, HELLO, sent by a viewer every few seconds to subscribe, and to ask for a key frame
+VERSION = 1
+KEY, DELTA, STATUS, HELLO = range(1, 5)
+FRAME = struct.Struct("<BBHBHB")
+SIZE = struct.Struct("<HH")
+HEAD = struct.Struct("<BBH")
+LEVELS = 255
+
+# the skeleton of the resnet18-body model
+LINKS = [("left_ankle", "left_knee"), ("left_knee", "left_hip"), ("right_ankle", "right_knee"),
+         ("right_knee", "right_hip"), ("left_hip", "right_hip"), ("left_shoulder", "left_hip"),
+         ("right_shoulder", "right_hip"), ("left_shoulder", "right_shoulder"), ("left_shoulder", "left_elbow"),
+         ("right_shoulder", "right_elbow"), ("left_elbow", "left_wrist"), ("right_elbow", "right_wrist"),
+         ("left_eye", "right_eye"), ("nose", "left_eye"), ("nose", "right_eye"), ("left_eye", "left_ear"),
+         ("right_eye", "right_ear"), ("left_ear", "left_shoulder"), ("right_ear", "right_shoulder"),
+         ("neck", "nose"), ("neck", "left_shoulder"), ("neck", "right_shoulder"), ("neck", "left_hip"),
+         ("neck", "right_hip")]
+
+
+def countdown(tracker, now):
+    """Seconds left of the hold the tracker is timing, 0 when there is none"""
+    if not tracker.part_at_exercise_previously or tracker.exercise_completed:
+        return 0
+    return max(0.0, tracker.time_start + tracker.exercise["duration"] - now)
+
+
+class TelemetryEncoder:
+    """Packs keypoints into key and delta packets.
+
+    The keypoints are quantized to 1/255 of the frame, and a delta packet
+    carries the differences to the values of the last packet, so a person
+    costs a few dozen bytes. A key frame is sent when a difference does not
+    fit a byte, when the people change or when asked for.
+    """
+
+    def __init__(self, num_keypoints, width=0, height=0):
+        self.num_keypoints = num_keypoints
+        self.seq = 0
+        self.status_seq = 0
+        self._reference = {}  # person id -> (present, quantized) of the last packet
+        self._counts = None
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        """Sets the size of the frames the keypoints are in, 0 while it is not known"""
+        self.size = (width, height)
+        self.scale = np.array([LEVELS / max(width, 1), LEVELS / max(height, 1)], dtype=np.float32)
+        # the deltas to the old size mean nothing in the new one
+        self._reference = {}
+
+    def encode(self, people, countdown=0.0, count=0, key=False, unchanged=True):
+        """people is a list of (id, (K,2) keypoints in pixels, NaN if not detected).
+        Returns the packet, or None when unchanged is False and the packet
+        would add nothing to the last one."""
+        quantized = []
+        for person_id, keypoints in people:
+            present = ~np.isnan(keypoints[:, 0])
+            q = np.rint(np.where(present[:, None], keypoints, 0) * self.scale)
+            quantized.append((person_id & 0xff, present, np.clip(q, 0, LEVELS).astype(np.uint8)))
+        counts = (min(int(np.ceil(countdown)), 255), min(count, 0xffff))
+
+        reference = self._reference
+        key = key or set(reference) != {person_id for person_id, _, _ in quantized}
+        values = []
+        changed = counts != self._counts
+        for person_id, present, q in quantized:
+            if key:
+                values.append(q[present])
+                continue
+            ref_present, ref_q = reference[person_id]
+            delta = q.astype(np.int16) - ref_q
+            kept = present & ref_present
+            if kept.any() and np.abs(delta[kept]).max() > 127:
+                key = True
+                values = [q[present] for _, present, q in quantized]
+                break
+            # a keypoint that just appeared has no value to differ from
+            values.append(np.where(ref_present[:, None], delta, q)[present])
+            changed = changed or (present != ref_present).any() or delta[kept].any()
+        if not (key or changed or unchanged):
+            return None
+
+        self.seq = (self.seq + 1) & 0xffff
+        parts = [FRAME.pack(VERSION, KEY if key else DELTA, self.seq, counts[0], counts[1], len(quantized))]
+        if key:
+            parts.append(SIZE.pack(*self.size))
+        for (person_id, present, q), person_values in zip(quantized, values):
+            parts.append(bytes([person_id]))
+            parts.append(np.packbits(present).tobytes())
+            # negative differences are stored as their two's complement
+            parts.append((person_values & 0xff).astype(np.uint8).tobytes())
+        self._reference = {person_id: (present, q) for person_id, present, q in quantized}
+        self._counts = counts
+        return b"".join(parts)
+
+    def encode_status(self, status):
+        self.status_seq = (self.status_seq + 1) & 0xffff
+        return HEAD.pack(VERSION, STATUS, self.status_seq) + json.dumps(status, separators=(",", ":")).encode()
+
+
+class TelemetryDecoder:
+    """Unpacks the packets of a TelemetryEncoder. After a lost packet the
+    deltas cannot be applied until the next key frame, need_key tells the
+    viewer to ask for one."""
+
+    def __init__(self, num_keypoints=len(KEYPOINT_NAMES)):
+        self.num_keypoints = num_keypoints
+        self.mask_bytes = (num_keypoints + 7) // 8
+        self.size = None
+        self.seq = None
+        self.need_key = True
+        self.people = {}      # id -> (K,2) keypoints as fractions of the frame, NaN if not detected
+        self.countdown = 0
+        self.count = 0
+        self.status = {}
+        self.lost = 0
+        self._reference = {}
+
+    def decode(self, packet)->bool:
+        """Applies a packet, returns True if the people or status changed"""
+        version, kind, seq = HEAD.unpack_from(packet)
+        if version != VERSION:
+            return False
+        if kind == STATUS:
+            self.status = json.loads(packet[HEAD.size:].decode())
+            return True
+        if kind not in (KEY, DELTA):
+            return False
+
+        if self.seq is not None and seq != (self.seq + 1) & 0xffff:
+            self.lost += (seq - self.seq - 1) & 0xffff
+            self.need_key = True
+        self.seq = seq
+        if kind == DELTA and self.need_key:
+            return False
+
+        _, _, _, countdown, count, num_people = FRAME.unpack_from(packet)
+        offset = FRAME.size
+        if kind == KEY:
+            self.size = SIZE.unpack_from(packet, offset)
+            offset += SIZE.size
+            self.need_key = False
+
+        reference = {}
+        people = {}
+        for _ in range(num_people):
+            person_id = packet[offset]
+            mask = np.frombuffer(packet, dtype=np.uint8, count=self.mask_bytes, offset=offset + 1)
+            present = np.unpackbits(mask)[:self.num_keypoints].astype(bool)
+            offset += 1 + self.mask_bytes
+            values = np.frombuffer(packet, dtype=np.uint8, count=2 * int(present.sum()), offset=offset).reshape(-1, 2)
+            offset += values.nbytes
+
+            q = np.zeros((self.num_keypoints, 2), dtype=np.uint8)
+            if kind == KEY:
+                q[present] = values
+            else:
+                ref_present, ref_q = self._reference.get(person_id, (np.zeros(self.num_keypoints, dtype=bool), q))
+                kept = ref_present[present]
+                q[present] = np.where(kept[:, None], ref_q[present] + values.view(np.int8).astype(np.int16), values)
+            reference[person_id] = (present, q)
+            keypoints = q.astype(np.float32) / LEVELS
+            keypoints[~present] = np.nan
+            people[person_id] = keypoints
+
+        self._reference = reference
+        self.people = people
+        self.countdown = countdown
+        self.count = count
+        return True
+
+
+class TelemetryServer:
+    """Sends the keypoints and exercise status to viewers over UDP.
+
+    Viewers subscribe by sending hello datagrams at least every timeout
+    seconds, so they can sit behind a NAT. publish() is called with the
+    data of every frame and sends at most rate packets a second, skipping
+    packets that change nothing but sending one every second to show the
+    tracker is alive, a key frame every keyframe_interval seconds and the
+    status whenever it changes or with a key frame. Sending never blocks,
+    a datagram the socket cannot take is dropped. Nothing is sent until the
+    frame size is known, from the constructor or resize().
+    """
+
+    def __init__(self, port, width=0, height=0, host="127.0.0.1", num_keypoints=len(KEYPOINT_NAMES),
+                 rate=5.0, keyframe_interval=2.0, timeout=30.0):
+        self.encoder = TelemetryEncoder(num_keypoints, width, height)
+        self.interval = 1.0 / rate
+        self.keyframe_interval = keyframe_interval
+        self.timeout = timeout
+        self.subscribers = {}  # address -> time of the last hello
+        self.packets = 0
+        self.bytes = 0
+        self.started = timer()
+        self._next_send = 0.0
+        self._sent = 0.0
+        self._next_key = 0.0
+        self._status = None
+        self._key_requested = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self.port = self._socket.getsockname()[1]
+        self._closed = False
+        self._thread = threading.Thread(target=self._receive, name="telemetry", daemon=True)
+        self._thread.start()
+
+    def _receive(self):
+        while not self._closed:
+            try:
+                packet, address = self._socket.recvfrom(64)
+            except OSError:
+                break
+            if len(packet) >= 2 and packet[0] == VERSION and packet[1] == HELLO:
+                # a new viewer, or one that lost a packet, needs a key frame
+                self.subscribers[address] = timer()
+                self._key_requested = True
+
+    def resize(self, width, height):
+        """Sets the size of the frames, the viewers get it with the next key frame"""
+        if (width, height) != self.encoder.size:
+            self.encoder.resize(width, height)
+            self._key_requested = True
+
+    def publish(self, people, status, countdown=0.0, count=0):
+        """people is a list of (id, (K,2) keypoints), status a dict of the exercise and status text"""
+        now = timer()
+        if not self.subscribers or now < self._next_send or not all(self.encoder.size):
+            return
+        self._next_send = now + self.interval
+        for address, seen in list(self.subscribers.items()):
+            if now - seen > self.timeout:
+                del self.subscribers[address]
+
+        key = self._key_requested or now >= self._next_key
+        if key:
+            self._key_requested = False
+            self._next_key = now + self.keyframe_interval
+        if key or status != self._status:
+            self._status = status
+            self._send(self.encoder.encode_status(status))
+        packet = self.encoder.encode(people, countdown, count, key, unchanged=now - self._sent >= 1.0)
+        if packet is not None:
+            self._send(packet)
+            self._sent = now
+
+    def _send(self, packet):
+        for address in list(self.subscribers):
+            try:
+                self._socket.sendto(packet, socket.MSG_DONTWAIT, address)
+                self.packets += 1
+                self.bytes += len(packet)
+            except OSError:
+                pass
+
+    def report(self)->str:
+        elapsed = max(timer() - self.started, 1e-9)
+        return (f"telemetry: {self.packets} packets, {self.bytes} bytes, "
+                f"{self.bytes / elapsed:.0f} bytes/s to {len(self.subscribers)} viewers")
+
+    def close(self):
+        self._closed = True
+        self._socket.close()
+
+
+def draw(canvas, decoder, links):
+    """Draws the stick figures and status of the decoder onto a BGR canvas with OpenCV"""
+    import cv2
+    canvas.fill(0)
+    height, width = canvas.shape[:2]
+    for person_id, keypoints in decoder.people.items():
+        points = keypoints * (width, height)
+        for a, b in links:
+            if not (np.isnan(points[a, 0]) or np.isnan(points[b, 0])):
+                cv2.line(canvas, tuple(int(v) for v in points[a]), tuple(int(v) for v in points[b]), (0, 255, 0), 2)
+        for x, y in points[~np.isnan(points[:, 0])]:
+            cv2.circle(canvas, (int(x), int(y)), 3, (0, 200, 255), -1)
+    lines = [f"{decoder.status.get('exercise', '')}  # exercises: {decoder.count}"]
+    lines.append(f"Holds this position for {decoder.countdown} seconds." if decoder.countdown
+                 else decoder.status.get("status") or "")
+    for i, line in enumerate(lines):
+        cv2.putText(canvas, line, (10, 30 + 30 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the keypoints and exercise status sent with main.py --telemetry-port.")
+    parser.add_argument("host", type=str, help="address of the tracker")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--width", type=int, default=640, help="width of the window, the height follows the frame")
+    parser.add_argument("--text", action="store_true", help="print the status instead of drawing the stick figures")
+    parser.add_argument("--seconds", type=float, default=0, help="stop after some seconds and report the bandwidth")
+    args = parser.parse_args()
+
+    decoder = TelemetryDecoder()
+    name_id = {name: i for i, name in enumerate(KEYPOINT_NAMES)}
+    links = [(name_id[a], name_id[b]) for a, b in LINKS]
+    hello = bytes([VERSION, HELLO])
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.5)
+    address = (socket.gethostbyname(args.host), args.port)
+
+    canvas = None
+    last_hello = 0.0
+    last_line = None
+    received = 0
+    start = time.monotonic()
+    try:
+        while not args.seconds or time.monotonic() - start < args.seconds:
+            now = time.monotonic()
+            # keep subscribed, and ask for a key frame after losing a packet
+            if now - last_hello >= 5.0 or (decoder.need_key and now - last_hello >= 0.5):
+                s.sendto(hello, address)
+                last_hello = now
+            try:
+                packet = s.recv(2048)
+            except socket.timeout:
+                continue
+            received += len(packet)
+            if not decoder.decode(packet):
+                continue
+
+            if args.text:
+                line = (decoder.status.get("exercise"), decoder.countdown or decoder.status.get("status") or "",
+                        decoder.count, len(decoder.people))
+                if line != last_line:
+                    print(f"{time.monotonic() - start:8.1f}  {line[0]}: {line[1]}  # exercises: {line[2]}  people: {line[3]}")
+                    last_line = line
+            elif decoder.size is not None:
+                import cv2
+                height = args.width * decoder.size[1] // decoder.size[0]
+                if canvas is None or canvas.shape[:2] != (height, args.width):
+                    canvas = np.zeros((height, args.width, 3), dtype=np.uint8)
+                draw(canvas, decoder, links)
+                cv2.imshow("Exercise Tracker", canvas)
+                if cv2.waitKey(1) & 0xff == ord("q"):
+                    break
+    except KeyboardInterrupt:
+        pass
+    elapsed = time.monotonic() - start
+    print(f"received {received} bytes, {received / max(elapsed, 1e-9):.0f} bytes/s, {decoder.lost} packets lost")
@@ -0,0 +1,51 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class RecordingVideoSource:
+    """Stands in for jetson_utils.videoSource and keeps the arguments it was opened with"""
+    opened = []
+
+    def __init__(self, uri="", argv=None):
+        self.opened.append((uri, argv))
+
+    @staticmethod
+    def Usage():
+        return ""
+
+
+def fake_jetson(monkeypatch):
+    class WithUsage:
+        @staticmethod
+        def Usage():
+            return ""
+
+    RecordingVideoSource.opened = []
+    monkeypatch.setitem(sys.modules, "jetson_inference", types.SimpleNamespace(poseNet=WithUsage))
+    monkeypatch.setitem(sys.modules, "jetson_utils", types.SimpleNamespace(
+        videoSource=RecordingVideoSource, videoOutput=WithUsage, Log=WithUsage, cudaFont=None,
+        cudaToNumpy=None, cudaDeviceSynchronize=None))
+    monkeypatch.setitem(sys.modules, "adafruit_servokit", types.SimpleNamespace(ServoKit=None))
+
+
+def test_input_uri_reaches_the_video_source(monkeypatch):
+    fake_jetson(monkeypatch)
+    monkeypatch.setattr(sys, "argv", ["main.py"])
+    args, backend = main.parse_args(["--recipe", "recipes/default.json", "csi://1", "--input-flip=rotate-180"])
+
+    assert args.input == "csi://1"
+    backend.videoSource(args.input, buffers=8)
+    uri, argv = RecordingVideoSource.opened[-1]
+    assert uri == "csi://1"
+    assert "--input-flip=rotate-180" in argv
+    assert argv[-1] == "--num-buffers=8"
+
+
+def test_sim_options_are_not_taken_for_the_uri():
+    args, backend = main.parse_args(["--backend", "sim", "--sim-frames", "30"])
+    assert args.input == ""
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import sys
+import queue
+import threading
+import multiprocessing
+import cv2
+
+from face_store import FaceStore, encode_image
+
+
+class Enroller:
+    """Saves captured photos and adds their encodings to the face store in the background.
+
+    The GUI only copies the frame and calls enroll(). A thread encodes the
+    JPEG and writes it, then a process pool computes the face encoding and
+    appends it to the store, where running recognizers pick it up with
+    FaceStore.load(). Create it before the GUI starts, so the pool processes
+    are forked from a process without GUI threads.
+    """
+
+    def __init__(self, image_dir, workers=1, quality=95, maxsize=8):
+        self.store = FaceStore(image_dir)
+        self.quality = quality
+        self.saved = 0
+        self.enrolled = 0
+        self.no_face = 0
+        self.failed = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(workers)
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="enroll", daemon=True)
+        self._thread.start()
+
+    def enroll(self, frame, name, filename)->bool:
+        """Queues a BGR frame to be saved as image_dir/name/filename, False if the queue is full"""
+        try:
+            self._queue.put_nowait((frame, name, filename))
+        except queue.Full:
+            return False
+        with self._lock:
+            self._pending += 1
+        return True
+
+    def pending(self)->int:
+        with self._lock:
+            return self._pending
+
+    def _done(self, counter):
+        with self._lock:
+            self._pending -= 1
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            frame, name, filename = job
+            path = os.path.join(self.store.image_dir, name, filename)
+            try:
+                ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ok:
+                    raise ValueError("JPEG encoding failed")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # written under a temporary name so a store sync never sees half a file
+                with open(path + ".tmp", "wb") as f:
+                    f.write(jpeg.tobytes())
+                os.replace(path + ".tmp", path)
+                self.saved += 1
+            except (OSError, ValueError) as e:
+                print(f"enroll: cannot save {path}: {e}", file=sys.stderr)
+                self._done("failed")
+                continue
+
+            relative = f"{name}/{filename}"
+            self._pool.apply_async(encode_image, (path,),
+                                   callback=lambda encoding, relative=relative, name=name: self._add(relative, name, encoding),
+                                   error_callback=lambda e, path=path: self._error(path, e))
+
+    def _add(self, path, name, encoding):
+        try:
+            self.store.add(path, name, encoding)
+            self._done("enrolled" if encoding is not None else "no_face")
+        except OSError as e:
+            self._error(path, e)
+
+    def _error(self, path, e):
+        print(f"enroll: cannot encode {path}: {e}", file=sys.stderr)
+        self._done("failed")
+
+    def close(self):
+        """Finishes the queued photos and stops the pool"""
+        self._queue.put(None)
+        self._thread.join()
+        self._pool.close()
+        self._pool.join()
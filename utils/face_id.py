@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 import os
-import face_recognition
+import signal
+import argparse
 import cv2
 import numpy as np
 
+from timeit import default_timer as timer
+
+from face_store import FaceStore
+from face_match import AGGREGATES, TOLERANCE
+from face_worker import RecognitionWorker
+from framebus import FrameBusReader
+from profiler import SpanProfiler
+
 
 
 def gstreamer_pipeline(
@@ -33,77 +42,116 @@ def gstreamer_pipeline(
         )
     )
 
-video_capture = cv2.VideoCapture(gstreamer_pipeline(flip_method=2), cv2.CAP_GSTREAMER)
-
-known_face_encodings = []
+parser = argparse.ArgumentParser(description="Identify the people in front of the camera.")
+parser.add_argument("--aggregate", type=str, default="best", choices=AGGREGATES,
+                    help="compare against the closest photo of each person or the centroid of their photos")
+parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="largest distance accepted as a match")
+parser.add_argument("--top-k", type=int, default=1, help="also show the runner-up candidates of each face")
+parser.add_argument("--detect-interval", type=int, default=10, help="frames between face detections while faces are tracked")
+parser.add_argument("--reverify", type=float, default=5.0, help="seconds before a tracked face is identified again")
+parser.add_argument("--frame-bus", type=str, default="", help="take the frames from this shared-memory frame bus instead of opening the camera")
+parser.add_argument("--profile", type=int, default=0, help="record the spans of the first N frames as a Chrome trace, 0 for none,\n"
+                                                           "kill -USR1 records the next N frames (300 by default)")
+parser.add_argument("--profile-dir", type=str, default="profiles", help="directory of the traces")
+parser.add_argument("--cprofile", action="store_true", help="also profile this loop with cProfile while recording a trace")
+args = parser.parse_args()
 
 image_root = "/jetson-exercise-tracker"
-
-known_face_names = []
-
-
-for person_dir in os.listdir(os.path.join(image_root, "face_images")):
-    person_full_path = os.path.join(image_root, "face_images", person_dir)
-    for person_image in os.listdir(person_full_path):
-        img = face_recognition.load_image_file(os.path.join(person_full_path, person_image))    
-        encodings = face_recognition.face_encodings(img)
-        print(person_dir, person_image)
-        if len(encodings) > 0:
-            known_face_encodings.append(encodings[0])
-            known_face_names.append(person_dir)
-        
-
-face_locations = []
-face_encodings = []
-face_names = []
-face_scores = []
-process_this_frame = True
+image_dir = os.path.join(image_root, "face_images")
+
+capture_width, capture_height = 1280, 720
+frame_bus = None
+if args.frame_bus:
+    # another process owns the camera and publishes RGB frames
+    frame_bus = FrameBusReader(args.frame_bus, timeout=10.0)
+    capture_height, capture_width = frame_bus.shape[:2]
+small_width, small_height = capture_width // 4, capture_height // 4
+
+# encodings are kept in face_images/.index and only new or changed photos are encoded,
+# before the camera is opened so the encoding processes do not inherit it
+known_face_encodings, known_face_names = FaceStore(image_dir).sync()
+print(f"{len(known_face_names)} known faces of {len(set(known_face_names))} people")
+
+# detection, encoding and matching run in their own process on the newest frame,
+# this loop only downscales, hands the frame over and draws the last known faces
+worker = RecognitionWorker((small_height, small_width, 3), image_dir, args.aggregate, args.tolerance, args.top_k,
+                           args.detect_interval, args.reverify)
+worker.start()
+
+# the trace gets the detect/encode/match spans of the worker process too
+profiler = SpanProfiler("face_id", args.profile_dir, args.cprofile)
+profiler.on_start.append(worker.start_profile)
+profiler.sources.append(worker.stop_profile)
+profiler.toggle_on(signal.SIGUSR1, args.profile or 300)
+
+if frame_bus is None:
+    video_capture = cv2.VideoCapture(gstreamer_pipeline(capture_width, capture_height, capture_width, capture_height,
+                                                        flip_method=2), cv2.CAP_GSTREAMER)
+
+small_frame = np.empty((small_height, small_width, 3), dtype=np.uint8)
+frame = np.empty((capture_height, capture_width, 3), dtype=np.uint8)
+frames = 0
+start = timer()
+if args.profile:
+    profiler.start(args.profile)
 
 while True:
-
-    ret, frame = video_capture.read()
-
-    if process_this_frame:
-        small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-
-        rgb_small_frame = small_frame[:, :, ::-1]
-        
-        face_locations = face_recognition.face_locations(rgb_small_frame)
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
-
-
-        face_names = []
-        for face_encoding in face_encodings:
-            matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-            name = "Unknown"
-
-            face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-            best_match_index = np.argmin(face_distances)
-            best_match_score = np.min(face_distances)
-            if matches[best_match_index]:
-                name = known_face_names[best_match_index]
-            face_names.append(name)
-            face_scores.append(best_match_score)
-
-    process_this_frame = not process_this_frame
-
-    for (top, right, bottom, left), name in zip(face_locations, face_names):
-        top *= 4
-        right *= 4
-        bottom *= 4
-        left *= 4
-
-        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
-
-        cv2.rectangle(frame, (left, bottom - 35), (right, bottom), (0, 0, 255), cv2.FILLED)
-        font = cv2.FONT_HERSHEY_DUPLEX
-        cv2.putText(frame, name + " " + str(best_match_score), (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
-
-    cv2.imshow('Video', frame)
-
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
+    profiler.frame()
+
+    if frame_bus is None:
+        with profiler.span("capture", profile=True):
+            # decodes into the same frame every time while the size does not change
+            ret, frame = video_capture.read(frame)
+        if not ret:
+            break
+
+        with profiler.span("resize", profile=True):
+            cv2.resize(frame, (small_width, small_height), dst=small_frame)
+            with worker.slot.write() as rgb_small_frame:
+                cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB, dst=rgb_small_frame)
+    else:
+        with profiler.span("capture", profile=True):
+            latest = frame_bus.wait(1.0)
+        if latest is None:
+            if frame_bus.closed:
+                break
+            continue
+        # read in place from shared memory, the bus frame is already RGB
+        rgb_frame = latest[2]
+        with profiler.span("resize", profile=True):
+            with worker.slot.write() as rgb_small_frame:
+                cv2.resize(rgb_frame, (small_width, small_height), dst=rgb_small_frame)
+            cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGR, dst=frame)
+    frames += 1
+
+    scale_x = frame.shape[1] / small_width
+    scale_y = frame.shape[0] / small_height
+    with profiler.span("draw", profile=True):
+        for (top, right, bottom, left), name, distance, candidates in worker.poll():
+            top, bottom = int(top * scale_y), int(bottom * scale_y)
+            left, right = int(left * scale_x), int(right * scale_x)
+
+            cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+
+            cv2.rectangle(frame, (left, bottom - 35), (right, bottom), (0, 0, 255), cv2.FILLED)
+            font = cv2.FONT_HERSHEY_DUPLEX
+            cv2.putText(frame, f"{name} {distance:.2f}", (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
+            for i, (candidate, candidate_distance) in enumerate(candidates):
+                cv2.putText(frame, f"{candidate} {candidate_distance:.2f}", (left + 6, bottom + 20 + 20 * i), font, 0.6, (255, 255, 255), 1)
+
+    with profiler.span("display", profile=True):
+        cv2.imshow('Video', frame)
+        key = cv2.waitKey(1) & 0xFF
+    if key == ord('q'):
         break
 
-video_capture.release()
+elapsed = timer() - start
+# the worker has to be running to hand over its spans
+profiler.stop(wait=True)
+worker.close()
+if frame_bus is None:
+    video_capture.release()
+else:
+    frame_bus.close()
 cv2.destroyAllWindows()
+print(f"{frames / max(elapsed, 1e-9):.1f} FPS displayed, recognition {worker.latency * 1000:.0f} ms per frame, {worker.stats}")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import numpy as np
+
+from timeit import default_timer as timer
+
+from face_store import ENCODING_SIZE
+
+
+# the distance face_recognition.compare_faces() accepts as the same person
+TOLERANCE = 0.6
+AGGREGATES = ["best", "centroid"]
+
+Match = collections.namedtuple("Match", ["name", "distance", "candidates"])
+
+
+class FaceMatcher:
+    """Matches all the faces of a frame against the known encodings at once.
+
+    The (faces x known) euclidean distances come from one matrix product,
+    using |a-b|^2 = |a|^2 + |b|^2 - 2ab with the known norms computed up
+    front, and are then reduced per person: "best" takes the closest photo
+    of each person, "centroid" compares against the mean of their photos.
+    """
+
+    def __init__(self, encodings, names, aggregate="best", tolerance=TOLERANCE):
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"unknown aggregate {aggregate}, expected one of {', '.join(AGGREGATES)}")
+        self.aggregate = aggregate
+        self.tolerance = tolerance
+
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(len(names), ENCODING_SIZE)
+        # group the rows by person so the per-person minimum is one reduceat()
+        self.people, person_of_row = np.unique(np.asarray(names, dtype=object), return_inverse=True)
+        order = np.argsort(person_of_row, kind="stable")
+        counts = np.bincount(person_of_row, minlength=len(self.people))
+        self._starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+
+        if aggregate == "centroid":
+            known = np.add.reduceat(encodings[order], self._starts, axis=0) / counts[:, None] if len(names) else encodings
+        else:
+            known = encodings[order]
+        self.known = np.ascontiguousarray(known, dtype=np.float32)
+        self._known_sq = np.einsum("ij,ij->i", self.known, self.known)
+
+    def __len__(self):
+        return len(self.people)
+
+    def distances(self, face_encodings):
+        """Returns the (faces x people) distance matrix"""
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(len(face_encodings), ENCODING_SIZE)
+        if len(faces) == 0 or len(self.people) == 0:
+            return np.full((len(faces), len(self.people)), np.inf, dtype=np.float32)
+        d2 = faces @ self.known.T
+        d2 *= -2
+        d2 += self._known_sq
+        d2 += np.einsum("ij,ij->i", faces, faces)[:, None]
+        np.maximum(d2, 0, out=d2)
+        d = np.sqrt(d2, out=d2)
+        if self.aggregate == "best":
+            d = np.minimum.reduceat(d, self._starts, axis=1)
+        return d
+
+    def match(self, face_encodings, k=1):
+        """Returns a Match per face: the best person, or "Unknown" when nobody is within
+        the tolerance, its distance and the k closest (name, distance) candidates"""
+        d = self.distances(face_encodings)
+        k = min(k, d.shape[1])
+        if k == 0:
+            return [Match("Unknown", float("inf"), []) for _ in range(len(d))]
+        if k < d.shape[1]:
+            top = np.argpartition(d, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(d.shape[1]), d.shape)
+        top_d = np.take_along_axis(d, top, axis=1)
+        order = np.argsort(top_d, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_d = np.take_along_axis(top_d, order, axis=1)
+
+        matches = []
+        for people, distances in zip(top, top_d):
+            candidates = [(self.people[p], float(dist)) for p, dist in zip(people, distances)]
+            name, distance = candidates[0]
+            matches.append(Match(name if distance <= self.tolerance else "Unknown", distance, candidates))
+        return matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time matching faces against random identities.")
+    parser.add_argument("--people", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--photos", type=int, default=5, help="photos per person")
+    parser.add_argument("--faces", type=int, default=2, help="faces per frame")
+    parser.add_argument("--aggregate", type=str, default="best", choices=AGGREGATES)
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    for people in args.people:
+        names = [f"person{i}" for i in range(people) for _ in range(args.photos)]
+        encodings = rng.normal(0, 0.05, (len(names), 128)).astype(np.float32)
+        matcher = FaceMatcher(encodings, names, args.aggregate)
+        faces = encodings[rng.randint(0, len(names), args.faces)] + rng.normal(0, 0.01, (args.faces, 128))
+
+        start = timer()
+        for _ in range(args.runs):
+            matches = matcher.match(faces, k=3)
+        elapsed = (timer() - start) / args.runs
+        print(f"{people:5d} people, {len(names):5d} photos: {elapsed * 1000:.3f} ms per frame, "
+              f"{matches[0].name} {matches[0].distance:.3f}")
@@ -19,9 +19,14 @@ import cv2
 import os 
 import sys 
 import time 
-from PyQt6.QtCore import pyqtSignal, pyqtSlot, Qt, QThread
+from PyQt6.QtCore import pyqtSignal, pyqtSlot, Qt, QThread, QTimer
+import argparse
 import numpy as np
 
+from face_enroll import Enroller
+from frame_mailbox import FrameMailbox
+from framebus import FrameBusReader
+
 
 def gstreamer_pipeline(
     capture_width=1280,
@@ -53,23 +58,69 @@ def gstreamer_pipeline(
 
 
 class VideoThread(QThread):
-    change_pixmap_signal = pyqtSignal(np.ndarray)
+    """Captures frames and prepares them for display off the GUI thread.
+
+    Every frame is converted to RGB at the display size here and published
+    to the mailbox together with the full frame, the GUI picks up the newest
+    one on its own refresh timer instead of queueing a signal per frame.
+    """
 
-    def __init__(self):
+    def __init__(self, display_width=1280, display_height=720, frame_bus=""):
         super().__init__()
         self._run_flag = True
+        self.frame_bus = frame_bus
+        self.display_size = (display_width, display_height)
+        self.mailbox = FrameMailbox()
 
     def run(self):
         # capture from web cam
         self._run_flag = True
-        self.cap = cv2.VideoCapture(gstreamer_pipeline(flip_method=2), cv2.CAP_GSTREAMER)
+        if self.frame_bus:
+            # another process owns the camera and publishes RGB frames
+            self.cap = None
+            bus = FrameBusReader(self.frame_bus, timeout=10.0)
+        else:
+            self.cap = cv2.VideoCapture(gstreamer_pipeline(flip_method=2), cv2.CAP_GSTREAMER)
+        scaled = None
         while self._run_flag:
-  
-            ret, cv_img = self.cap.read()
-            if ret:
-                self.change_pixmap_signal.emit(cv_img)
+
+            buffers = self.mailbox.back()
+            if self.cap is None:
+                ret, cv_img = self.read_bus(bus, buffers[0] if buffers is not None else None)
+            else:
+                ret, cv_img = self.cap.read(buffers[0] if buffers is not None else None)
+            if not ret:
+                continue
+
+            h, w = cv_img.shape[:2]
+            scale = min(self.display_size[0] / w, self.display_size[1] / h)
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            if buffers is None or buffers[0] is not cv_img or buffers[1].shape[:2] != size[::-1]:
+                buffers = self.mailbox.set_back((cv_img, np.empty((size[1], size[0], 3), dtype=np.uint8)))
+            if size == (w, h):
+                cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB, dst=buffers[1])
+            else:
+                if scaled is None or scaled.shape != buffers[1].shape:
+                    scaled = np.empty_like(buffers[1])
+                cv2.resize(cv_img, size, dst=scaled, interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(scaled, cv2.COLOR_BGR2RGB, dst=buffers[1])
+            self.mailbox.publish()
         # shut down capture system
-        self.cap.release()
+        if self.cap is None:
+            bus.close()
+        else:
+            self.cap.release()
+
+    def read_bus(self, bus, out):
+        """Converts the newest frame of the bus to BGR in out, like cap.read()"""
+        latest = bus.wait(0.5)
+        if latest is None:
+            return False, out
+        rgb = latest[2]
+        if out is None or out.shape != rgb.shape:
+            out = np.empty(rgb.shape, dtype=np.uint8)
+        cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=out)
+        return True, out
 
     def stop(self):
         """Sets run flag to False and waits for thread to finish"""
@@ -77,15 +128,20 @@ class VideoThread(QThread):
 
 
 class Ui_Main_window(QMainWindow):
-    def setupUi(self):
+    def setupUi(self, display_fps=15.0, frame_bus=""):
+        self.disply_width = 1280
+        self.display_height = 720        
+
         # create the video capture thread
-        self.thread = VideoThread()        
-        self.thread.change_pixmap_signal.connect(self.update_image)
+        self.thread = VideoThread(self.disply_width, self.display_height, frame_bus)
         # start the thread
         self.thread.start()    
-        
-        self.disply_width = 1280
-        self.display_height = 720        
+
+        # the display refreshes at its own rate, whatever the camera delivers
+        self.frame_seq = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_image)
+        self.timer.start(int(1000 / display_fps))
                 
         font = QtGui.QFont()
         font.setPointSize(14)        
@@ -133,8 +189,10 @@ class Ui_Main_window(QMainWindow):
         self.label.setAlignment(Qt.AlignmentFlag.AlignCenter)    
 
 
-    def __init__(self): 
+    def __init__(self, enroller=None): 
         super().__init__() 
+        self.enroller = enroller
+        self.enrolled = 0
 
 		# creating a status bar 
         self.status = QStatusBar() 
@@ -150,6 +208,7 @@ class Ui_Main_window(QMainWindow):
     def closeEvent(self, event):
         print("closing")
         time.sleep(1)
+        self.timer.stop()
         self.thread.stop()
         
         event.accept() # let the window close
@@ -171,7 +230,8 @@ class Ui_Main_window(QMainWindow):
 		# capture the image and save it on the save path 
 
         person_dir = os.path.join(self.save_path, self.person_name)
-        os.makedirs(person_dir, exist_ok=True)
+        if self.enroller is None:
+            os.makedirs(person_dir, exist_ok=True)
 
         self.capture_filename = os.path.join(person_dir, 
 			"%04d-%s.jpg" % ( 
@@ -193,24 +253,32 @@ class Ui_Main_window(QMainWindow):
 		# setting text to the error message 
         error.showMessage(msg) 
 
-    def update_image(self, cv_img):
-        """Updates the image_label with a new opencv image"""
-        qt_img = self.convert_cv_qt(cv_img)
-        self.label.setPixmap(qt_img)
+    def update_image(self):
+        """Updates the image_label with the newest frame of the capture thread"""
+        self.frame_seq, buffers = self.thread.mailbox.take(self.frame_seq)
+        if buffers is None:
+            return
+        cv_img, rgb_image = buffers
+        self.label.setPixmap(self.convert_cv_qt(rgb_image))
         if self.capture_filename != "":
-            cv2.imwrite(self.capture_filename, cv_img)
+            if self.enroller is None:
+                cv2.imwrite(self.capture_filename, cv_img)
+            elif not self.enroller.enroll(cv_img.copy(), self.person_name, os.path.basename(self.capture_filename)):
+                self.label1.setText(f"Hello {self.person_name}, still saving the last photos, try again")
             self.capture_filename = ""
+        # photos are saved and encoded in the background, show when they are ready for recognition
+        if self.enroller is not None and self.enroller.enrolled != self.enrolled:
+            self.enrolled = self.enroller.enrolled
+            self.label1.setText(f"Hello {self.person_name}, photo taken: {self.save_seq}, ready for recognition: {self.enrolled}")
 
 
-    def convert_cv_qt(self, cv_img):
-        """Convert from an opencv image to QPixmap"""
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+    def convert_cv_qt(self, rgb_image):
+        """Convert from an RGB image already at display size to QPixmap"""
         h, w, ch = rgb_image.shape
         bytes_per_line = ch * w
+        # wraps the buffer without copying, fromImage() makes the one copy
         convert_to_Qt_format = QtGui.QImage(rgb_image.data, w, h, bytes_per_line, QtGui.QImage.Format.Format_RGB888)
-        p = convert_to_Qt_format.scaled(self.disply_width, self.display_height, Qt.AspectRatioMode.KeepAspectRatio)
-        #p = convert_to_Qt_format.scaled(801, 801, Qt.KeepAspectRatio)
-        return QPixmap.fromImage(p)
+        return QPixmap.fromImage(convert_to_Qt_format)
         
 
 
@@ -229,8 +297,17 @@ class Ui_Main_window(QMainWindow):
 
 if __name__ == "__main__":
     import sys
-    app = QtWidgets.QApplication(sys.argv)
-    ui = Ui_Main_window()
-    ui.setupUi()
+    parser = argparse.ArgumentParser(description="Take photos for face recognition.")
+    parser.add_argument("--display-fps", type=float, default=15.0, help="refresh rate of the camera view")
+    parser.add_argument("--frame-bus", type=str, default="", help="take the frames from this shared-memory frame bus instead of opening the camera")
+    parser.add_argument("--enroll-workers", type=int, default=1, help="processes encoding the new photos")
+    args, qt_args = parser.parse_known_args()
+    # started before Qt so the encoding processes are forked without its threads
+    enroller = Enroller("/jetson-exercise-tracker/face_images", args.enroll_workers)
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    ui = Ui_Main_window(enroller)
+    ui.setupUi(args.display_fps, args.frame_bus)
     ui.show()
-    sys.exit(app.exec())
+    code = app.exec()
+    enroller.close()
+    sys.exit(code)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import fcntl
+import argparse
+import multiprocessing
+import numpy as np
+
+
+ENCODING_SIZE = 128
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def encode_image(path):
+    """Returns the encoding of the first face in the image, or None. Runs in the pool workers."""
+    import face_recognition
+    img = face_recognition.load_image_file(path)
+    encodings = face_recognition.face_encodings(img)
+    return encodings[0].astype(np.float32) if len(encodings) > 0 else None
+
+
+def _encode_job(job):
+    path, key = job
+    try:
+        return key, encode_image(path)
+    except Exception as e:
+        print(f"face_store: cannot encode {path}: {e}", file=sys.stderr)
+        return key, None
+
+
+class FaceStore:
+    """On-disk index of the face encodings of face_images/<person>/<photo>.
+
+    The index lives in face_images/.index as two append-only files:
+        encodings.f32   float32 rows of 128, memory-mapped as one matrix
+        entries.jsonl   one line per photo: path, size, mtime_ns, name and row
+                        (-1 when no face was found), the last line of a path wins
+    Photos are only encoded when they are new or their size or mtime changed,
+    and the files are rewritten when photos were changed or removed.
+    """
+
+    def __init__(self, image_dir, index_dir=None):
+        self.image_dir = image_dir
+        self.index_dir = index_dir or os.path.join(image_dir, ".index")
+        self.encodings_path = os.path.join(self.index_dir, "encodings.f32")
+        self.entries_path = os.path.join(self.index_dir, "entries.jsonl")
+        self.entries = {}   # relative path -> entry
+        self.rows = np.zeros((0, ENCODING_SIZE), dtype=np.float32)
+        self.lines = 0      # lines of entries.jsonl read so far
+        self._offset = 0    # bytes of entries.jsonl read so far
+        self._inode = None  # a compaction replaces the files, then they are read again
+
+    def _lock(self, mode=fcntl.LOCK_EX):
+        os.makedirs(self.index_dir, exist_ok=True)
+        lock = open(os.path.join(self.index_dir, "lock"), "a")
+        fcntl.flock(lock, mode)
+        return lock
+
+    def load(self)->bool:
+        """Reads the entries appended since the last load, returns True if there were any"""
+        lock = self._lock(fcntl.LOCK_SH)
+        try:
+            return self._load()
+        finally:
+            lock.close()
+
+    def _load(self):
+        if not os.path.exists(self.entries_path):
+            return False
+        with open(self.entries_path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self._inode:
+                self._inode = inode
+                self.entries = {}
+                self.lines = 0
+                self._offset = 0
+            f.seek(self._offset)
+            data = f.read()
+        # a line still being written has no newline yet
+        data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            return False
+        self._offset += len(data)
+        for line in data.splitlines():
+            entry = json.loads(line)
+            self.entries[entry["path"]] = entry
+            self.lines += 1
+        self.rows = self._map()
+        return True
+
+    def _map(self):
+        rows = os.path.getsize(self.encodings_path) // (4 * ENCODING_SIZE)
+        if rows == 0:
+            return np.zeros((0, ENCODING_SIZE), dtype=np.float32)
+        return np.memmap(self.encodings_path, dtype=np.float32, mode="r", shape=(rows, ENCODING_SIZE))
+
+    def known(self):
+        """Returns the (N,128) encodings and the N names of all photos with a face"""
+        entries = [entry for entry in self.entries.values() if 0 <= entry["row"] < len(self.rows)]
+        entries.sort(key=lambda entry: entry["path"])
+        rows = np.array([entry["row"] for entry in entries], dtype=np.intp)
+        return self.rows[rows], [entry["name"] for entry in entries]
+
+    def _scan(self):
+        photos = {}
+        if not os.path.isdir(self.image_dir):
+            return photos
+        for person_dir in sorted(os.listdir(self.image_dir)):
+            person_full_path = os.path.join(self.image_dir, person_dir)
+            if person_dir.startswith(".") or not os.path.isdir(person_full_path):
+                continue
+            for person_image in sorted(os.listdir(person_full_path)):
+                if not person_image.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                st = os.stat(os.path.join(person_full_path, person_image))
+                photos[f"{person_dir}/{person_image}"] = (person_dir, st.st_size, st.st_mtime_ns)
+        return photos
+
+    def _append(self, items):
+        """Appends (path, name, size, mtime_ns, encoding) items, holding the lock"""
+        with open(self.encodings_path, "ab") as rows_file, open(self.entries_path, "a") as entries_file:
+            row = os.path.getsize(self.encodings_path) // (4 * ENCODING_SIZE)
+            for path, name, size, mtime_ns, encoding in items:
+                entry = {"path": path, "name": name, "size": size, "mtime_ns": mtime_ns, "row": -1}
+                if encoding is not None:
+                    rows_file.write(np.asarray(encoding, dtype=np.float32).reshape(ENCODING_SIZE).tobytes())
+                    rows_file.flush()
+                    entry["row"] = row
+                    row += 1
+                # the row is on disk before the entry that points at it
+                entries_file.write(json.dumps(entry) + "\n")
+                entries_file.flush()
+
+    def _compact(self, photos):
+        """Rewrites the index with only the current photos, holding the lock"""
+        encodings, keep = [], []
+        for path in sorted(self.entries):
+            entry = dict(self.entries[path])
+            if path not in photos:
+                continue
+            if 0 <= entry["row"] < len(self.rows):
+                encodings.append(self.rows[entry["row"]])
+                entry["row"] = len(encodings) - 1
+            else:
+                entry["row"] = -1
+            keep.append(entry)
+
+        rows = np.array(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        rows.tofile(self.encodings_path + ".tmp")
+        with open(self.entries_path + ".tmp", "w") as f:
+            for entry in keep:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(self.encodings_path + ".tmp", self.encodings_path)
+        os.replace(self.entries_path + ".tmp", self.entries_path)
+
+        self.entries = {entry["path"]: entry for entry in keep}
+        self.rows = rows
+        self.lines = len(keep)
+        self._offset = os.path.getsize(self.entries_path)
+        self._inode = os.stat(self.entries_path).st_ino
+
+    def sync(self, workers=None):
+        """Brings the index up to date with the photos, encoding only new and
+        changed ones in a process pool, then returns known()"""
+        lock = self._lock()
+        try:
+            self._load()
+            photos = self._scan()
+            jobs = []
+            for path, (name, size, mtime_ns) in photos.items():
+                entry = self.entries.get(path)
+                if entry is None or entry["size"] != size or entry["mtime_ns"] != mtime_ns or entry["name"] != name:
+                    jobs.append((os.path.join(self.image_dir, path), path))
+
+            if jobs:
+                print(f"face_store: encoding {len(jobs)} of {len(photos)} photos")
+                workers = workers or min(len(jobs), multiprocessing.cpu_count())
+                if workers > 1:
+                    with multiprocessing.Pool(workers) as pool:
+                        results = list(pool.imap_unordered(_encode_job, jobs))
+                else:
+                    results = [_encode_job(job) for job in jobs]
+                self._append([(path,) + photos[path] + (encoding,) for path, encoding in results])
+                self._load()
+
+            # drop removed photos and rows that were superseded by a newer encoding
+            referenced = sum(1 for entry in self.entries.values() if entry["row"] >= 0)
+            if set(self.entries) - set(photos) or self.lines > len(self.entries) or len(self.rows) > referenced:
+                self._compact(photos)
+        finally:
+            lock.close()
+        return self.known()
+
+    def add(self, path, name, encoding):
+        """Adds one photo that is already in image_dir, e.g. just taken by the snapshot tool"""
+        st = os.stat(os.path.join(self.image_dir, path))
+        lock = self._lock()
+        try:
+            self._append([(path, name, st.st_size, st.st_mtime_ns, encoding)])
+        finally:
+            lock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the face encoding index of a face_images directory.")
+    parser.add_argument("image_dir", nargs="?", default="/jetson-exercise-tracker/face_images")
+    parser.add_argument("--workers", type=int, default=0, help="encoding processes, 0 for one per CPU")
+    args = parser.parse_args()
+
+    encodings, names = FaceStore(args.image_dir).sync(args.workers or None)
+    for name in sorted(set(names)):
+        print(name, names.count(name))
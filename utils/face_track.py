@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+def iou_matrix(a, b):
+    """Returns the (len(a) x len(b)) intersection over union of (top, right, bottom, left) boxes"""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    top = np.maximum(a[:, None, 0], b[None, :, 0])
+    right = np.minimum(a[:, None, 1], b[None, :, 1])
+    bottom = np.minimum(a[:, None, 2], b[None, :, 2])
+    left = np.maximum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (a[:, 1] - a[:, 3]) * (a[:, 2] - a[:, 0])
+    area_b = (b[:, 1] - b[:, 3]) * (b[:, 2] - b[:, 0])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+class CorrelationFollower:
+    """Follows a face between detections with a dlib correlation tracker"""
+
+    def __init__(self, image, box, min_quality=7.0):
+        import dlib
+        self.min_quality = min_quality
+        self.tracker = dlib.correlation_tracker()
+        top, right, bottom, left = box
+        self.tracker.start_track(image, dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+
+    def update(self, image):
+        """Returns the new box, or None when the face is lost"""
+        if self.tracker.update(image) < self.min_quality:
+            return None
+        position = self.tracker.get_position()
+        return (int(position.top()), int(position.right()), int(position.bottom()), int(position.left()))
+
+
+class Track:
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = tuple(box)
+        self.name = None
+        self.distance = float("inf")
+        self.candidates = []
+        self.verified_at = None
+        self.missed = 0
+        self.follower = None
+
+
+class FaceTracker:
+    """Keeps the identity of a face on a track between detections.
+
+    A full detection runs when there are no tracks, when a follower lost its
+    face, or every detect_interval frames to pick up new faces. Detected boxes
+    are associated with the tracks by IoU, and only new faces and tracks due
+    for re-verification are returned for encoding. In between, the followers
+    move the boxes, so a single person in front of the camera is encoded once
+    per reverify_interval seconds instead of on every frame.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=1, detect_interval=10, reverify_interval=5.0, follower=CorrelationFollower):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.detect_interval = detect_interval
+        self.reverify_interval = reverify_interval
+        self.follower = follower
+        self.tracks = []
+        self.frames = 0
+        self.detections = 0
+        self.encodings = 0
+        self._next_id = 0
+        self._since_detection = 0
+        self._lost = False
+
+    def needs_detection(self):
+        return not self.tracks or self._lost or self._since_detection >= self.detect_interval
+
+    def follow(self, image):
+        """Moves the tracks on a frame without detection"""
+        self.frames += 1
+        self._since_detection += 1
+        for track in self.tracks:
+            if track.follower is None:
+                continue
+            box = track.follower.update(image)
+            if box is None:
+                self._lost = True
+            else:
+                track.box = box
+
+    def update(self, image, boxes, now):
+        """Associates the detected boxes with the tracks, returns the tracks that need encoding"""
+        self.frames += 1
+        self.detections += 1
+        self._since_detection = 0
+        self._lost = False
+
+        boxes = [tuple(box) for box in boxes]
+        matched_tracks, matched_boxes = set(), set()
+        if self.tracks and boxes:
+            iou = iou_matrix([track.box for track in self.tracks], boxes)
+            # greedy assignment, best overlaps first
+            for flat in np.argsort(iou, axis=None)[::-1]:
+                t, b = np.unravel_index(flat, iou.shape)
+                if iou[t, b] < self.iou_threshold:
+                    break
+                if t in matched_tracks or b in matched_boxes:
+                    continue
+                matched_tracks.add(t)
+                matched_boxes.add(b)
+                self.tracks[t].box = boxes[b]
+                self.tracks[t].missed = 0
+
+        tracks = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    continue
+            tracks.append(track)
+        for b, box in enumerate(boxes):
+            if b not in matched_boxes:
+                tracks.append(Track(self._next_id, box))
+                self._next_id += 1
+        self.tracks = tracks
+
+        for track in self.tracks:
+            if track.missed == 0 and self.follower is not None:
+                track.follower = self.follower(image, track.box)
+        return [track for track in self.tracks if track.missed == 0 and
+                (track.verified_at is None or now - track.verified_at >= self.reverify_interval)]
+
+    def identify(self, track, match, now):
+        """Stores the Match of an encoded track"""
+        track.name, track.distance, track.candidates = match
+        track.verified_at = now
+        self.encodings += 1
+
+    def stats(self):
+        return f"{self.frames} frames, {self.detections} detections, {self.encodings} encodings"
+
+
+if __name__ == "__main__":
+    # a face drifting right with a second one appearing halfway, followed by shifting the last box
+    class Follower:
+        def __init__(self, image, box):
+            self.box = box
+
+        def update(self, image):
+            top, right, bottom, left = self.box
+            self.box = (top, right + 2, bottom, left + 2)
+            return self.box
+
+    tracker = FaceTracker(follower=Follower, reverify_interval=2.0)
+    for frame in range(120):
+        now = frame / 30
+        if not tracker.needs_detection():
+            tracker.follow(None)
+            continue
+        boxes = [(50, 100 + 2 * frame, 150, 2 * frame)]
+        if frame >= 60:
+            boxes.append((40, 400, 140, 300))
+        for track in tracker.update(None, boxes, now):
+            tracker.identify(track, (f"person{track.id}", 0.3, []), now)
+    print(tracker.stats(), [(track.id, track.name) for track in tracker.tracks])
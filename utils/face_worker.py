@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import queue
+import contextlib
+import multiprocessing
+import numpy as np
+
+from timeit import default_timer as timer
+
+from face_store import FaceStore
+from face_match import FaceMatcher
+from face_track import FaceTracker
+from profiler import SpanProfiler
+
+
+class FrameSlot:
+    """A single frame in shared memory that the writer overwrites and the
+    reader copies out, so the reader always gets the newest frame and frames
+    it was too busy for are skipped rather than queued"""
+
+    def __init__(self, shape, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._buffer = multiprocessing.RawArray("B", int(np.prod(self.shape)) * self.dtype.itemsize)
+        self._seq = multiprocessing.RawValue("Q", 0)
+        self._lock = multiprocessing.Lock()
+        self._ready = multiprocessing.Event()
+        self._map()
+
+    def _map(self):
+        self.array = np.frombuffer(self._buffer, dtype=self.dtype).reshape(self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["array"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map()
+
+    @contextlib.contextmanager
+    def write(self):
+        """Yields the shared frame to write the next frame into"""
+        with self._lock:
+            yield self.array
+            self._seq.value += 1
+        self._ready.set()
+
+    def read(self, out, seq, timeout=None):
+        """Copies a frame newer than seq into out, returns its sequence number or None on timeout"""
+        if not self._ready.wait(timeout):
+            return None
+        with self._lock:
+            self._ready.clear()
+            if self._seq.value == seq:
+                return None
+            np.copyto(out, self.array)
+            return self._seq.value
+
+
+class RecognitionWorker:
+    """Runs detection, encoding, matching and tracking in a separate process.
+
+    The display loop writes the newest downscaled RGB frame into the slot
+    and keeps drawing the last published faces, so dlib holding the GIL or
+    the CPU for a long detection never stalls the display. Start it before
+    opening the camera so the process does not inherit the capture.
+    """
+
+    def __init__(self, shape, image_dir, aggregate="best", tolerance=0.6, top_k=1,
+                 detect_interval=10, reverify_interval=5.0, reload_interval=2.0):
+        self.slot = FrameSlot(shape)
+        self.options = dict(image_dir=image_dir, aggregate=aggregate, tolerance=tolerance, top_k=top_k,
+                            detect_interval=detect_interval, reverify_interval=reverify_interval,
+                            reload_interval=reload_interval)
+        self.faces = []
+        self.seq = 0
+        self.stats = ""
+        self.latency = 0.0
+        self._results = multiprocessing.Queue()
+        self._stop = multiprocessing.Event()
+        self._profiling = multiprocessing.Value("b", 0)
+        self._spans = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_run, name="face-recognition",
+                                                args=(self.slot, self._results, self._stop, self.options,
+                                                      self._profiling, self._spans), daemon=True)
+
+    def start(self):
+        self._process.start()
+
+    def poll(self):
+        """Returns the newest published faces: (box, name, distance, candidates) tuples"""
+        while True:
+            try:
+                self.seq, self.faces, self.stats, self.latency = self._results.get_nowait()
+            except queue.Empty:
+                return self.faces
+
+    def start_profile(self):
+        """Makes the process record the spans of its next frames"""
+        self._profiling.value = 1
+
+    def stop_profile(self, timeout=2.0):
+        """Returns the Chrome trace events the process recorded since start_profile()"""
+        self._profiling.value = 0
+        try:
+            return self._spans.get(timeout=timeout)
+        except queue.Empty:
+            return []
+
+    def close(self):
+        self._stop.set()
+        self._process.join(2.0)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+def _run(slot, results, stop, options, profiling, spans):
+    import face_recognition
+
+    store = FaceStore(options["image_dir"])
+    store.load()
+    matcher = FaceMatcher(*store.known(), aggregate=options["aggregate"], tolerance=options["tolerance"])
+    tracker = FaceTracker(detect_interval=options["detect_interval"], reverify_interval=options["reverify_interval"])
+
+    profiler = SpanProfiler("face-recognition")
+    rgb = np.empty(slot.shape, dtype=slot.dtype)
+    seq = 0
+    loaded = timer()
+    while not stop.is_set():
+        if profiling.value and not profiler.active:
+            profiler.start()
+        elif not profiling.value and profiler.active:
+            spans.put(profiler.trace_events(profiler.stop(write=False)))
+
+        # people enrolled with the snapshot tool are appended to the store while this runs
+        if timer() - loaded >= options["reload_interval"]:
+            loaded = timer()
+            if store.load():
+                matcher = FaceMatcher(*store.known(), aggregate=options["aggregate"], tolerance=options["tolerance"])
+
+        new_seq = slot.read(rgb, seq, timeout=0.5)
+        if new_seq is None:
+            continue
+        seq = new_seq
+        start = timer()
+
+        if tracker.needs_detection():
+            # only new faces and faces due for re-verification are encoded
+            with profiler.span("detect"):
+                pending = tracker.update(rgb, face_recognition.face_locations(rgb), start)
+            if pending:
+                with profiler.span("encode"):
+                    encodings = face_recognition.face_encodings(rgb, [track.box for track in pending])
+                with profiler.span("match"):
+                    matches = matcher.match(encodings, options["top_k"])
+                for track, match in zip(pending, matches):
+                    tracker.identify(track, match, timer())
+        else:
+            with profiler.span("follow"):
+                tracker.follow(rgb)
+
+        faces = [(track.box, track.name, track.distance, track.candidates[1:])
+                 for track in tracker.tracks if track.name is not None]
+        results.put((seq, faces, tracker.stats(), timer() - start))
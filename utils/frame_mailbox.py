@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import threading
+
+
+class FrameMailbox:
+    """Hands the newest frame from a capture thread to a slower reader.
+
+    Three sets of buffers rotate between the writer, the newest published
+    frame and the frame the reader holds, so the writer never waits, never
+    overwrites what the reader is using, and frames the reader did not get
+    to are simply replaced. Buffers are allocated once by the writer and
+    reused for every frame.
+    """
+
+    def __init__(self):
+        self._slots = [None, None, None]
+        self._back = 0
+        self._latest = None
+        self._reading = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def back(self):
+        """Returns the buffers of the writer, None until it stored some with set_back()"""
+        return self._slots[self._back]
+
+    def set_back(self, buffers):
+        self._slots[self._back] = buffers
+        return buffers
+
+    def publish(self):
+        """Publishes the back buffers as the newest frame and moves the writer to a free slot"""
+        with self._lock:
+            self._latest = self._back
+            self._seq += 1
+            self._back = next(i for i in range(3) if i != self._latest and i != self._reading)
+
+    def take(self, seq=0):
+        """Returns (seq, buffers) of the newest frame if it is newer than seq, else (seq, None).
+        The buffers stay valid until the next take()"""
+        with self._lock:
+            if self._latest is None or self._seq == seq:
+                return seq, None
+            self._reading = self._latest
+            return self._seq, self._slots[self._reading]
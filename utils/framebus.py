@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+import os
+import mmap
+import time
+import signal
+import argparse
+import contextlib
+import numpy as np
+
+
+# a bus is a file in /dev/shm laid out as
+#   header   HEADER_FIELDS uint64: magic, version, slots, height, width, channels, latest seq, closed
+#   seqs     (slots,) uint64   sequence number of the frame in each slot, 0 while it is being written
+#   times    (slots,) float64  capture time of the frame in each slot
+#   frames   (slots, height, width, channels) uint8 RGB, 64 byte aligned
+# frame n goes into slot n % slots, so a reader has slots - 1 frame times to use a frame in place
+MAGIC = int.from_bytes(b"FRAMEBUS", "little")
+VERSION = 1
+HEADER_FIELDS = 8
+LATEST, CLOSED = 6, 7
+BUS_DIR = "/dev/shm"
+
+
+def bus_path(name):
+    if not name or os.path.basename(name) != name:
+        raise ValueError(f"invalid frame bus name {name!r}")
+    return os.path.join(BUS_DIR, f"framebus-{name}")
+
+
+def _layout(slots, shape):
+    frames_offset = (HEADER_FIELDS + 2 * slots) * 8
+    frames_offset = (frames_offset + 63) // 64 * 64
+    return frames_offset, frames_offset + slots * int(np.prod(shape))
+
+
+def _views(buffer, slots, shape, frames_offset):
+    header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=buffer)
+    seqs = np.ndarray((slots,), dtype=np.uint64, buffer=buffer, offset=HEADER_FIELDS * 8)
+    times = np.ndarray((slots,), dtype=np.float64, buffer=buffer, offset=(HEADER_FIELDS + slots) * 8)
+    frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8, buffer=buffer, offset=frames_offset)
+    return header, seqs, times, frames
+
+
+class FrameBusWriter:
+    """The single producer of a frame bus, normally the process owning the camera"""
+
+    def __init__(self, name, shape, slots=4):
+        self.path = bus_path(name)
+        self.shape = tuple(shape)
+        self.slots = slots
+        frames_offset, size = _layout(slots, self.shape)
+        # a new file, so readers still mapping a previous bus keep their own
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.truncate(size)
+        with open(tmp, "r+b") as f:
+            self._mmap = mmap.mmap(f.fileno(), size)
+        self.header, self.seqs, self.times, self.frames = _views(self._mmap, slots, self.shape, frames_offset)
+        self.header[1:6] = (VERSION, slots) + self.shape
+        self.header[0] = MAGIC
+        os.replace(tmp, self.path)
+        self.seq = 0
+
+    @contextlib.contextmanager
+    def write(self, timestamp=None):
+        """Yields the slot to write the next frame into, it is published when the block ends"""
+        seq = self.seq + 1
+        slot = seq % self.slots
+        self.seqs[slot] = 0
+        yield self.frames[slot]
+        self.times[slot] = time.time() if timestamp is None else timestamp
+        self.seqs[slot] = seq
+        self.header[LATEST] = seq
+        self.seq = seq
+
+    def publish(self, frame, timestamp=None):
+        with self.write(timestamp) as slot:
+            np.copyto(slot, frame)
+
+    def close(self, unlink=True):
+        self.header[CLOSED] = 1
+        self.header = self.seqs = self.times = self.frames = None
+        with contextlib.suppress(BufferError):
+            self._mmap.close()
+        if unlink:
+            with contextlib.suppress(OSError):
+                os.unlink(self.path)
+
+
+class FrameBusReader:
+    """A read-only consumer of a frame bus, any number of them can attach.
+
+    latest() returns a view of the newest frame in shared memory without
+    copying. A slow consumer just skips to the newest frame, and checks with
+    intact() that the frame it used was not overwritten meanwhile, or uses
+    read() to copy it out consistently.
+    """
+
+    def __init__(self, name, timeout=None):
+        self.path = bus_path(name)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not os.path.exists(self.path):
+            if deadline is not None and time.monotonic() > deadline:
+                raise OSError(f"no frame bus at {self.path}, is the producer running?")
+            time.sleep(0.1)
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.uint64, buffer=self._mmap)
+        if int(header[0]) != MAGIC or int(header[1]) != VERSION:
+            raise ValueError(f"{self.path} is not a version {VERSION} frame bus")
+        self.slots = int(header[2])
+        self.shape = tuple(int(v) for v in header[3:6])
+        self.header, self.seqs, self.times, self.frames = _views(self._mmap, self.slots, self.shape,
+                                                                 _layout(self.slots, self.shape)[0])
+        self.seq = 0
+        self.skipped = 0
+
+    @property
+    def closed(self):
+        return bool(self.header[CLOSED])
+
+    def intact(self, seq):
+        """True while frame seq is still in its slot"""
+        return int(self.seqs[seq % self.slots]) == seq
+
+    def latest(self):
+        """Returns (seq, timestamp, read-only view) of the newest frame, or None if there is none yet"""
+        while True:
+            seq = int(self.header[LATEST])
+            if seq == 0:
+                return None
+            slot = seq % self.slots
+            timestamp = float(self.times[slot])
+            if self.intact(seq):
+                return seq, timestamp, self.frames[slot]
+
+    def wait(self, timeout=None, poll=0.002):
+        """Waits for a frame newer than the last one returned, counting the frames skipped.
+        Returns (seq, timestamp, view), or None on timeout or when the producer closed the bus."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while int(self.header[LATEST]) <= self.seq:
+            if self.closed or (deadline is not None and time.monotonic() > deadline):
+                return None
+            time.sleep(poll)
+        frame = self.latest()
+        if self.seq:
+            self.skipped += frame[0] - self.seq - 1
+        self.seq = frame[0]
+        return frame
+
+    def read(self, out, timeout=None):
+        """Copies the next newest frame into out, returns (seq, timestamp) or None"""
+        while True:
+            frame = self.wait(timeout)
+            if frame is None:
+                return None
+            seq, timestamp, view = frame
+            np.copyto(out, view)
+            if self.intact(seq):
+                return seq, timestamp
+
+    def close(self):
+        self.header = self.seqs = self.times = self.frames = None
+        # views still held by the consumer keep the mapping alive until they are gone
+        with contextlib.suppress(BufferError):
+            self._mmap.close()
+
+
+class FrameBusSource:
+    """A videoSource that captures from a frame bus.
+
+    The frames are copied from shared memory into a small pool of images
+    made by allocate(width, height), which returns (image, numpy view) and
+    on the Jetson allocates mapped CUDA memory, so the pool must hold more
+    images than the pipeline has frames in flight.
+    """
+
+    def __init__(self, name, allocate, buffers=6, timeout=10.0):
+        self.reader = FrameBusReader(name, timeout)
+        height, width, _ = self.reader.shape
+        self._pool = [allocate(width, height) for _ in range(buffers)]
+        self._next = 0
+        self.frames = 0
+
+    @property
+    def buffers(self):
+        return len(self._pool)
+
+    def Capture(self, timeout=1000):
+        image, view = self._pool[self._next]
+        if self.reader.read(view, timeout / 1000.0 if timeout >= 0 else None) is None:
+            return None
+        self._next = (self._next + 1) % len(self._pool)
+        self.frames += 1
+        return image
+
+    def IsStreaming(self)->bool:
+        return not self.reader.closed
+
+    def GetWidth(self):
+        return self.reader.shape[1]
+
+    def GetHeight(self):
+        return self.reader.shape[0]
+
+
+def gstreamer_pipeline(
+    capture_width=1280,
+    capture_height=720,
+    display_width=1280,
+    display_height=720,
+    framerate=30,
+    flip_method=0,
+    ):
+    return (
+        "nvarguscamerasrc ! "
+        "video/x-raw(memory:NVMM), "
+        "width=(int)%d, height=(int)%d, "
+        "format=(string)NV12, framerate=(fraction)%d/1 ! "
+        "nvvidconv flip-method=%d ! "
+        "video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "
+        "videoconvert ! "
+        "video/x-raw, format=(string)RGB ! appsink"
+        % (
+            capture_width,
+            capture_height,
+            framerate,
+            flip_method,
+            display_width,
+            display_height,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture the camera into a shared-memory frame bus.")
+    parser.add_argument("--name", type=str, default="camera", help="bus name, consumers attach with --frame-bus NAME")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--flip", type=int, default=2, help="nvvidconv flip-method")
+    parser.add_argument("--slots", type=int, default=4, help="frames kept in the ring")
+    parser.add_argument("--sim", action="store_true", help="publish synthetic frames instead of the camera")
+    args = parser.parse_args()
+
+    bus = FrameBusWriter(args.name, (args.height, args.width, 3), args.slots)
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    print(f"publishing {args.width}x{args.height} frames to {bus.path}")
+
+    try:
+        if args.sim:
+            # a bar sweeping across a gradient
+            gradient = np.linspace(0, 255, args.width, dtype=np.float32).astype(np.uint8)
+            next_time = time.monotonic()
+            while True:
+                with bus.write() as frame:
+                    frame[:, :, 0] = gradient
+                    frame[:, :, 1] = 64
+                    frame[:, :, 2] = 255 - gradient
+                    x = bus.seq * 8 % args.width
+                    frame[:, x:x + 16] = 255
+                next_time += 1.0 / args.fps
+                time.sleep(max(0.0, next_time - time.monotonic()))
+        else:
+            import cv2
+            cap = cv2.VideoCapture(gstreamer_pipeline(args.width, args.height, args.width, args.height,
+                                                      args.fps, args.flip), cv2.CAP_GSTREAMER)
+            while True:
+                with bus.write() as frame:
+                    # the capture decodes straight into the shared slot when the sizes agree
+                    ret, img = cap.read(frame)
+                    if not ret:
+                        # leaving the block with an exception does not publish the slot
+                        raise EOFError
+                    if not np.shares_memory(img, frame):
+                        np.copyto(frame, img)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        bus.close()
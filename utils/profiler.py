@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import pstats
+import signal
+import cProfile
+import threading
+import contextlib
+
+from timeit import default_timer as timer
+
+
+_NOTHING = object()
+
+
+class SpanProfiler:
+    """Records the spans of the next frames and writes them as a Chrome trace,
+    which chrome://tracing and ui.perfetto.dev open.
+
+    The functions to time are wrapped once with wrap() or span(), and only
+    check a flag while nothing is recorded. start() records the next frames,
+    counted by frame(), and the trace is written by a background thread when
+    they are done. With cprofile the calls of the wrapped stages are also
+    profiled, each thread with its own profiler, and dumped next to the
+    trace for pstats or snakeviz.
+
+    The spans use timer(), which is the same clock in every process on
+    Linux, so the spans of other processes returned by the sources can be
+    merged into the trace.
+    """
+
+    def __init__(self, name, directory="profiles", cprofile=False):
+        self.name = name
+        self.directory = directory
+        self.cprofile = cprofile
+        self.active = False
+        self.frames_left = 0
+        self.on_start = []   # called when recording starts
+        self.sources = []    # called when it stops, returning the trace events of other processes
+        self.written = None  # path of the last trace
+        self._events = []
+        self._profiles = {}
+        self._requested = _NOTHING
+        self._lock = threading.Lock()
+
+    def start(self, frames=0):
+        """Records the next frames, or until stop() with 0"""
+        with self._lock:
+            if self.active:
+                return
+            self._events = []
+            self._profiles = {}
+            self.frames_left = frames
+            self.active = True
+        for callback in self.on_start:
+            callback()
+
+    def stop(self, write=True, wait=False):
+        """Stops recording, writes the trace in the background, or before
+        returning with wait, and returns its spans"""
+        with self._lock:
+            if not self.active:
+                return []
+            self.active = False
+            events, profiles = self._events, self._profiles
+            # spans that were running end in a list nobody reads
+            self._events, self._profiles = [], {}
+        if write:
+            writer = threading.Thread(target=self._write, args=(events, profiles), name="profile-write")
+            writer.start()
+            if wait:
+                writer.join()
+        return events
+
+    def request(self, frames):
+        """Starts recording frames, or stops with None, at the next frame.
+        Safe to call from a signal handler."""
+        self._requested = frames
+
+    def toggle_on(self, signum, frames):
+        """Makes the signal start recording frames, or stop a recording early"""
+        def toggle(signum, frame):
+            self.request(None if self.active else frames)
+        signal.signal(signum, toggle)
+
+    def frame(self):
+        """Called once per frame, counts the recorded frames"""
+        requested = self._requested
+        if requested is not _NOTHING:
+            self._requested = _NOTHING
+            if requested is None:
+                self.stop()
+            else:
+                self.start(requested)
+        elif self.active and self.frames_left > 0:
+            self.frames_left -= 1
+            if self.frames_left == 0:
+                self.stop()
+
+    def wrap(self, name, fn, profile=False):
+        """Wraps fn so its calls are spans while recording, profile runs them under cProfile"""
+        def span(*args):
+            if not self.active:
+                return fn(*args)
+            start = timer()
+            if profile and self.cprofile:
+                result = self._profile().runcall(fn, *args)
+            else:
+                result = fn(*args)
+            self._events.append((name, threading.get_ident(), start, timer(), None))
+            return result
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name, profile=False):
+        """Records the block as a span while recording, profile runs it under cProfile"""
+        if not self.active:
+            yield
+            return
+        profiler = self._profile() if profile and self.cprofile else None
+        start = timer()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._events.append((name, threading.get_ident(), start, timer(), None))
+
+    def observer(self, name, observe=None):
+        """Returns a function taking the duration of something that just ended,
+        like ServoController.observe, that also records it as a span"""
+        def observe_span(seconds):
+            if self.active:
+                end = timer()
+                self._events.append((name, threading.get_ident(), end - seconds, end, None))
+            if observe is not None:
+                observe(seconds)
+        return observe_span
+
+    def _profile(self):
+        ident = threading.get_ident()
+        profile = self._profiles.get(ident)
+        if profile is None:
+            profile = self._profiles[ident] = cProfile.Profile()
+        return profile
+
+    def trace_events(self, events):
+        """The spans as Chrome trace events of this process"""
+        pid = os.getpid()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        trace = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        for tid in sorted({event[1] for event in events}):
+            trace.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                          "args": {"name": names.get(tid, str(tid))}})
+        for name, tid, start, end, args in events:
+            event = {"name": name, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": round(start * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+            if args:
+                event["args"] = args
+            trace.append(event)
+        return trace
+
+    def _write(self, events, profiles):
+        trace = self.trace_events(events)
+        for source in self.sources:
+            trace.extend(source())
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        number = 1
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}-{number}.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        if profiles:
+            pstats.Stats(*profiles.values()).dump_stats(path[:-len(".json")] + ".prof")
+        self.written = path
+        print(f"profile: wrote {len(events)} spans to {path}" + (" and the cProfile stats" if profiles else ""))